@@ -508,4 +508,5 @@ output_json["chn_trim_settings"] = chn_trim_settings
 output_json["channel_not_used"] = channel_not_used
 
 with open(output_json_path, 'w') as json_file:
-    json.dump(output_json, json_file, indent=4)
\ No newline at end of file
+    json.dump(output_json, json_file, indent=4)
+packetlib.register_calib_file(output_json_path, packetlib.calib_type_pedestal, h2gcroc_ip)
\ No newline at end of file
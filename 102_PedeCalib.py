@@ -1321,4 +1321,5 @@ output_pedecalib_json["dead_channels"] = dead_channels
 output_pedecalib_json["channel_not_used"] = channel_not_used
 
 with open(output_pedecalib_path, 'w') as f:
-    json.dump(output_pedecalib_json, f, indent=4)
\ No newline at end of file
+    json.dump(output_pedecalib_json, f, indent=4)
+packetlib.register_calib_file(output_pedecalib_path, packetlib.calib_type_pedestal, h2gcroc_ip)
\ No newline at end of file
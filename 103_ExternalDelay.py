@@ -8,6 +8,7 @@ import logging
 import colorlog
 from icmplib import ping
 from tqdm import tqdm
+import argparse
 
 # * --- Set up script information -------------------------------------
 script_id_str       = '103_ExternalDelay'
@@ -45,6 +46,13 @@ logger = logging.getLogger('example_logger')
 logger.setLevel(logging.DEBUG)
 logger.addHandler(handler)
 
+# * --- Set up argument parser -----------------------------------------
+parser = argparse.ArgumentParser(description='External trigger delay scan')
+parser.add_argument('-r', '--resume', type=str, nargs='?', const='latest', default=None, help='Resume an interrupted scan from its journal (newest journal if no file is given)')
+parser.add_argument('--force_resume', action='store_true', help='Resume even if the UDP or I2C settings differ from those stored in the journal')
+
+args = parser.parse_args()
+
 # * --- Set up output folder -------------------------------------------
 output_dump_path = 'dump'   # dump is for temporary files like config
 output_data_path = 'data'   # data is for very-likely-to-be-used files
@@ -59,6 +67,19 @@ output_data_path = os.path.join(output_data_path, output_folder_name)
 
 output_dump_folder = os.path.join(output_dump_path, output_folder_name)
 output_config_path = os.path.join(output_dump_path, output_config_json_name)
+scan_journal_path = os.path.join(output_dump_path, f'{script_id_str}_journal_{time.strftime("%Y%m%d_%H%M%S")}.jsonl')
+
+# * --- Resume from scan journal ---------------------------------------
+scan_journal = None
+if args.resume is not None:
+    try:
+        scan_journal = packetlib.resume_scan(args.resume, output_dump_path, script_id_str)
+    except FileNotFoundError as e:
+        logger.critical(str(e))
+        exit()
+    scan_journal_path = scan_journal.journal_path
+    output_data_path = scan_journal.header['output_data_path']
+    logger.info(f"Resuming scan from {scan_journal_path}, {len(scan_journal.points)} points already finished")
 
 common_settings_json_path = "common_settings.json"
 is_common_settings_exist = False
@@ -159,6 +180,11 @@ if len(pedestal_calib_files) > 0:
     newest_pedestal_calib_file = pedestal_calib_files[0]
     logger.info(f"Found newest pedestal calibration file: {newest_pedestal_calib_file}")
 
+# restore the board configuration of the interrupted scan
+if scan_journal is not None:
+    newest_pedestal_calib_file = scan_journal.header['pedestal_calib_file']
+    logger.info(f"Using pedestal calibration file of the resumed scan: {newest_pedestal_calib_file}")
+
 trim_dac_values     = []
 noinv_vref_list     = []
 inv_vref_list       = []
@@ -199,6 +225,24 @@ _ex_trg_val = 2 # TODO: Fixed external trigger value
 if gen_nr_cycle*(1+machine_gun_val)*4 > 300:
     logger.warning("Too much packet requested")
 
+# * --- Set up scan journal --------------------------------------------
+scan_journal_header = {
+        'script_id': script_id_str,
+        'output_data_path': output_data_path,
+        'pedestal_calib_file': newest_pedestal_calib_file,
+        'udp': output_config_json['udp'],
+        'i2c': output_config_json['i2c']
+}
+_new_scan = scan_journal is None
+try:
+    # a resumed scan has to run with the board settings it was started with
+    scan_journal = packetlib.open_or_resume_scan(scan_journal, scan_journal_path, scan_journal_header, force=args.force_resume)
+except ValueError as e:
+    logger.critical(f"{e}, use --force_resume to resume anyway")
+    exit()
+if _new_scan:
+    logger.info(f"Scan journal: {scan_journal_path}")
+
 try:
     # * --- Set up channel-wise registers -------------------------------------
     logger.info("Setting up channel-wise registers")
@@ -254,8 +298,14 @@ try:
     for _L1_delay_value in progress_bar:
     # for _ex_trg_val in progress_bar:
         progress_bar.set_description(f"L1 delay: {_L1_delay_value}")
+        scan_point = {'L1_delay': _L1_delay_value}
+        if scan_journal.is_done(scan_point):
+            measurement_good_array += scan_journal.get_data(scan_point)['measurement_good']
+            continue
+        _measurement_good_start = len(measurement_good_array)
         output_data_txt_name = "ex_delay_scan_data_val_" + str(_L1_delay_value) + "_" + time.strftime("%Y%m%d_%H%M%S") + ".txt"
         output_data_txt_path = os.path.join(output_data_path, output_data_txt_name)
+        scan_journal.start(scan_point, output_data_txt_name)
         with open(output_data_txt_path, 'w') as data_file:
             _trg_dead_time = _ex_trg_val + machine_gun_val + 10
             if _trg_dead_time > 255:
@@ -397,8 +447,14 @@ try:
         
         # * --- Save the data -----------------------------------------------------
         data_file.close()
+        # only good points are journaled, a resumed scan measures the others again
+        if all(measurement_good_array[_measurement_good_start:]):
+            scan_journal.record(scan_point, {'data_file': output_data_txt_name, 'measurement_good': measurement_good_array[_measurement_good_start:]})
+        else:
+            logger.warning(f"Scan point {scan_point} is not good and was not journaled")
 
 finally:
+    scan_journal.close()
     socket_udp.close()
     logger.info("Socket closed")
 
@@ -775,6 +775,7 @@ output_pedecalib_json["pede_values"]            = _trim_chn_pede_list
 
 with open(output_pedecalib_path, 'w') as f:
     json.dump(output_pedecalib_json, f, indent=4)
+packetlib.register_calib_file(output_pedecalib_path, packetlib.calib_type_pedestal, output_pedecalib_json['udp']['h2gcroc_ip'])
 
 with open(output_config_path, 'w') as f:
     json.dump(output_config_json, f, indent=4)
\ No newline at end of file
@@ -8,6 +8,7 @@ import logging
 import colorlog
 from icmplib import ping
 from tqdm import tqdm
+import argparse
 
 import matplotlib.pyplot as plt
 
@@ -16,104 +17,6 @@ import matplotlib.pyplot as plt
 script_id_str       = '204_PhaseScan'
 script_version_str  = '0.1'
 
-# * --- Test function -------------------------------------------------
-
-def measure_v0v1v2_raw(_socket_udp, _ip, _port, _fpga_address, _reg_runLR, _reg_offLR, _event_num, _fragment_life, _logger):
-    for _asic in range(2):
-        if not packetlib.send_check_i2c_wrapper(_socket_udp, _ip, _port, asic_num=_asic, fpga_addr = _fpga_address, sub_addr=packetlib.subblock_address_dict["Top"], reg_addr=0x00, data=_reg_runLR, retry=5, verbose=False):
-            _logger.warning(f"Failed to turn on LR for ASIC {_asic}")
-
-    packetlib.clean_socket(_socket_udp)
-
-    if not packetlib.send_daq_gen_start_stop(_socket_udp, _ip, _port, asic_num=0, fpga_addr = _fpga_address, daq_push=0x00, gen_start_stop=1, daq_start_stop=0xFF, verbose=False):
-        _logger.warning("Failed to start the generator")
-
-    extracted_payloads_pool = []
-    event_fragment_pool     = []
-    fragment_life_dict      = {}
-
-    current_half_packet_num = 0
-    current_event_num = 0
-
-    all_chn_value_0_array = np.zeros((_event_num, 152))
-    all_chn_value_1_array = np.zeros((_event_num, 152))
-    all_chn_value_2_array = np.zeros((_event_num, 152))
-    hamming_code_array    = np.zeros((_event_num, 12))
-
-    while True:
-        try:
-            data_packet, rec_addr    = _socket_udp.recvfrom(8192)
-            # _logger.debug("Packet received")
-            extracted_payloads_pool += packetlib.extract_raw_payloads(data_packet)
-            while len(extracted_payloads_pool) >= 5:
-                candidate_packet_lines = extracted_payloads_pool[:5]
-                is_packet_good, event_fragment = packetlib.check_event_fragment(candidate_packet_lines)
-                if is_packet_good:
-                    event_fragment_pool.append(event_fragment)
-                    current_half_packet_num += 1
-                    extracted_payloads_pool = extracted_payloads_pool[5:]
-                else:
-                    _logger.warning("Warning: Event fragment is not good")
-                    extracted_payloads_pool = extracted_payloads_pool[1:]
-            indices_to_delete = set()
-            if len(event_fragment_pool) >= 4:
-                event_fragment_pool = sorted(event_fragment_pool, key=lambda x: x[0][3:7])
-            i = 0
-            while i <= len(event_fragment_pool) - 4:
-                timestamp0 = event_fragment_pool[i][0][4] << 24 | event_fragment_pool[i][0][5] << 16 | event_fragment_pool[i][0][6] << 8 | event_fragment_pool[i][0][7]
-                timestamp1 = event_fragment_pool[i+1][0][4] << 24 | event_fragment_pool[i+1][0][5] << 16 | event_fragment_pool[i+1][0][6] << 8 | event_fragment_pool[i+1][0][7]
-                timestamp2 = event_fragment_pool[i+2][0][4] << 24 | event_fragment_pool[i+2][0][5] << 16 | event_fragment_pool[i+2][0][6] << 8 | event_fragment_pool[i+2][0][7]
-                timestamp3 = event_fragment_pool[i+3][0][4] << 24 | event_fragment_pool[i+3][0][5] << 16 | event_fragment_pool[i+3][0][6] << 8 | event_fragment_pool[i+3][0][7]
-                if timestamp0 == timestamp1 and timestamp0 == timestamp2 and timestamp0 == timestamp3:
-                    id_str = f"{timestamp0:08X}"
-                    for _half in range(4):
-                        extracted_data = packetlib.assemble_data_from_40bytes(event_fragment_pool[i+_half], verbose=False)
-                        extracted_values = packetlib.extract_values(extracted_data["_extraced_160_bytes"], verbose=False)
-                        uni_chn_base = (extracted_data["_header"] - 0xA0) * 76 + (extracted_data["_packet_type"] - 0x24) * 38
-                        for j in range(len(extracted_values["_extracted_values"])):
-                            all_chn_value_0_array[current_event_num][j+uni_chn_base] = extracted_values["_extracted_values"][j][1]
-                            all_chn_value_1_array[current_event_num][j+uni_chn_base] = extracted_values["_extracted_values"][j][2]
-                            all_chn_value_2_array[current_event_num][j+uni_chn_base] = extracted_values["_extracted_values"][j][3]
-                        hamming_code_array[current_event_num][_half*3+0] =  packetlib.DaqH_get_H1(extracted_values["_DaqH"])
-                        hamming_code_array[current_event_num][_half*3+1] =  packetlib.DaqH_get_H2(extracted_values["_DaqH"])
-                        hamming_code_array[current_event_num][_half*3+2] =  packetlib.DaqH_get_H3(extracted_values["_DaqH"])
-                    indices_to_delete.update([i, i+1, i+2, i+3])
-                    current_event_num += 1
-                    i += 4
-                else:
-                    if timestamp0 in fragment_life_dict:
-                        if fragment_life_dict[timestamp0] >= _fragment_life - 1:
-                            indices_to_delete.update([i])
-                            del fragment_life_dict[timestamp0]
-                        else:
-                            fragment_life_dict[timestamp0] += 1
-                    else:
-                        fragment_life_dict[timestamp0] = 1
-                    i += 1
-            for index in sorted(indices_to_delete, reverse=True):
-                del event_fragment_pool[index]
-            if current_event_num == _event_num:
-                break;      
-        except Exception as e:
-            _logger.warning("Exception in receiving data")
-            _logger.warning(e)
-            _logger.warning('Packet received: ' + str(current_half_packet_num))
-            _logger.warning('left fragments:' + str(len(event_fragment_pool)))
-            _logger.warning("current event num:" + str(current_event_num))
-            measurement_good_flag = False
-            break
-
-    if not np.all(hamming_code_array == 0):
-        _logger.warning("Hamming code error detected!")
-        measurement_good_flag = False
-    if not packetlib.send_daq_gen_start_stop(_socket_udp, _ip, _port, asic_num=0, fpga_addr = _fpga_address, daq_push=0x00, gen_start_stop=0, daq_start_stop=0x00, verbose=False):
-        _logger.warning("Failed to stop the generator")
-    for _asic in range(2):
-        if not packetlib.send_check_i2c_wrapper(_socket_udp, _ip, _port, asic_num=_asic, fpga_addr = _fpga_address, sub_addr=packetlib.subblock_address_dict["Top"], reg_addr=0x00, data=_reg_offLR, retry=5, verbose=False):
-            _logger.warning(f"Failed to turn off LR for ASIC {_asic}")
-    
-    return all_chn_value_0_array, all_chn_value_1_array, all_chn_value_2_array
-
 # * --- Set up logging ------------------------------------------------
 class TqdmColorLoggingHandler(colorlog.StreamHandler):
     def __init__(self):
@@ -146,6 +49,13 @@ logger = logging.getLogger('example_logger')
 logger.setLevel(logging.DEBUG)
 logger.addHandler(handler)
 
+# * --- Set up argument parser -----------------------------------------
+parser = argparse.ArgumentParser(description='Phase scan with internal injection')
+parser.add_argument('-r', '--resume', type=str, nargs='?', const='latest', default=None, help='Resume an interrupted scan from its journal (newest journal if no file is given)')
+parser.add_argument('--force_resume', action='store_true', help='Resume even if the UDP or I2C settings differ from those stored in the journal')
+
+args = parser.parse_args()
+
 # * --- Set up output folder -------------------------------------------
 output_dump_path = 'dump'   # dump is for temporary files like config
 output_data_path = 'data'   # data is for very-likely-to-be-used files
@@ -160,6 +70,19 @@ output_data_path = os.path.join(output_data_path, output_folder_name)
 
 output_dump_folder = os.path.join(output_dump_path, output_folder_name)
 output_config_path = os.path.join(output_dump_path, output_config_json_name)
+scan_journal_path = os.path.join(output_dump_path, f'{script_id_str}_journal_{time.strftime("%Y%m%d_%H%M%S")}.jsonl')
+
+# * --- Resume from scan journal ---------------------------------------
+scan_journal = None
+if args.resume is not None:
+    try:
+        scan_journal = packetlib.resume_scan(args.resume, output_dump_path, script_id_str)
+    except FileNotFoundError as e:
+        logger.critical(str(e))
+        exit()
+    scan_journal_path = scan_journal.journal_path
+    output_data_path = scan_journal.header['output_data_path']
+    logger.info(f"Resuming scan from {scan_journal_path}, {len(scan_journal.points)} points already finished")
 
 common_settings_json_path = "common_settings.json"
 is_common_settings_exist = False
@@ -255,6 +178,11 @@ if len(pedestal_calib_files) > 0:
     newest_pedestal_calib_file = pedestal_calib_files[0]
     logger.info(f"Found newest pedestal calibration file: {newest_pedestal_calib_file}")
 
+# restore the board configuration of the interrupted scan
+if scan_journal is not None:
+    newest_pedestal_calib_file = scan_journal.header['pedestal_calib_file']
+    logger.info(f"Using pedestal calibration file of the resumed scan: {newest_pedestal_calib_file}")
+
 trim_dac_values     = []
 inputdac_values     = []
 noinv_vref_list     = []
@@ -305,6 +233,24 @@ expected_event_num = gen_nr_cycle*(1+machine_gun_val)
 if gen_nr_cycle*(1+machine_gun_val)*4 > 300:
     logger.warning("Too much packet requested")
 
+# * --- Set up scan journal --------------------------------------------
+scan_journal_header = {
+        'script_id': script_id_str,
+        'output_data_path': output_data_path,
+        'pedestal_calib_file': newest_pedestal_calib_file,
+        'udp': output_config_json['udp'],
+        'i2c': output_config_json['i2c']
+}
+_new_scan = scan_journal is None
+try:
+    # a resumed scan has to run with the board settings it was started with
+    scan_journal = packetlib.open_or_resume_scan(scan_journal, scan_journal_path, scan_journal_header, force=args.force_resume)
+except ValueError as e:
+    logger.critical(f"{e}, use --force_resume to resume anyway")
+    exit()
+if _new_scan:
+    logger.info(f"Scan journal: {scan_journal_path}")
+
 try:
     # * --- Set up channel-wise registers -------------------------------------
     logger.info("Setting up channel-wise registers")
@@ -376,34 +322,50 @@ try:
     chns_phase_list = [[]]*len(target_chns)
     chns_pre_interval_list = [[]]*len(target_chns)
     chns_val0_list = [[]]*len(target_chns)
-    
-    progress_bar_phase = tqdm(phase_scan_range, desc="Phase scan", leave=True)
-    for _phase in progress_bar_phase:
-        progress_bar_phase.set_description(f"Phase scan: {_phase}")
-        _top_content_runLR = top_reg_runLR.copy()
-        _top_content_runLR[7] = _phase
-        _top_content_offLR = top_reg_offLR.copy()
-        _top_content_offLR[7] = _phase
-        progress_bar_gen_pre_interval = tqdm(gen_pre_interval_scan_range, desc="Pre-interval scan", leave=False)
-        for _gen_pre_interval in progress_bar_gen_pre_interval:
-            for _retry in range(3):
-                time.sleep(0.1)
-                if not packetlib.send_check_DAQ_gen_params(socket_udp, h2gcroc_ip, h2gcroc_port, 0x00, fpga_addr=fpga_address, data_coll_en=0x03,trig_coll_en=0x00, daq_fcmd=75, gen_preimp_en=1, gen_pre_interval= _gen_pre_interval, gen_nr_of_cycle=gen_nr_cycle,gen_pre_fcmd=gen_fcmd_internal_injection,gen_fcmd=gen_fcmd_L1A,gen_interval=gen_interval_value, daq_push_fcmd=75, machine_gun=machine_gun_val, verbose=False):
-                    logger.warning("Failed to set generator parameters")
-
-                all_chn_value_0_array, all_chn_value_1_array, all_chn_value_2_array = measure_v0v1v2_raw(socket_udp, h2gcroc_ip, h2gcroc_port, fpga_address, _top_content_runLR, _top_content_offLR, expected_event_num, 5, logger)
-
-                for _chn_index, _chn in enumerate(target_chns):
-                    if _chn in dead_channels or _chn in not_used_channels:
-                        continue
-                    _val0_list = []
-                    for _event in range(expected_event_num):
-                        _val0_list.append(all_chn_value_0_array[_event][_chn])
-                    chns_val0_list[_chn_index].append(_val0_list)
-                    chns_phase_list[_chn_index].append(_phase)
-                    chns_pre_interval_list[_chn_index].append(_gen_pre_interval)
+
+    # * --- Declare the phase scan -----------------------------------------
+    def configure_gen_pre_interval(_point):
+        time.sleep(0.1)
+        if not packetlib.send_check_DAQ_gen_params(socket_udp, h2gcroc_ip, h2gcroc_port, 0x00, fpga_addr=fpga_address, data_coll_en=0x03,trig_coll_en=0x00, daq_fcmd=75, gen_preimp_en=1, gen_pre_interval= _point['gen_pre_interval'], gen_nr_of_cycle=gen_nr_cycle,gen_pre_fcmd=gen_fcmd_internal_injection,gen_fcmd=gen_fcmd_L1A,gen_interval=gen_interval_value, daq_push_fcmd=75, machine_gun=machine_gun_val, verbose=False):
+            logger.warning("Failed to set generator parameters")
+
+    def top_phase_mapping(_point, _top_content_runLR, _top_content_offLR):
+        _top_content_runLR[7] = _point['phase']
+        _top_content_offLR[7] = _point['phase']
+        return _top_content_runLR, _top_content_offLR
+
+    def reduce_target_chns(_point, _measurement):
+        if not _measurement['good']:
+            logger.warning(f"Measurement at phase {_point['phase']}, pre-interval {_point['gen_pre_interval']} is not good")
+        return {'chns_val0': [_measurement['val0'][:expected_event_num, _chn].tolist() for _chn in target_chns]}
+
+    phase_scan = packetlib.ScanDefinition(
+        parameter_grid={'phase': phase_scan_range, 'gen_pre_interval': gen_pre_interval_scan_range, 'retry': range(3)},
+        configure=configure_gen_pre_interval,
+        acquire=packetlib.generator_acquisition(socket_udp, h2gcroc_ip, h2gcroc_port, fpga_address, top_reg_runLR, top_reg_offLR, expected_event_num, top_mapping=top_phase_mapping, fragment_life=5),
+        reduce=reduce_target_chns,
+        is_good=lambda _point, _measurement: _measurement['good'])
+
+    scan_executor = packetlib.ScanExecutor(socket_udp, h2gcroc_ip, h2gcroc_port, fpga_address)
+    scan_results = scan_executor.run(phase_scan, journal=scan_journal, progress=lambda _points, total: tqdm(_points, total=total, desc="Phase scan", leave=True))
+
+    scan_timing = scan_executor.timing_summary()
+    for _stage in packetlib.scan_stage_names:
+        logger.info(f"Scan stage {_stage}: total {scan_timing[_stage]['total']:.2f} s, mean {scan_timing[_stage]['mean']*1000:.1f} ms over {scan_timing[_stage]['count']} points")
+    logger.info(f"Scan wall time: {scan_timing['wall']:.2f} s")
+    if len(scan_executor.failed_points) > 0:
+        logger.warning(f"{len(scan_executor.failed_points)} scan points are not good and were not journaled, resume the scan to measure them again")
+
+    for _point, _result in scan_results:
+        for _chn_index, _chn in enumerate(target_chns):
+            if _chn in dead_channels or _chn in not_used_channels:
+                continue
+            chns_val0_list[_chn_index].append(_result['chns_val0'][_chn_index])
+            chns_phase_list[_chn_index].append(_point['phase'])
+            chns_pre_interval_list[_chn_index].append(_point['gen_pre_interval'])
 
 finally:
+    scan_journal.close()
     socket_udp.close()
     logger.info("Socket closed")
 
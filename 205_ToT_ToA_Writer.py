@@ -1,3 +1,4 @@
+import packetlib
 import json
 import time
 import os
@@ -74,6 +75,9 @@ with open(json_name_A, 'w') as f:
 with open(json_name_B, 'w') as f:
     json.dump(json_content_B, f, indent=4)
 
+packetlib.register_calib_file(json_name_A, packetlib.calib_type_tottoa, BoardA_H2G_IP)
+packetlib.register_calib_file(json_name_B, packetlib.calib_type_tottoa, BoardB_H2G_IP)
+
 print(f"Json files are saved as {json_name_A} and {json_name_B}")
 
 
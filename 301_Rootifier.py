@@ -1 +1,79 @@
-import ROOT 
+import packetlib
+import time
+import os
+import logging
+import colorlog
+import argparse
+from tqdm import tqdm
+
+# * --- Set up script information -------------------------------------
+script_id_str       = '301_Rootifier'
+script_version_str  = '0.1'
+
+# * --- Set up logging ------------------------------------------------
+class TqdmColorLoggingHandler(colorlog.StreamHandler):
+    def __init__(self):
+        super().__init__()
+
+    def emit(self, record):
+        try:
+            msg = self.format(record)
+            tqdm.write(msg)
+            self.flush()
+        except Exception:
+            self.handleError(record)
+
+# Configure the custom logging handler with colored output
+handler = TqdmColorLoggingHandler()
+formatter = colorlog.ColoredFormatter(
+    '%(log_color)s%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%H:%M:%S',  # Customizes the date format to show only time
+    log_colors={
+        'DEBUG': 'cyan',
+        'INFO': 'green',
+        'WARNING': 'yellow',
+        'ERROR': 'red',
+        'CRITICAL': 'red,bg_white',
+    }
+)
+handler.setFormatter(formatter)
+
+logger = logging.getLogger('example_logger')
+logger.setLevel(logging.DEBUG)
+logger.addHandler(handler)
+
+# * --- Set up argument parser -----------------------------------------
+parser = argparse.ArgumentParser(description='Convert a run file to a flat ROOT TTree')
+parser.add_argument('-i', '--input', type=str, help='Input file name')
+parser.add_argument('-o', '--output', type=str, help='Output .root file name')
+parser.add_argument('-t', '--tree', type=str, default='h2gcroc', help='Name of the TTree')
+parser.add_argument('-b', '--batch', type=int, default=65536, help='Number of events decoded and written per basket')
+
+args = parser.parse_args()
+
+if args.input is None:
+    logger.error('No input file specified')
+    exit()
+
+# * --- Check the input file ------------------------------------------
+input_file_name = args.input
+input_file_folder = 'data'
+input_file_path = os.path.join(input_file_folder, input_file_name)
+
+if not os.path.exists(input_file_path):
+    logger.error(f'Input file {input_file_path} does not exist')
+    exit()
+
+if args.output is not None:
+    output_file_path = os.path.join(input_file_folder, args.output)
+else:
+    output_file_path = os.path.join(input_file_folder, os.path.splitext(input_file_name)[0] + '.root')
+
+# * --- Convert the run ------------------------------------------------
+logger.info(f'Converting {input_file_path} to {output_file_path}:{args.tree}')
+start_time = time.time()
+progress_bar = tqdm(desc='Events', unit=' events')
+event_num = packetlib.rootify_run_file(input_file_path, output_file_path, tree_name=args.tree, batch_size=args.batch, progress=progress_bar.update)
+progress_bar.close()
+
+logger.info(f'{event_num} events written in {time.time() - start_time:.1f} s')
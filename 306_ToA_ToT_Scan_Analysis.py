@@ -100,10 +100,9 @@ for _file_index in progress_bar:
         hamming_code_array = np.zeros((expected_event_num, 12))
 
         machinegun_sample_index_array = np.zeros((expected_event_num, 1))
+        event_timestamp_array = np.zeros(expected_event_num, dtype=np.int64)
 
         _line = 0
-        _last_timestamp = 0
-        sample_index = 0
 
         while _line < lines_count - 4:
             _line_bytearrays = []
@@ -111,15 +110,6 @@ for _file_index in progress_bar:
                 # each line the bytes are separated by space
                 _line_bytearrays.append(bytearray.fromhex(lines[_line+_line_offset].strip()))
             
-            _timestamp = _line_bytearrays[0][4] << 24 | _line_bytearrays[0][5] << 16 | _line_bytearrays[0][6] << 8 | _line_bytearrays[0][7]
-            _timestamp_offset = _timestamp - _last_timestamp
-            _last_timestamp = _timestamp
-
-            if (abs(_timestamp_offset) > 100):
-                sample_index = 0
-            elif (_timestamp_offset > 5):
-                sample_index += 1
-            
             event_fragment_pool.append(_line_bytearrays)
             _line += 5
             indices_to_delete = set()
@@ -145,8 +135,7 @@ for _file_index in progress_bar:
                         hamming_code_array[current_event_num][_half*3+2] =  packetlib.DaqH_get_H3(extracted_values["_DaqH"])
                     indices_to_delete.update([i, i+1, i+2, i+3])
                     
-                    machinegun_sample_index_array[current_event_num] = sample_index
-                    # print("current sample num:" + str(sample_index))
+                    event_timestamp_array[current_event_num] = timestamp0
                     current_event_num += 1
                     i += 4
                 else:
@@ -157,64 +146,20 @@ for _file_index in progress_bar:
             if current_event_num == expected_event_num:
                 break;
 
-        _one_scan_data_val0 = []
-        _one_scan_data_val1 = []
-        _one_scan_data_val2 = []
-        for _chn in range(152):
-            _chn_values_val0 = []
-            _chn_values_val1 = []
-            _chn_values_val2 = []
-            for _event in range(current_event_num):
-                _chn_values_val0.append(all_chn_value_0_array[_event][_chn])
-                tot_val = all_chn_value_1_array[_event][_chn]
-                if int(tot_val) >> 9 == 1:
-                    tot_val = tot_val * 8
-                _chn_values_val1.append(tot_val)
-                _chn_values_val2.append(all_chn_value_2_array[_event][_chn])
-            _one_scan_data_val0.append(_chn_values_val0)
-            _one_scan_data_val1.append(_chn_values_val1)
-            _one_scan_data_val2.append(_chn_values_val2)
-
-        
-        # print("channels:" + str(len(_one_scan_data)))
-        all_chn_scan_data_val0_matrix.append(_one_scan_data_val0)
-        all_chn_scan_data_val1_matrix.append(_one_scan_data_val1)
-        all_chn_scan_data_val2_matrix.append(_one_scan_data_val2)
+        all_chn_scan_data_val0_matrix.append(all_chn_value_0_array[:current_event_num])
+        all_chn_scan_data_val1_matrix.append(packetlib.expand_tot(all_chn_value_1_array[:current_event_num]))
+        all_chn_scan_data_val2_matrix.append(all_chn_value_2_array[:current_event_num])
+        machinegun_sample_index_array[:current_event_num, 0] = packetlib.machine_gun_samples(event_timestamp_array[:current_event_num])[0]
         all_chn_sample_index_matrix.append(machinegun_sample_index_array)
 
 if not os.path.exists(output_pics_folder_name):
     os.makedirs(output_pics_folder_name) 
 
-progress_bar_saving = tqdm(range(152))
-for _chn in progress_bar_saving:
-    progress_bar_saving.set_description(f'Saving channel {_chn+1}/152')
-    figure_path = "Chn" + str(_chn) + '.png'
-    _chn_val_x_val0s = []
-    _chn_val_y_val0s = []
-    _chn_val_x_val1s = []
-    _chn_val_y_val1s = []
-    _chn_val_x_val2s = []
-    _chn_val_y_val2s = []
-
-    _scan = 0
-    for _index in range(len(input_data_files)):
-        _internal_12b_val = input_data_internal_12b_values[_index]
-        for _event in range(len(all_chn_scan_data_val0_matrix[_scan][_chn])):
-            # _chn_val_x_vals.append(_delay + int(machine_gun_offset * all_chn_sample_index_matrix[_scan][_event]))
-            _chn_val_x_val0s.append(_internal_12b_val)
-            _chn_val_y_val0s.append(all_chn_scan_data_val0_matrix[_scan][_chn][_event])
-            _chn_val_x_val1s.append(_internal_12b_val)
-            _chn_val_y_val1s.append(all_chn_scan_data_val1_matrix[_scan][_chn][_event])
-            _chn_val_x_val2s.append(_internal_12b_val)
-            _chn_val_y_val2s.append(all_chn_scan_data_val2_matrix[_scan][_chn][_event])
-        _scan += 1
-
-    figure_path = os.path.join(output_pics_folder_name, figure_path)
-    fig_chn, ax_chn = plt.subplots(dpi=300)
-    # ax_chn.hist2d(_chn_val_x_val0s, _chn_val_y_val0s, bins=(np.linspace(min_threshold,max_threshold,len(input_data_files)), np.linspace(0,1024,512)), norm=mpl.colors.LogNorm())
-    ax_chn.hist2d(_chn_val_x_val1s, _chn_val_y_val1s, bins=(np.linspace(min_threshold,max_threshold,len(input_data_files)), np.linspace(0,4096, 512)), norm=mpl.colors.LogNorm())
-    # ax_chn.hist2d(_chn_val_x_val2s, _chn_val_y_val2s, bins=(np.linspace(min_threshold,max_threshold,len(input_data_files)), np.linspace(0,1024,512)), norm=mpl.colors.LogNorm())
-    ax_chn.set_xlabel('Internal 12b DAC Value')
-    ax_chn.set_ylabel('Values')
-    plt.savefig(figure_path)
-    plt.close()
+# * --- Render the channel figures ---------------------------------------
+scan_x_values = input_data_internal_12b_values
+hist2d_x_edges = np.linspace(min_threshold,max_threshold,len(input_data_files))
+
+# all_chn_hist2d_counts = packetlib.channel_scan_histograms(scan_x_values, all_chn_scan_data_val0_matrix, hist2d_x_edges, np.linspace(0,1024,512))
+all_chn_hist2d_counts = packetlib.channel_scan_histograms(scan_x_values, all_chn_scan_data_val1_matrix, hist2d_x_edges, np.linspace(0,4096, 512))
+# all_chn_hist2d_counts = packetlib.channel_scan_histograms(scan_x_values, all_chn_scan_data_val2_matrix, hist2d_x_edges, np.linspace(0,1024,512))
+packetlib.render_channel_gallery(all_chn_hist2d_counts, hist2d_x_edges, np.linspace(0,4096, 512), output_pics_folder_name, xlabel='Internal 12b DAC Value', ylabel='Values', log_scale=True, progress=lambda _results, total: tqdm(_results, total=total, desc='Saving channels'))
@@ -116,9 +116,13 @@ locked_output       = 0xaccccccc
 sublist_min_len     = 20
 sublist_extend      = 8
 inter_step_sleep    = 0.05 # seconds
+coarse_step         = 16
+line_sweep_step     = 2
 
 enable_sublist          = True
 enable_reset            = True
+enable_fast_search      = True # coarse sweep + edge bisection, both ASICs per step
+enable_per_line_delay   = True # independent delay for each line, found by the fast search when it is enabled
 
 i2c_setting_verbose     = False
 bitslip_verbose         = False
@@ -132,37 +136,18 @@ output_config_json['running_parameters'] = {
     'sublist_min_len': sublist_min_len,
     'sublist_extend': sublist_extend,
     'inter_step_sleep': inter_step_sleep,
+    'coarse_step': coarse_step,
+    'line_sweep_step': line_sweep_step,
     'enable_sublist': enable_sublist,
     'enable_reset': enable_reset,
+    'enable_fast_search': enable_fast_search,
+    'enable_per_line_delay': enable_per_line_delay,
     'i2c_setting_verbose': i2c_setting_verbose,
     'bitslip_verbose': bitslip_verbose,
     'bitslip_debug_verbose': bitslip_debug_verbose
 }
 
 # * --- Useful functions ----------------------------------------------
-def find_true_sublists(bool_list):
-    results = []
-    start_index = None
-    in_sequence = False
-
-    for index, value in enumerate(bool_list):
-        if value:
-            if not in_sequence:
-                # Starting a new sequence
-                start_index = index
-                in_sequence = True
-        else:
-            if in_sequence:
-                # Ending a sequence
-                results.append((start_index, index - start_index))
-                in_sequence = False
-
-    # Check if the last sequence extends to the end of the list
-    if in_sequence:
-        results.append((start_index, len(bool_list) - start_index))
-
-    return results
-
 def test_delay(delay_val, num_asic, verbose=False):
     if not packetlib.set_bitslip(socket_udp, h2gcroc_ip, h2gcroc_port, fpga_addr=fpga_address, asic_num=num_asic, io_dly_sel=asic_select, a0_io_dly_val_fclk=0x000, a0_io_dly_val_fcmd=0x400, a1_io_dly_val_fclk=0x000, a1_io_dly_val_fcmd=0x400, a0_io_dly_val_tr0=delay_val, a0_io_dly_val_tr1=delay_val, a0_io_dly_val_tr2=delay_val, a0_io_dly_val_tr3=delay_val, a0_io_dly_val_dq0=delay_val, a0_io_dly_val_dq1=delay_val, a1_io_dly_val_tr0=delay_val, a1_io_dly_val_tr1=delay_val, a1_io_dly_val_tr2=delay_val, a1_io_dly_val_tr3=delay_val, a1_io_dly_val_dq0=delay_val, a1_io_dly_val_dq1=delay_val, verbose=bitslip_verbose):
         print('\033[33m' + "Warning in setting bitslip 0" + '\033[0m')
@@ -281,103 +266,193 @@ try:
                 exit()
     
     best_values = []
-    for _asic in range(total_asic):
-        locked_flag_array  = []
-        locked_delay_array = []
-        logger.info(f"Setting bitslip for ASIC {_asic}")
-        progress_bar_local = tqdm(range(0, 512, 2))
-        for _delay in progress_bar_local:
-            if _delay == 320: # Skip 320 because it is cursed
+    if enable_per_line_delay:
+        def probe_lines(delay_vals):
+            return packetlib.probe_iodelay(socket_udp, h2gcroc_ip, h2gcroc_port, fpga_address, delay_vals, locked_output, asic_select=asic_select, settle_time=inter_step_sleep, verbose=bitslip_verbose)
+
+        if enable_fast_search:
+            logger.info("Searching for best IO delay of every line of all ASICs")
+            line_centers, line_widths, lock_bitmap, sweep_delays, probe_count = packetlib.fast_line_delay_search(probe_lines, asic_list=range(total_asic), coarse_step=coarse_step)
+            logger.info(f"IO delay search finished after {probe_count} steps")
+        else:
+            logger.info("Sweeping IO delay for all lines of all ASICs")
+            sweep_delays = [_delay for _delay in range(0, 512, line_sweep_step) if _delay != 320] # Skip 320 because it is cursed
+            lock_bitmap = packetlib.iodelay_line_sweep(probe_lines, tqdm(sweep_delays))
+            line_centers, line_widths = packetlib.find_line_delay_centers(lock_bitmap, sweep_delays)
+        # the lock bitmap is the coarse sweep when the fast search is used
+        np.save(os.path.join(output_dump_folder, 'iodelay_lock_bitmap.npy'), lock_bitmap)
+        np.save(os.path.join(output_dump_folder, 'iodelay_lock_delays.npy'), np.array(sweep_delays))
+
+        _line_delays = []
+        _common_windows = []
+        for _asic in range(2):
+            # window where all lines are locked, used for lines without their own window
+            _common_window = packetlib.find_delay_window_center(lock_bitmap[:, _asic, :].all(axis=1), sweep_delays)
+            _common_windows.append(_common_window)
+            _asic_line_delays = []
+            for _line, _line_label in enumerate(packetlib.iodelay_line_labels):
+                if line_centers[_asic, _line] < 0:
+                    if _asic < total_asic:
+                        logger.error(f"No valid IO delay found for ASIC {_asic} line {_line_label}")
+                    _asic_line_delays.append(int(_common_window[0]) if _common_window is not None else 0)
+                    continue
+                if line_widths[_asic, _line] < sublist_min_len:
+                    logger.warning(f"Narrow IO delay window for ASIC {_asic} line {_line_label}: {line_widths[_asic, _line]}")
+                _asic_line_delays.append(int(line_centers[_asic, _line]))
+            _line_delays.append(_asic_line_delays)
+
+        # program every line with its own center and check the lock once more
+        best_line_values = []
+        _line_locked = probe_lines(_line_delays)
+        for _asic in range(total_asic):
+            if not all(_line_locked[_asic]):
+                logger.error(f"Best per-line IO delays for ASIC {_asic} are not locked")
+                best_line_values.append(None)
+                best_values.append(None)
                 continue
-            progress_bar_local.set_description(f"Delay " + "{:03}".format(_delay))
-            locked_flag_array.append(test_delay(_delay, _asic, verbose=False))
-            locked_delay_array.append(_delay)
-        valid_sublists = []
-        try:
-            valid_sublists = find_true_sublists(locked_flag_array)
-        except:
-            logger.error('No valid IO delay found for ASIC ' + str(_asic))
-            continue
-        if len(valid_sublists) == 0:
-            logger.error('No valid IO delay found for ASIC ' + str(_asic))
-            continue
-
-        sorted_sublists = sorted(valid_sublists, key=lambda x: x[1], reverse=True)
-        _valid_sublist_found = False
-        _best_delay = 0
-        logger.info(f"Searching for best IO delay for ASIC {_asic}")
-        for _sublist_index in range(len(sorted_sublists)):
-            _sublist = sorted_sublists[_sublist_index]
-            # logger.info(f"Sublist start index: {_sublist[0]}, length: {_sublist[1]}")
-            if len(_sublist) != 2:
-                logger.warning(f"Abnormal sublist data format for ASIC {_asic}")
-                break
-            _start_index = _sublist[0]
-            _sublist_len = _sublist[1]
-            if _sublist_len < sublist_min_len:
-                _best_delay = _start_index + _sublist_len // 2
-                _valid_sublist_found = True
-                logger.warning('No best IO delay found for ASIC ' + str(_asic)+ ' using coarse delay ' + str(_best_delay))
-                break
-            if not enable_sublist:
-                _best_delay = _start_index + _sublist_len // 2
-                _valid_sublist_found = True
-                break
+            logger.info(f"Best IO delays for ASIC {_asic}: " + ", ".join(f"{_label} {_delay}" for _label, _delay in zip(packetlib.iodelay_line_labels, _line_delays[_asic])))
+            best_line_values.append(_line_delays[_asic])
+            # best_values keeps one delay per ASIC, the center of the window where all lines lock
+            if _common_windows[_asic] is not None:
+                best_values.append(int(_common_windows[_asic][0]))
             else:
-                _subscan_start = max(0, _start_index - sublist_extend)
-                _subscan_end = min(511, _start_index + _sublist_len + sublist_extend)
-
-            valid_subsublists = []
-            locked_flag_sublist = []
-            locked_delay_sublist = []
-            progress_bar_sublocal = tqdm(range(_subscan_start, _subscan_end, 1))
-            for _subdelay in progress_bar_sublocal:
-                if _subdelay == 320:
-                    continue
-                progress_bar_sublocal.set_description(f"Delay " + "{:03}".format(_subdelay))
-                locked_flag_sublist.append(test_delay(_subdelay, _asic, verbose=False))
-                locked_delay_sublist.append(_subdelay)
-            try:
-                valid_subsublists = find_true_sublists(locked_flag_sublist)
-            except:
+                best_values.append(int(np.median(_line_delays[_asic])))
+        output_config_json['best_line_values'] = best_line_values
+        output_config_json['line_window_widths'] = line_widths.tolist()
+    elif enable_fast_search:
+        def probe_all_locked(delay_vals):
+            _lock_status = packetlib.probe_iodelay(socket_udp, h2gcroc_ip, h2gcroc_port, fpga_address, delay_vals, locked_output, asic_select=asic_select, settle_time=inter_step_sleep, verbose=bitslip_verbose)
+            return [all(_line_locked) for _line_locked in _lock_status]
+
+        logger.info("Searching for best IO delay for all ASICs")
+        search_results, probe_count = packetlib.fast_iodelay_search(probe_all_locked, asic_list=range(total_asic), coarse_step=coarse_step, min_window=sublist_min_len)
+        logger.info(f"IO delay search finished after {probe_count} steps")
+
+        _best_delays = [0] * 2
+        for _asic in range(total_asic):
+            if search_results[_asic] is None:
+                logger.error('No valid IO delay found for ASIC ' + str(_asic))
                 continue
-                # _best_delay = _start_index + _sublist_len // 2
-                # _valid_sublist_found = True
-                # logger.warning('No best IO delay found for ASIC ' + str(_asic)+ ' using coarse delay ' + str(_best_delay) + ' (E1)')
-                # break
-            if len(valid_subsublists) == 0:
+            _best_delays[_asic] = search_results[_asic]["best_delay"]
+            _window = search_results[_asic]["window"]
+            if search_results[_asic]["window_len"] < sublist_min_len:
+                logger.warning(f"Narrow IO delay window for ASIC {_asic}: {_window[0]} - {_window[1]}")
+            else:
+                logger.info(f"IO delay window for ASIC {_asic}: {_window[0]} - {_window[1]}")
+        # program both ASICs with their best values and check the lock once more
+        _best_locked = probe_all_locked(_best_delays)
+        for _asic in range(total_asic):
+            if search_results[_asic] is None:
+                best_values.append(None)
+                continue
+            if not _best_locked[_asic]:
+                logger.error(f"Best IO delay candidate for ASIC {_asic} is not locked")
+                best_values.append(None)
                 continue
-                # _best_delay = _start_index + _sublist_len // 2
-                # _valid_sublist_found = True
-                # logger.warning('No best IO delay found for ASIC ' + str(_asic)+ ' using coarse delay ' + str(_best_delay) + ' (E2)')
-                # break
-            sorted_subsublists = sorted(valid_subsublists, key=lambda x: x[1], reverse=True)
-            # logger.info(sorted_subsublists)
+            logger.info(f"Best IO delay for ASIC {_asic}: {_best_delays[_asic]}")
+            best_values.append(_best_delays[_asic])
+    else:
+        for _asic in range(total_asic):
+            locked_flag_array  = []
+            locked_delay_array = []
+            logger.info(f"Setting bitslip for ASIC {_asic}")
+            progress_bar_local = tqdm(range(0, 512, 2))
+            for _delay in progress_bar_local:
+                if _delay == 320: # Skip 320 because it is cursed
+                    continue
+                progress_bar_local.set_description(f"Delay " + "{:03}".format(_delay))
+                locked_flag_array.append(test_delay(_delay, _asic, verbose=False))
+                locked_delay_array.append(_delay)
+            valid_sublists = []
             try:
-                best_sublist = sorted_subsublists[0]
+                valid_sublists = packetlib.find_true_sublists(locked_flag_array)
             except:
+                logger.error('No valid IO delay found for ASIC ' + str(_asic))
+                best_values.append(None)
                 continue
-            if best_sublist[1] > sublist_min_len:
-                _best_delay = best_sublist[0] + best_sublist[1] // 2 + _subscan_start
-                _valid_sublist_found = True
-                break
-            else:
-                if _sublist_index == len(sorted_sublists) - 1:
+            if len(valid_sublists) == 0:
+                logger.error('No valid IO delay found for ASIC ' + str(_asic))
+                best_values.append(None)
+                continue
+
+            sorted_sublists = sorted(valid_sublists, key=lambda x: x[1], reverse=True)
+            _valid_sublist_found = False
+            _best_delay = 0
+            logger.info(f"Searching for best IO delay for ASIC {_asic}")
+            for _sublist_index in range(len(sorted_sublists)):
+                _sublist = sorted_sublists[_sublist_index]
+                # logger.info(f"Sublist start index: {_sublist[0]}, length: {_sublist[1]}")
+                if len(_sublist) != 2:
+                    logger.warning(f"Abnormal sublist data format for ASIC {_asic}")
+                    break
+                _start_index = _sublist[0]
+                _sublist_len = _sublist[1]
+                if _sublist_len < sublist_min_len:
+                    _best_delay = _start_index + _sublist_len // 2
+                    _valid_sublist_found = True
+                    logger.warning('No best IO delay found for ASIC ' + str(_asic)+ ' using coarse delay ' + str(_best_delay))
+                    break
+                if not enable_sublist:
                     _best_delay = _start_index + _sublist_len // 2
                     _valid_sublist_found = True
-                    logger.warning('No best IO delay found for ASIC ' + str(_asic)+ ' using coarse delay ' + str(_best_delay) + ' (E4)')
                     break
                 else:
+                    _subscan_start = max(0, _start_index - sublist_extend)
+                    _subscan_end = min(511, _start_index + _sublist_len + sublist_extend)
+
+                valid_subsublists = []
+                locked_flag_sublist = []
+                locked_delay_sublist = []
+                progress_bar_sublocal = tqdm(range(_subscan_start, _subscan_end, 1))
+                for _subdelay in progress_bar_sublocal:
+                    if _subdelay == 320:
+                        continue
+                    progress_bar_sublocal.set_description(f"Delay " + "{:03}".format(_subdelay))
+                    locked_flag_sublist.append(test_delay(_subdelay, _asic, verbose=False))
+                    locked_delay_sublist.append(_subdelay)
+                try:
+                    valid_subsublists = packetlib.find_true_sublists(locked_flag_sublist)
+                except:
                     continue
-        if not _valid_sublist_found:
-            logger.error('No valid IO delay found for ASIC ' + str(_asic))
-            continue
-        if not test_delay(_best_delay, _asic, verbose=False):
-            logger.error(f"Best IO delay candidate for ASIC {_asic} is not locked")
-            continue
-        else:
-            logger.info(f"Best IO delay for ASIC {_asic}: {_best_delay}")
-            best_values.append(_best_delay)
+                    # _best_delay = _start_index + _sublist_len // 2
+                    # _valid_sublist_found = True
+                    # logger.warning('No best IO delay found for ASIC ' + str(_asic)+ ' using coarse delay ' + str(_best_delay) + ' (E1)')
+                    # break
+                if len(valid_subsublists) == 0:
+                    continue
+                    # _best_delay = _start_index + _sublist_len // 2
+                    # _valid_sublist_found = True
+                    # logger.warning('No best IO delay found for ASIC ' + str(_asic)+ ' using coarse delay ' + str(_best_delay) + ' (E2)')
+                    # break
+                sorted_subsublists = sorted(valid_subsublists, key=lambda x: x[1], reverse=True)
+                # logger.info(sorted_subsublists)
+                try:
+                    best_sublist = sorted_subsublists[0]
+                except:
+                    continue
+                if best_sublist[1] > sublist_min_len:
+                    _best_delay = best_sublist[0] + best_sublist[1] // 2 + _subscan_start
+                    _valid_sublist_found = True
+                    break
+                else:
+                    if _sublist_index == len(sorted_sublists) - 1:
+                        _best_delay = _start_index + _sublist_len // 2
+                        _valid_sublist_found = True
+                        logger.warning('No best IO delay found for ASIC ' + str(_asic)+ ' using coarse delay ' + str(_best_delay) + ' (E4)')
+                        break
+                    else:
+                        continue
+            if not _valid_sublist_found:
+                logger.error('No valid IO delay found for ASIC ' + str(_asic))
+                best_values.append(None)
+                continue
+            if not test_delay(_best_delay, _asic, verbose=False):
+                logger.error(f"Best IO delay candidate for ASIC {_asic} is not locked")
+                best_values.append(None)
+                continue
+            else:
+                logger.info(f"Best IO delay for ASIC {_asic}: {_best_delay}")
+                best_values.append(_best_delay)
 
 finally:
     socket_udp.close()
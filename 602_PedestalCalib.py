@@ -772,9 +772,11 @@ output_pedecalib_json["chn_inputdac_settings"]  = final_chn_inputdac_list
 output_pedecalib_json["dead_channels"]          = dead_channels
 output_pedecalib_json["channel_not_used"]       = channel_not_used
 output_pedecalib_json["pede_values"]            = _trim_chn_pede_list
+output_pedecalib_json["pede_noise"]             = _trim_chn_pede_err
 
 with open(output_pedecalib_path, 'w') as f:
     json.dump(output_pedecalib_json, f, indent=4)
+packetlib.register_calib_file(output_pedecalib_path, packetlib.calib_type_pedestal, output_pedecalib_json['udp']['h2gcroc_ip'])
 
 with open(output_config_path, 'w') as f:
     json.dump(output_config_json, f, indent=4)
\ No newline at end of file
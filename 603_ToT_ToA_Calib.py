@@ -18,137 +18,18 @@ script_version_str  = '0.1'
 
 # * --- Test function -------------------------------------------------
 
-def measure_v0v1v2(_socket_udp, _ip, _port, _fpga_address, _reg_runLR, _reg_offLR, _event_num, _fragment_life, _logger):
-    for _asic in range(2):
-        if not packetlib.send_check_i2c_wrapper(_socket_udp, _ip, _port, asic_num=_asic, fpga_addr = _fpga_address, sub_addr=packetlib.subblock_address_dict["Top"], reg_addr=0x00, data=_reg_runLR, retry=5, verbose=False):
-            _logger.warning(f"Failed to turn on LR for ASIC {_asic}")
-
-    packetlib.clean_socket(_socket_udp)
-
-    if not packetlib.send_daq_gen_start_stop(_socket_udp, _ip, _port, asic_num=0, fpga_addr = _fpga_address, daq_push=0x00, gen_start_stop=1, daq_start_stop=0xFF, verbose=False):
-        _logger.warning("Failed to start the generator")
-
-    extracted_payloads_pool = []
-    event_fragment_pool     = []
-    fragment_life_dict      = {}
-
-    current_half_packet_num = 0
-    current_event_num = 0
-
-    all_chn_value_0_array = np.zeros((_event_num, 152))
-    all_chn_value_1_array = np.zeros((_event_num, 152))
-    all_chn_value_2_array = np.zeros((_event_num, 152))
-    hamming_code_array    = np.zeros((_event_num, 12))
-
-    while True:
-        try:
-            data_packet, rec_addr    = _socket_udp.recvfrom(8192)
-            # _logger.debug("Packet received")
-            extracted_payloads_pool += packetlib.extract_raw_payloads(data_packet)
-            while len(extracted_payloads_pool) >= 5:
-                candidate_packet_lines = extracted_payloads_pool[:5]
-                is_packet_good, event_fragment = packetlib.check_event_fragment(candidate_packet_lines)
-                if is_packet_good:
-                    event_fragment_pool.append(event_fragment)
-                    current_half_packet_num += 1
-                    extracted_payloads_pool = extracted_payloads_pool[5:]
-                else:
-                    _logger.warning("Warning: Event fragment is not good")
-                    extracted_payloads_pool = extracted_payloads_pool[1:]
-            indices_to_delete = set()
-            if len(event_fragment_pool) >= 4:
-                event_fragment_pool = sorted(event_fragment_pool, key=lambda x: x[0][3:7])
-            i = 0
-            while i <= len(event_fragment_pool) - 4:
-                timestamp0 = event_fragment_pool[i][0][4] << 24 | event_fragment_pool[i][0][5] << 16 | event_fragment_pool[i][0][6] << 8 | event_fragment_pool[i][0][7]
-                timestamp1 = event_fragment_pool[i+1][0][4] << 24 | event_fragment_pool[i+1][0][5] << 16 | event_fragment_pool[i+1][0][6] << 8 | event_fragment_pool[i+1][0][7]
-                timestamp2 = event_fragment_pool[i+2][0][4] << 24 | event_fragment_pool[i+2][0][5] << 16 | event_fragment_pool[i+2][0][6] << 8 | event_fragment_pool[i+2][0][7]
-                timestamp3 = event_fragment_pool[i+3][0][4] << 24 | event_fragment_pool[i+3][0][5] << 16 | event_fragment_pool[i+3][0][6] << 8 | event_fragment_pool[i+3][0][7]
-                if timestamp0 == timestamp1 and timestamp0 == timestamp2 and timestamp0 == timestamp3:
-                    id_str = f"{timestamp0:08X}"
-                    for _half in range(4):
-                        extracted_data = packetlib.assemble_data_from_40bytes(event_fragment_pool[i+_half], verbose=False)
-                        extracted_values = packetlib.extract_values(extracted_data["_extraced_160_bytes"], verbose=False)
-                        uni_chn_base = (extracted_data["_header"] - 0xA0) * 76 + (extracted_data["_packet_type"] - 0x24) * 38
-                        for j in range(len(extracted_values["_extracted_values"])):
-                            all_chn_value_0_array[current_event_num][j+uni_chn_base] = extracted_values["_extracted_values"][j][1]
-                            all_chn_value_1_array[current_event_num][j+uni_chn_base] = extracted_values["_extracted_values"][j][2]
-                            all_chn_value_2_array[current_event_num][j+uni_chn_base] = extracted_values["_extracted_values"][j][3]
-                        hamming_code_array[current_event_num][_half*3+0] =  packetlib.DaqH_get_H1(extracted_values["_DaqH"])
-                        hamming_code_array[current_event_num][_half*3+1] =  packetlib.DaqH_get_H2(extracted_values["_DaqH"])
-                        hamming_code_array[current_event_num][_half*3+2] =  packetlib.DaqH_get_H3(extracted_values["_DaqH"])
-                    indices_to_delete.update([i, i+1, i+2, i+3])
-                    current_event_num += 1
-                    i += 4
-                else:
-                    if timestamp0 in fragment_life_dict:
-                        if fragment_life_dict[timestamp0] >= _fragment_life - 1:
-                            indices_to_delete.update([i])
-                            del fragment_life_dict[timestamp0]
-                        else:
-                            fragment_life_dict[timestamp0] += 1
-                    else:
-                        fragment_life_dict[timestamp0] = 1
-                    i += 1
-            for index in sorted(indices_to_delete, reverse=True):
-                del event_fragment_pool[index]
-            if current_event_num == _event_num:
-                break;      
-        except Exception as e:
-            _logger.warning("Exception in receiving data")
-            _logger.warning(e)
-            _logger.warning('Packet received: ' + str(current_half_packet_num))
-            _logger.warning('left fragments:' + str(len(event_fragment_pool)))
-            _logger.warning("current event num:" + str(current_event_num))
-            measurement_good_flag = False
-            break
-
-    if not np.all(hamming_code_array == 0):
-        _logger.warning("Hamming code error detected!")
-        measurement_good_flag = False
-    if not packetlib.send_daq_gen_start_stop(_socket_udp, _ip, _port, asic_num=0, fpga_addr = _fpga_address, daq_push=0x00, gen_start_stop=0, daq_start_stop=0x00, verbose=False):
-        _logger.warning("Failed to stop the generator")
-    for _asic in range(2):
-        if not packetlib.send_check_i2c_wrapper(_socket_udp, _ip, _port, asic_num=_asic, fpga_addr = _fpga_address, sub_addr=packetlib.subblock_address_dict["Top"], reg_addr=0x00, data=_reg_offLR, retry=5, verbose=False):
-            _logger.warning(f"Failed to turn off LR for ASIC {_asic}")
-    _val0_mean_list = []
-    _val0_err_list  = []
-    _val1_mean_list = []
-    _val1_err_list  = []
-    _val2_mean_list = []
-    _val2_err_list  = []
-
-    for _chn in range(152):
-        _candidate_v0_values = []
-        _candidate_v1_values = []
-        _candidate_v2_values = []
-        for _event in range(_event_num):
-            if np.all(hamming_code_array[_event] == 0):
-                _candidate_v0_values.append(all_chn_value_0_array[_event][_chn])
-                _candidate_v1_values.append(all_chn_value_1_array[_event][_chn])
-                _candidate_v2_values.append(all_chn_value_2_array[_event][_chn])
-        if len(_candidate_v0_values) > 0:
-            _val0_mean_list.append(np.max(_candidate_v0_values))
-            _val0_err_list.append(np.std(_candidate_v0_values))
-        else:
-            _logger.warning(f"Channel {_chn} has no valid v0")
-            _val0_mean_list.append(0)
-            _val0_err_list.append(0)
-        if len(_candidate_v1_values) > 0:
-            _val1_mean_list.append(np.max(_candidate_v1_values))
-            _val1_err_list.append(np.std(_candidate_v1_values))
-        else:
-            _logger.warning(f"Channel {_chn} has no valid v1")
-            _val1_mean_list.append(0)
-            _val1_err_list.append(0)
-        if len(_candidate_v2_values) > 0:
-            _val2_mean_list.append(np.max(_candidate_v2_values))
-            _val2_err_list.append(np.std(_candidate_v2_values))
-        else:
-            _logger.warning(f"Channel {_chn} has no valid v2")
-            _val2_mean_list.append(0)
-            _val2_err_list.append(0)
-    return _val0_mean_list, _val0_err_list, _val1_mean_list, _val1_err_list, _val2_mean_list, _val2_err_list
+def measure_v0v1v2(_socket_udp, _ip, _port, _fpga_address, _reg_runLR, _reg_offLR, _event_num, _fragment_life, _logger, _idle_timeout=None, _deadline=None):
+    _statistics = packetlib.ChannelStatistics()
+    _measurement = packetlib.measure_events(_socket_udp, _ip, _port, _fpga_address, _reg_runLR, _reg_offLR, _event_num, fragment_life=_fragment_life, statistics=_statistics, store_events=False, idle_timeout=_idle_timeout, deadline=_deadline)
+    if _measurement["event_num"] < _event_num:
+        _logger.warning(f"Only {_measurement['event_num']} of {_event_num} events received ({_measurement['shortfall']['reason']})")
+    if _measurement["hamming_error_num"] > 0:
+        _logger.warning(f"Hamming code error detected in {_measurement['hamming_error_num']} events!")
+    if _statistics.event_count == 0:
+        _logger.warning("No valid v0, v1 and v2 for any channel")
+        return [0] * 152, [0] * 152, [0] * 152, [0] * 152, [0] * 152, [0] * 152
+    # the peak of each value over the events, with the spread as error
+    return _statistics.max("val0").tolist(), _statistics.std("val0").tolist(), _statistics.max("val1").tolist(), _statistics.std("val1").tolist(), _statistics.max("val2").tolist(), _statistics.std("val2").tolist()
 
 # * --- Set up logging ------------------------------------------------
 class TqdmColorLoggingHandler(colorlog.StreamHandler):
@@ -285,23 +166,11 @@ output_config_json["i2c"]["top_reg_offLR"] = top_reg_offLR
 # * ---------------------------------------------------------------------------
 pedestal_calib_file_prefix = "pede_calib_config"
 pedestal_calib_folder = "dump"
-pedestal_calib_files = [f for f in os.listdir(pedestal_calib_folder) if f.startswith(pedestal_calib_file_prefix)]
-pedestal_calib_files.sort(reverse=True)
-
-newest_pedestal_calib_file_found = False
-if len(pedestal_calib_files) > 0:
-    for _file in pedestal_calib_files:
-        logger.info(f"Found pedestal calibration file: {_file}")
-        newest_pedestal_calib_file = _file
-        with open(os.path.join(pedestal_calib_folder, newest_pedestal_calib_file), 'r') as json_file:
-            pedestal_calib = json.load(json_file)
-            if pedestal_calib['udp']['h2gcroc_ip'] == h2gcroc_ip:
-                newest_pedestal_calib_file_found = True
-                break
-
-if not newest_pedestal_calib_file_found:
+newest_pedestal_calib_path = packetlib.find_latest_calib_file(packetlib.calib_type_pedestal, h2gcroc_ip, pedestal_calib_folder, pedestal_calib_file_prefix)
+if newest_pedestal_calib_path is None:
     logger.critical("No pedestal calibration file found for the current H2GCROC IP")
     exit()
+newest_pedestal_calib_file = os.path.basename(newest_pedestal_calib_path)
 
 logger.info(f"Found newest pedestal calibration file: {newest_pedestal_calib_file}")
 
@@ -451,6 +320,8 @@ chn_trim_tot_scan_range = range(0, 64, 2)
 # toa_trim_scan_range = range(0, 64, 1)
 
 expected_event_num = gen_nr_cycle*(1+machine_gun_val)
+# a lost half-packet ends the measurement with a shortfall instead of a socket error
+measurement_idle_timeout, measurement_deadline = packetlib.generator_timeouts(gen_nr_cycle, gen_interval_value, machine_gun_val)
 
 if gen_nr_cycle*(1+machine_gun_val)*4 > 300:
     logger.warning("Too much packet requested")
@@ -574,7 +445,7 @@ try:
                     if not packetlib.send_check_i2c_wrapper(socket_udp, h2gcroc_ip, h2gcroc_port, asic_num=_asic_num, fpga_addr = fpga_address, sub_addr=_sub_addr, reg_addr=0x00, data=_chn_wise, retry=5, verbose=False):
                         logger.warning(f"Failed to set Channel Wise settings for {_chn}")
 
-            val0_mean_list, val0_err_list, val1_mean_list, val1_err_list, val2_mean_list, val2_err_list = measure_v0v1v2(socket_udp, h2gcroc_ip, h2gcroc_port, fpga_address, top_content_runLR, top_content_offLR, expected_event_num, 5, logger)
+            val0_mean_list, val0_err_list, val1_mean_list, val1_err_list, val2_mean_list, val2_err_list = measure_v0v1v2(socket_udp, h2gcroc_ip, h2gcroc_port, fpga_address, top_content_runLR, top_content_offLR, expected_event_num, 5, logger, measurement_idle_timeout, measurement_deadline)
             # logger.debug(f"Scan value: {val0_mean_list}")
 
             for _chn_index, _chn in enumerate(_target_chn_pack):
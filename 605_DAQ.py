@@ -56,10 +56,24 @@ parser.add_argument('-c', '--config', type=str, help='Configuration file name')
 parser.add_argument('-n', '--num', type=int, help='Number of events to acquire', default=100)
 parser.add_argument('-a', '--A', action='store_true', help='Acquire data from board A')
 parser.add_argument('-b', '--B', action='store_true', help='Acquire data from board B')
+parser.add_argument('-e', '--build', action='store_true', help='Build events online and write only complete events of all boards')
+parser.add_argument('-t', '--tolerance', type=int, default=0, help='Timestamp tolerance between boards for the online event building')
+parser.add_argument('-z', '--zero_suppress', type=float, nargs='?', const=5.0, help='Write zero-suppressed sparse events, keeping channels above this many pedestal noise sigma (default 5) or with ToT/ToA; implies -e')
+parser.add_argument('-C', '--compress', type=str, nargs='?', const=packetlib.default_compression_codec(), choices=packetlib.available_compression_codecs(), help='Write a block-compressed output stream (default codec: zstd, lz4 or zlib, whichever is installed)')
+parser.add_argument('--rotate_mb', type=float, help='Start a new numbered segment file after this many MB, with a run manifest')
+parser.add_argument('--rotate_events', type=int, help='Start a new numbered segment file after this many written half-packets (events with -e), with a run manifest')
+parser.add_argument('--sync', type=str, choices=['block', 'close'], help='fsync the output after every written block or once at the end of the run')
+parser.add_argument('--fadvise', action='store_true', help='Drop the written output from the page cache after every block')
+parser.add_argument('--idle', type=float, help='Stop the acquisition after this many seconds without data (default: wait for data without limit)')
+parser.add_argument('--deadline', type=float, help='Stop the acquisition this many seconds after it started (default: no deadline)')
+parser.add_argument('-P', '--processes', action='store_true', help='Receive and decode every board in its own process, on SO_REUSEPORT sockets connected to the boards')
+parser.add_argument('-m', '--monitor', type=int, nargs='?', const=packetlib.monitor_default_port, help='Send sampled datagrams to the online monitor (610_OnlineMonitor) on this local port')
 
 args = parser.parse_args()
 
 event_num = args.num
+if args.zero_suppress is not None:
+    args.build = True
 if event_num <= 0:
     logger.critical(f"Invalid number of events: {event_num}")
     exit()
@@ -102,9 +116,17 @@ else:
     exit()
 
 socket_udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+if args.processes:
+    # the receiver processes bind the same port, connected to their board
+    socket_udp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 socket_udp.bind((pc_ip, pc_port))
 # socket_udp.settimeout(timeout)
 
+monitor_sender = None
+if args.monitor is not None:
+    monitor_sender = packetlib.MonitorSender(port=args.monitor)
+    logger.info(f"Sampled datagrams are sent to the online monitor on port {args.monitor}")
+
 # * --- Find the configuration file ------------------------------------
 config_file = args.config
 
@@ -131,7 +153,41 @@ top_reg_offLR = config_json['i2c']['top_reg_offLR']
 info_generator = config_json['generator']
 info_input = config_json['input']
 
+# the boards run on external triggers, so a quiet spill break is normal and the
+# run only stops after an idle time or at a deadline when one is given
+idle_timeout = args.idle
+acquisition_deadline = args.deadline
+if idle_timeout is not None:
+    logger.info(f"Idle timeout: {idle_timeout:.1f} s")
+if acquisition_deadline is not None:
+    logger.info(f"Deadline: {acquisition_deadline:.1f} s")
+
 output_file_name = os.path.join(output_folder, args.output)
+if args.compress is not None and not output_file_name.endswith('.h2gz'):
+    output_file_name += '.h2gz'
+
+# with rotation the output file name is the base of the numbered segments and the manifest
+rotating_output = args.rotate_mb is not None or args.rotate_events is not None
+if rotating_output:
+    output_base_name = output_file_name.split('.txt')[0]
+    output_file_name = packetlib.run_manifest_path(output_base_name)
+
+# * --- Load the pedestals for zero suppression -------------------------
+pedestal_calib_file_prefix = "pede_calib_config"
+pedestal_calib_folder = "dump"
+
+zero_suppressors = {}
+if args.zero_suppress is not None:
+    for _board, _used, _ip in ((0x00, args.A, h2gcroc_ip_A), (0x01, args.B, h2gcroc_ip_B)):
+        if not _used:
+            continue
+        _pede_file = packetlib.find_latest_calib_file(packetlib.calib_type_pedestal, _ip, pedestal_calib_folder, pedestal_calib_file_prefix)
+        if _pede_file is None:
+            logger.warning(f"No pedestal calibration file found for board {_board}, its events are written without suppression")
+            continue
+        logger.info(f"Using pedestal calibration file for board {_board}: {_pede_file}")
+        _pedestal, _noise, _dead = packetlib.load_pedestal_calib(_pede_file)
+        zero_suppressors[_board] = packetlib.ZeroSuppressor(_pedestal, _noise, threshold_sigma=args.zero_suppress, dead=_dead)
 
 # if the file already exists, ask for confirmation
 if os.path.exists(output_file_name):
@@ -141,7 +197,29 @@ if os.path.exists(output_file_name):
         logger.info("User cancelled the operation")
         exit()
 
-with open(output_file_name, 'w') as f:
+# compressed output is framed in independent blocks, compressed and written on a worker thread
+if rotating_output:
+    output_file = packetlib.SegmentedRunWriter(output_base_name, max_bytes=None if args.rotate_mb is None else int(args.rotate_mb * 1024 * 1024), max_records=args.rotate_events, codec=args.compress)
+elif args.compress is None:
+    output_file = open(output_file_name, 'w')
+else:
+    output_file = packetlib.CompressedBlockWriter(output_file_name, codec=args.compress)
+
+run_report = packetlib.RunReport(info={
+    "script_id": script_id_str,
+    "script_version": script_version_str,
+    "output_file": output_file_name,
+    "configuration_file": config_file,
+    "event_num": event_num,
+    "board_A": args.A,
+    "board_B": args.B,
+    "build": args.build,
+    "zero_suppress": args.zero_suppress,
+    "compress": args.compress,
+    "receive_buffer_bytes": socket_udp.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+})
+
+with output_file as f:
     # write info block
     f.write(f"#########################################################\n")
     f.write(f"# KCU-H2GCROC DAQ\n")
@@ -152,10 +230,21 @@ with open(output_file_name, 'w') as f:
     f.write(f"# Number of events: {event_num}\n")
     f.write(f"# Board A: {args.A}\n")
     f.write(f"# Board B: {args.B}\n")
+    if args.compress is not None:
+        f.write(f"# Compression: {args.compress}\n")
+    f.write(f"# Online event building: {args.build}\n")
+    if args.build:
+        f.write(f"# Timestamp tolerance: {args.tolerance}\n")
+    if args.zero_suppress is not None:
+        f.write(f"# Zero suppression: {args.zero_suppress} sigma\n")
     f.write(f"# Time: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())}\n")
     f.write(f"#########################################################\n")
     # * --- Set up data acquisition ----------------------------------------
+    receiver_pool = None
+    sparse_writer = None
+    buffered_writer = None
     try:
+        run_report.start_phase("configuration")
         # set up top register
         if args.A:
             fpga_address = 0x00
@@ -170,6 +259,12 @@ with open(output_file_name, 'w') as f:
 
         packetlib.clean_socket(socket_udp)
 
+        # with -P the data of every board goes to its own receiver process from here on
+        if args.processes:
+            receiver_pool = packetlib.BoardReceiverPool([(_board, _ip, _port) for _board, _used, _ip, _port in ((0x00, args.A, h2gcroc_ip_A, h2gcroc_port_A), (0x01, args.B, h2gcroc_ip_B, h2gcroc_port_B)) if _used], pc_ip, pc_port, monitor_port=args.monitor)
+            receiver_pool.start()
+            logger.info(f"Started {len(receiver_pool.boards)} receiver processes")
+
         # set up generator
         
         if args.A:
@@ -187,37 +282,188 @@ with open(output_file_name, 'w') as f:
         logger.info(f"Expected number of packets: {expected_packet_num}")
 
         extracted_payloads_pool = []
+        # line-level loss accounting, independent of the fragment parser below
+        packet_accounting = packetlib.PacketAccounting()
+
+        # with online event building the half-packets of both boards are merged into events before writing
+        event_builder = None
+        if args.build:
+            event_builder = packetlib.DualBoardEventBuilder(boards=[_board for _board, _used in ((0x00, args.A), (0x01, args.B)) if _used], timestamp_tolerance=args.tolerance, fragment_life=10, event_life=20)
+        if args.zero_suppress is not None:
+            sparse_writer = packetlib.SparseEventWriter(f, zero_suppressors)
+        else:
+            # raw lines are collected in large blocks and formatted and written on a worker thread
+            buffered_writer = packetlib.BufferedRunWriter(f, sync=args.sync, fadvise=args.fadvise)
 
         progress_bar = tqdm(total=expected_packet_num, desc="Acquiring data", unit="packets")
         progress_divider = expected_packet_num // 100
 
+        def write_event_fragment(event_fragment):
+            if event_builder is None:
+                buffered_writer.add_lines(event_fragment, packetlib.fragment_timestamp(event_fragment) if rotating_output else None)
+                return
+            for _merged_event in event_builder.add_fragment(event_fragment):
+                if sparse_writer is not None:
+                    for _event_key, _halves in _merged_event.values():
+                        _event_words, _event_daqh = packetlib.event_channel_words(_halves)
+                        sparse_writer.add(_event_key[0], _event_key[1], _event_words, [int.from_bytes(bytes(_d), byteorder='big') for _d in _event_daqh])
+                    continue
+                _event_lines = [_byte_line for _event_key, _halves in _merged_event.values() for _half_index in sorted(_halves.keys()) for _byte_line in _halves[_half_index]]
+                buffered_writer.add_lines(_event_lines, next(iter(_merged_event.values()))[0][1])
+
+        run_report.start_phase("acquisition")
+        kernel_drops_start = packetlib.udp_socket_drops(socket_udp)
+        acquisition_start_time = time.monotonic()
+        stop_reason = None
+
         # ! acquire data
-        while True:
+        while receiver_pool is not None:
+            wait_seconds = idle_timeout
+            if acquisition_deadline is not None:
+                remaining_seconds = acquisition_start_time + acquisition_deadline - time.monotonic()
+                if remaining_seconds <= 0:
+                    stop_reason = "deadline"
+                    break
+                wait_seconds = remaining_seconds if idle_timeout is None else min(idle_timeout, remaining_seconds)
+            # the receiver processes hand over whole half-packets of one board per block
+            received_block = receiver_pool.get_block(timeout=wait_seconds)
+            if received_block is None:
+                stop_reason = "deadline" if acquisition_deadline is not None and time.monotonic() - acquisition_start_time >= acquisition_deadline else "idle"
+                run_report.count("timeout_num")
+                break
+            _board, _block_data = received_block
+            _block_packet_num = len(_block_data) // 200
+            write_start = time.perf_counter()
+            if event_builder is None:
+                buffered_writer.add_block(_block_data)
+            else:
+                for _offset in range(0, len(_block_data), 200):
+                    write_event_fragment([_block_data[_offset + _line * 40:_offset + (_line + 1) * 40] for _line in range(5)])
+                event_builder.age()
+            run_report.add_time("write", time.perf_counter() - write_start)
+            current_packet_num += _block_packet_num
+            progress_bar.update(_block_packet_num)
+            progress_bar.set_postfix({f"lost_{_board}": _summary["lost"] for _board, _summary in receiver_pool.loss_summaries.items()}, refresh=False)
+            if current_packet_num >= expected_packet_num:
+                progress_bar.close()
+                break
+
+        socket_udp.settimeout(idle_timeout)
+        while receiver_pool is None:
+            if acquisition_deadline is not None:
+                remaining_seconds = acquisition_start_time + acquisition_deadline - time.monotonic()
+                if remaining_seconds <= 0:
+                    stop_reason = "deadline"
+                    break
+                socket_udp.settimeout(remaining_seconds if idle_timeout is None else min(idle_timeout, remaining_seconds))
             try:
                 # set the progress bar by the current packet number
                 rec_data, rec_addr = socket_udp.recvfrom(65536)
-                extracted_payloads_pool += packetlib.extract_raw_payloads(rec_data)
+                datagram_start = time.perf_counter()
+                datagram_write_seconds = 0.0
+                run_report.count("datagram_num")
+                run_report.count("byte_num", len(rec_data))
+                if monitor_sender is not None:
+                    monitor_sender.offer(rec_data)
+                new_payloads = packetlib.extract_raw_payloads(rec_data)
+                packet_accounting.add_datagram(rec_data, new_payloads)
+                extracted_payloads_pool += new_payloads
                 while len(extracted_payloads_pool) >= 5:
                     candidate_packet_lines = extracted_payloads_pool[:5]
                     is_packet_good, event_fragment = packetlib.check_event_fragment(candidate_packet_lines)
                     if is_packet_good:
                         extracted_payloads_pool = extracted_payloads_pool[5:]
                         current_packet_num += 1
-                        for _byte_line in event_fragment:
-                            hex_data = ' '.join([f'{_byte:02X}' for _byte in _byte_line])
-                            f.write(hex_data + '\n')
+                        write_start = time.perf_counter()
+                        write_event_fragment(event_fragment)
+                        write_seconds = time.perf_counter() - write_start
+                        datagram_write_seconds += write_seconds
+                        run_report.add_time("write", write_seconds)
                         if current_packet_num%progress_divider == 0:
                             progress_bar.update(progress_divider)
+                            progress_bar.set_postfix(packet_accounting.loss_summary(), refresh=False)
                     else:
                         extracted_payloads_pool = extracted_payloads_pool[1:]
+                        packet_accounting.parser_skipped_line_num += 1
+                if event_builder is not None:
+                    event_builder.age()
+                run_report.record_high_water("payload_pool_lines", len(extracted_payloads_pool))
+                run_report.add_time("decode", time.perf_counter() - datagram_start - datagram_write_seconds)
                 if current_packet_num >= expected_packet_num:
                     progress_bar.close()
                     break
             except socket.timeout:
-                logger.warning("UDP Timeout")
+                stop_reason = "deadline" if acquisition_deadline is not None and time.monotonic() - acquisition_start_time >= acquisition_deadline else "idle"
+                run_report.count("timeout_num")
                 break
 
         # ! end of data acquisition
+        acquisition_seconds = time.monotonic() - acquisition_start_time
+        # the shutdown commands below wait for replies, they get the normal socket timeout
+        socket_udp.settimeout(timeout)
+        if stop_reason is not None:
+            progress_bar.close()
+            logger.warning(f"Acquisition stopped ({stop_reason} timeout) after {acquisition_seconds:.1f} s with {current_packet_num} of {expected_packet_num} half-packets")
+        kernel_drops_end = packetlib.udp_socket_drops(socket_udp)
+        run_report.start_phase("shutdown")
+        if kernel_drops_start is not None and kernel_drops_end is not None:
+            run_report.count("kernel_drop_num", kernel_drops_end - kernel_drops_start)
+        if receiver_pool is not None:
+            for _board, _stats in receiver_pool.stop().items():
+                run_report.count("datagram_num", _stats["datagram_num"])
+                run_report.count("byte_num", _stats["byte_num"])
+                run_report.add_time("receiver_decode", _stats["decode_seconds"])
+                run_report.count("receiver_slot_wait_seconds", _stats["slot_wait_seconds"])
+                if _stats["kernel_drop_num"] is not None:
+                    run_report.count("kernel_drop_num", _stats["kernel_drop_num"])
+            for _accounting in receiver_pool.accounting.values():
+                packet_accounting.merge(_accounting)
+        run_report.count("half_packet_num", current_packet_num)
+
+        # drain the writer thread before anything else is written to the output
+        if buffered_writer is not None:
+            buffered_writer.close()
+            run_report.count("writer_thread_seconds", buffered_writer.write_seconds)
+            run_report.record_high_water("writer_block_seconds", buffered_writer.max_block_seconds)
+            run_report.record_high_water("buffered_writer_queue_blocks", buffered_writer.queue_high_water)
+            run_report.count("written_block_num", buffered_writer.block_num)
+
+        loss_report = packet_accounting.report()
+        for _name, _value in loss_report["totals"].items():
+            f.write(f"# Packet accounting {_name}: {_value}\n")
+        for _half_name, _counters in loss_report["halves"].items():
+            f.write(f"# Packet accounting half {_half_name}: " + ' '.join([f"{_name}={_value}" for _name, _value in _counters.items()]) + "\n")
+        logger.info(f"Datagrams: {packet_accounting.datagram_num}, lines: {packet_accounting.line_num}, unrecognised slots: {packet_accounting.unrecognised_slot_num}, lines skipped by the parser: {packet_accounting.parser_skipped_line_num}")
+        for _half_name, _counters in loss_report["halves"].items():
+            if _counters["missing_half_packet_num"] > 0 or _counters["incomplete_num"] > 0 or _counters["timestamp_backward_num"] > 0:
+                logger.warning(f"Half {_half_name} (fpga_asic_half): {_counters['half_packet_num']}/{_counters['expected_num']} half-packets, {_counters['incomplete_num']} incomplete, {_counters['missing_line_num']} missing lines, {_counters['timestamp_backward_num']} backward timestamps")
+
+        if sparse_writer is not None:
+            sparse_writer.flush()
+            if sparse_writer.event_num > 0:
+                logger.info(f"Zero suppression kept {sparse_writer.hit_num / sparse_writer.event_num:.1f} channels per board event")
+
+        if event_builder is not None:
+            event_builder.flush()
+            f.write(f"# Merged events: {event_builder.merged_event_num}\n")
+            for _board, _orphan_num in event_builder.orphan_event_num.items():
+                f.write(f"# Orphan events board {_board}: {_orphan_num}\n")
+            for _board, _dropped_num in event_builder.dropped_event_num().items():
+                f.write(f"# Incomplete events board {_board}: {_dropped_num}\n")
+            logger.info(f"Merged events: {event_builder.merged_event_num}")
+            logger.info(f"Orphan events per board: {event_builder.orphan_event_num}")
+            logger.info(f"Incomplete events per board: {event_builder.dropped_event_num()}")
+            run_report.count("event_num", event_builder.merged_event_num)
+        else:
+            run_report.count("event_num", current_packet_num // (4 * (2 if args.A and args.B else 1)))
+        for _name in ("unrecognised_slot_num", "parser_skipped_line_num", "missing_half_packet_num", "missing_line_num"):
+            run_report.count("loss_" + _name, loss_report["totals"].get(_name, 0))
+
+        # requested and received are counted in half-packets, dropped in incomplete board events
+        shortfall = packetlib.acquisition_shortfall(expected_packet_num, current_packet_num, stop_reason, acquisition_seconds, 0 if event_builder is None else sum(event_builder.dropped_event_num().values()))
+        run_report.add_section("shortfall", shortfall)
+        for _name, _value in shortfall.items():
+            f.write(f"# Shortfall {_name}: {_value}\n")
 
         if args.A:
             fpga_address = 0x00
@@ -242,9 +488,28 @@ with open(output_file_name, 'w') as f:
                     logger.warning(f"Failed to set Top settings OffLR for ASIC {_asic} for run on board B")
 
     finally:
+        # an interrupted run still writes what it has buffered, before the output file is closed
+        try:
+            if buffered_writer is not None:
+                buffered_writer.close()
+            if sparse_writer is not None:
+                sparse_writer.flush()
+        except Exception as e:
+            logger.error(f"Failed to write the buffered data: {e}")
+        if receiver_pool is not None:
+            receiver_pool.stop()
         socket_udp.close()
         logger.info("UDP socket is closed")
-
+        if monitor_sender is not None:
+            monitor_sender.close()
+
+# the writer queue only drains on close, so its high-water mark is taken afterwards
+run_report.record_high_water("writer_queue_blocks", getattr(output_file, 'queue_high_water', None))
+run_report_file_name = packetlib.run_report_path(output_base_name if rotating_output else output_file_name)
+run_report.save(run_report_file_name)
+for _line in run_report.summary_lines():
+    logger.info(_line)
+logger.info(f"Run report is saved to {run_report_file_name}")
 logger.info(f"Data acquisition is finished. Data is saved to {output_file_name}")
 
 
@@ -54,7 +54,7 @@ default_output_file_name = script_id_str + time.strftime("_%Y%m%d_%H%M%S", time.
 parser = argparse.ArgumentParser(description='DAQ script for data acquisition')
 parser.add_argument('-o', '--output', type=str, help='Output file name')
 parser.add_argument('-i', '--input', type=str, help='Input file name')
-parser.add_argument('-n', '--num', type=int, help='Number of events to process')
+parser.add_argument('-n', '--num', type=int, help='Number of events to process (all events if not given)')
 parser.add_argument('-a', '--show_A', action='store_true', help='Show A side data')
 parser.add_argument('-b', '--show_B', action='store_true', help='Show B side data')
 
@@ -87,152 +87,108 @@ logger.info(f'Reading input file {input_file_path}')
 
 # * --- Read the input file -------------------------------------------
 _fragment_life = 100
-_fragment_drop_counter = 0
+hist_batch_size = 10000
+
+# the histograms are filled batch by batch, so the memory does not depend on the number of events
+hist2d_adc = packetlib.ChannelHistogram2D(bins=256, value_range=(0, 1024))
+hist2d_tot = packetlib.ChannelHistogram2D(bins=256, value_range=(0, 4096))
+hist2d_toa = packetlib.ChannelHistogram2D(bins=256, value_range=(0, 1024))
+
+L1_scan_channel = 6
+machine_gun_min = 0
+machine_gun_max = 10
+machine_gun_bins = machine_gun_max - machine_gun_min + 1
+hist2d_machine_gun = packetlib.Histogram2D(machine_gun_bins+2, (machine_gun_min - 1, machine_gun_max + 1), 256, (0, 1024))
+
+timestamp_diff_threshold = 100
+
+def fill_histograms(_batch_words, _batch_timestamps, _machine_gun_previous):
+    # the Tc/Tp flags of each word tell which fields hold ADC, ToT and ToA
+    _decoded = packetlib.decode_channel_words(np.array(_batch_words))
+    _batch_machine_gun, _batch_burst_id = packetlib.machine_gun_samples(_batch_timestamps, timestamp_diff_threshold, previous=_machine_gun_previous)
+    hist2d_adc.fill_channels(_decoded["adc"], mask=_decoded["adc_valid"])
+    hist2d_tot.fill_channels(_decoded["tot"], mask=_decoded["tot_valid"])
+    hist2d_toa.fill_channels(_decoded["toa"])
+    hist2d_machine_gun.fill(_batch_machine_gun, _decoded["adc"][:, L1_scan_channel], mask=_decoded["adc_valid"][:, L1_scan_channel])
+    return _batch_timestamps[-1], _batch_machine_gun[-1], _batch_burst_id[-1]
+
+event_builder = packetlib.EventBuilder(_fragment_life)
 
 with open(input_file_path, 'r') as f:
     extracted_payloads_pool = []
-    event_fragment_pool     = []
-    fragment_life_dict      = {}
 
     current_event_num = 0
-    expected_event_num = 1000 if args.num is None else args.num
-
-    all_chn_value_0_array = np.zeros((expected_event_num, 152))
-    all_chn_value_1_array = np.zeros((expected_event_num, 152))
-    all_chn_value_2_array = np.zeros((expected_event_num, 152))
-    hamming_code_array    = np.zeros((expected_event_num, 12))
+    expected_event_num = args.num
 
-    last_timestamp = 0
-    timestamp_diff_pack = []
-    machine_gun_counter_pack = []
-
-    machine_gun_counter = 0
-    timestamp_diff_threshold = 100
+    batch_words = []
+    batch_timestamps = []
+    machine_gun_previous = None
 
     for line in f:
         # if it starts with a #, it is a comment
         if line.startswith('#'):
             continue
         # if it is not a comment, it is a data line
-        data = line.split()
+        bytearray_line = bytearray.fromhex(line)
+        if len(bytearray_line) < 2:
+            continue
         if not showing_A:
-            if data[1] == '00':
+            if bytearray_line[1] == 0x00:
                 continue
         if not showing_B:
-            if data[1] == '01':
-                continue    
-        bytearray_line = bytearray()
-        for d in data:
-            bytearray_line.append(int(d, 16))
+            if bytearray_line[1] == 0x01:
+                continue
 
         extracted_payloads_pool.append(bytearray_line)
         while len(extracted_payloads_pool) >= 5:
             candidate_packet_lines = extracted_payloads_pool[:5]
             is_packet_good, event_fragment = packetlib.check_event_fragment(candidate_packet_lines)
-            if is_packet_good:
-                event_fragment_pool.append(event_fragment)
-                extracted_payloads_pool = extracted_payloads_pool[5:]
-            else:
+            if not is_packet_good:
                 logger.warning("Warning: Event fragment is not good")
                 extracted_payloads_pool = extracted_payloads_pool[1:]
-        indices_to_delete = set()
-        if len(event_fragment_pool) >= 4:
-            event_fragment_pool = sorted(event_fragment_pool, key=lambda x: x[0][3:7])
-        i = 0
-        while i <= len(event_fragment_pool) - 4:
-            timestamp0 = event_fragment_pool[i][0][4] << 24 | event_fragment_pool[i][0][5] << 16 | event_fragment_pool[i][0][6] << 8 | event_fragment_pool[i][0][7]
-            timestamp1 = event_fragment_pool[i+1][0][4] << 24 | event_fragment_pool[i+1][0][5] << 16 | event_fragment_pool[i+1][0][6] << 8 | event_fragment_pool[i+1][0][7]
-            timestamp2 = event_fragment_pool[i+2][0][4] << 24 | event_fragment_pool[i+2][0][5] << 16 | event_fragment_pool[i+2][0][6] << 8 | event_fragment_pool[i+2][0][7]
-            timestamp3 = event_fragment_pool[i+3][0][4] << 24 | event_fragment_pool[i+3][0][5] << 16 | event_fragment_pool[i+3][0][6] << 8 | event_fragment_pool[i+3][0][7]
-            if timestamp0 == timestamp1 and timestamp0 == timestamp2 and timestamp0 == timestamp3:
-                id_str = f"{timestamp0:08X}"
-                timestamp = int(id_str, 16)
-                timediff = timestamp - last_timestamp
-                if len(timestamp_diff_pack) == 0:
-                    timestamp_diff_pack.append(100)
-                else:
-                    timestamp_diff_pack.append(timediff)
-                if timediff < 0:
-                    print(f"timestamp: {timestamp}, last_timestamp: {last_timestamp}, timediff: {timediff}")
-                    timediff += 2**30
-                last_timestamp = timestamp
-                for _half in range(4):
-                    extracted_data = packetlib.assemble_data_from_40bytes(event_fragment_pool[i+_half], verbose=False)
-                    extracted_values = packetlib.extract_values(extracted_data["_extraced_160_bytes"], verbose=False)
-
-                    DaqH_info = extracted_values["_DaqH"]
-                    # check if the DaqH is good
-                    good_DaqH = (DaqH_info[0] >> 4) == 0x05 and (DaqH_info[-1] & 0x0F) == 0x05
-                    if not good_DaqH:
-                        # logger.warning(f'Bad DaqH: {DaqH_info}')
-                        uni_chn_base = (extracted_data["_header"] - 0xA0) * 76 + (extracted_data["_packet_type"] - 0x24) * 38
-                        for j in range(len(extracted_values["_extracted_values"])):
-                            all_chn_value_0_array[current_event_num][j+uni_chn_base] = 0
-                            all_chn_value_1_array[current_event_num][j+uni_chn_base] = 0
-                            all_chn_value_2_array[current_event_num][j+uni_chn_base] = 0
-                    else:
-                        uni_chn_base = (extracted_data["_header"] - 0xA0) * 76 + (extracted_data["_packet_type"] - 0x24) * 38
-                        for j in range(len(extracted_values["_extracted_values"])):
-                            all_chn_value_0_array[current_event_num][j+uni_chn_base] = extracted_values["_extracted_values"][j][1]
-                            all_chn_value_1_array[current_event_num][j+uni_chn_base] = extracted_values["_extracted_values"][j][2]
-                            all_chn_value_2_array[current_event_num][j+uni_chn_base] = extracted_values["_extracted_values"][j][3]
-                    hamming_code_array[current_event_num][_half*3+0] =  packetlib.DaqH_get_H1(extracted_values["_DaqH"])
-                    hamming_code_array[current_event_num][_half*3+1] =  packetlib.DaqH_get_H2(extracted_values["_DaqH"])
-                    hamming_code_array[current_event_num][_half*3+2] =  packetlib.DaqH_get_H3(extracted_values["_DaqH"])
-                indices_to_delete.update([i, i+1, i+2, i+3])
-                current_event_num += 1
-                if timediff < timestamp_diff_threshold:
-                    machine_gun_counter += 1
-                else:
-                    machine_gun_counter = 0
-                machine_gun_counter_pack.append(machine_gun_counter)
-                i += 4
-            else:
-                if timestamp0 in fragment_life_dict:
-                    if fragment_life_dict[timestamp0] >= _fragment_life - 1:
-                        indices_to_delete.update([i])
-                        # logger.warning(f'Fragment {timestamp0} is not complete')
-                        _fragment_drop_counter += 1
-                        del fragment_life_dict[timestamp0]
-                    else:
-                        fragment_life_dict[timestamp0] += 1
-                else:
-                    fragment_life_dict[timestamp0] = 1
-                i += 1
-        for index in sorted(indices_to_delete, reverse=True):
-            del event_fragment_pool[index]
+                continue
+            extracted_payloads_pool = extracted_payloads_pool[5:]
+            _event = event_builder.add_fragment(event_fragment)
+            if _event is None:
+                continue
+            _event_key, _halves = _event
+            _event_words, _event_daqh = packetlib.event_channel_words(_halves)
+            for _half in range(4):
+                DaqH_info = _event_daqh[_half]
+                # check if the DaqH is good
+                good_DaqH = (DaqH_info[0] >> 4) == 0x05 and (DaqH_info[-1] & 0x0F) == 0x05
+                if not good_DaqH:
+                    _event_words[_half*38:(_half+1)*38] = 0
+            batch_words.append(_event_words)
+            batch_timestamps.append(_event_key[1])
+            current_event_num += 1
+            if len(batch_words) >= hist_batch_size:
+                machine_gun_previous = fill_histograms(batch_words, batch_timestamps, machine_gun_previous)
+                batch_words = []
+                batch_timestamps = []
+            if current_event_num == expected_event_num:
+                break
+        event_builder.age()
         if current_event_num == expected_event_num:
-            break;      
+            break
+
+    if len(batch_words) > 0:
+        fill_histograms(batch_words, batch_timestamps, machine_gun_previous)
 
-if current_event_num < expected_event_num:
+_fragment_drop_counter = event_builder.dropped_event_num
+
+if expected_event_num is not None and current_event_num < expected_event_num:
     logger.warning(f'Only {current_event_num} events are extracted')
-    expected_event_num = current_event_num
+expected_event_num = current_event_num
 
 # * --- Plot the data ------------------------------------------------
+def draw_hist2d(_ax, _hist):
+    # empty bins stay white, as in hist2d with a log scale
+    return _ax.pcolormesh(_hist.x_edges(), _hist.y_edges(), np.ma.masked_equal(_hist.counts, 0).T, cmap=plt.cm.jet, norm=mpl.colors.LogNorm())
+
 fig, [ax0, ax1, ax2] = plt.subplots(3, 1, figsize=(12, 12), dpi = 300, sharex=False, sharey=False)
 
-hist2d_x_v0_chns = []
-hist2d_x_v1_chns = []
-hist2d_x_v2_chns = []
-hist2d_y_v0_values = []
-hist2d_y_v1_values = []
-hist2d_y_v2_values = []
-
-for _event in range(expected_event_num):
-    # if machine_gun_counter_pack[_event] != 3:
-    #     continue
-    for _chn in range(152):
-        hist2d_x_v0_chns.append(_chn)
-        hist2d_x_v1_chns.append(_chn)
-        hist2d_x_v2_chns.append(_chn)
-        hist2d_y_v0_values.append(all_chn_value_0_array[_event][_chn])
-        tot_value = int(all_chn_value_1_array[_event][_chn])
-        if (tot_value >> 9) & 0x1 == 1:
-            tot_value = (tot_value & 0x1FF) << 3
-        hist2d_y_v1_values.append(tot_value)
-        hist2d_y_v2_values.append(all_chn_value_2_array[_event][_chn])
-
-ax0.hist2d(hist2d_x_v0_chns, hist2d_y_v0_values, bins=(152, 256), range=((0, 152), (0, 1024)), cmap=plt.cm.jet, norm=mpl.colors.LogNorm())
+draw_hist2d(ax0, hist2d_adc)
 if showing_A:
     ax0.set_title('Channel vs. ADC (Board 208)')
 if showing_B:
@@ -251,7 +207,7 @@ if showing_B:
     ax0.annotate(f'Board 209', xy=(0.99, 0.79), xycoords='axes fraction', ha='right', va='center', fontsize=16, color='black', weight='bold')
 
 
-ax1.hist2d(hist2d_x_v1_chns, hist2d_y_v1_values, bins=(152, 256), range=((0, 152), (0, 4096)), cmap=plt.cm.jet, norm=mpl.colors.LogNorm())
+draw_hist2d(ax1, hist2d_tot)
 if showing_A:
     ax1.set_title('Channel vs. ToT (Board 208)')
 if showing_B:
@@ -271,7 +227,7 @@ if showing_B:
     ax1.annotate(f'Board 209', xy=(0.99, 0.79), xycoords='axes fraction', ha='right', va='center', fontsize=16, color='black', weight='bold')
 
 
-ax2.hist2d(hist2d_x_v2_chns, hist2d_y_v2_values, bins=(152, 256), range=((0, 152), (0, 1024)), cmap=plt.cm.jet, norm=mpl.colors.LogNorm())
+draw_hist2d(ax2, hist2d_toa)
 if showing_A:
     ax2.set_title('Channel vs. ToA (Board 208)')
 if showing_B:
@@ -303,20 +259,8 @@ else:
     logger.info(f'Saving output file {output_file_path}')
     plt.savefig(output_file_path)
 
-L1_scan_channel = 6
-
-hist_1d_x = []
-hist_1d_y = []
-
-for _event in range(expected_event_num):
-    hist_1d_x.append(machine_gun_counter_pack[_event])
-    hist_1d_y.append(all_chn_value_0_array[_event][L1_scan_channel])
-
 fig, ax = plt.subplots(1, 1, figsize=(12, 6), dpi = 300)
-machine_gun_min = min(machine_gun_counter_pack)
-machine_gun_max = 10
-machine_gun_bins = machine_gun_max - machine_gun_min + 1
-ax.hist2d(hist_1d_x, hist_1d_y, bins=(machine_gun_bins+2, 256), range=((machine_gun_min - 1, machine_gun_max + 1), (0, 1024)), cmap=plt.cm.jet, norm=mpl.colors.LogNorm())
+draw_hist2d(ax, hist2d_machine_gun)
 ax.set_title('Machine Gun Counter vs. ToT')
 
 plt.tight_layout()
@@ -80,11 +80,7 @@ extracted_payloads_pool = []
 event_fragment_pool     = []
 fragment_life_dict      = {}
 
-last_timestamp = 0
-timestamp_diff_pack = []
-machine_gun_counter_pack = []
-
-machine_gun_counter = 0
+event_timestamp_pack = []
 timestamp_diff_threshold = 100
 
 good_packet_header_counter = 0
@@ -269,17 +265,7 @@ with open(os.path.join(input_folder, input_file), 'r') as f:
             timestamp2 = event_fragment_pool[i+2][0][4] << 24 | event_fragment_pool[i+2][0][5] << 16 | event_fragment_pool[i+2][0][6] << 8 | event_fragment_pool[i+2][0][7]
             timestamp3 = event_fragment_pool[i+3][0][4] << 24 | event_fragment_pool[i+3][0][5] << 16 | event_fragment_pool[i+3][0][6] << 8 | event_fragment_pool[i+3][0][7]
             if timestamp0 == timestamp1 and timestamp0 == timestamp2 and timestamp0 == timestamp3:
-                id_str = f"{timestamp0:08X}"
-                timestamp = int(id_str, 16)
-                timediff = timestamp - last_timestamp
-                if len(timestamp_diff_pack) == 0:
-                    timestamp_diff_pack.append(100)
-                else:
-                    timestamp_diff_pack.append(timediff)
-                if timediff < 0:
-                    print(f"timestamp: {timestamp}, last_timestamp: {last_timestamp}, timediff: {timediff}")
-                    timediff += 2**30
-                last_timestamp = timestamp
+                event_timestamp_pack.append(timestamp0)
                 for _half in range(4):
                     extracted_data = packetlib.assemble_data_from_40bytes(event_fragment_pool[i+_half], verbose=False)
                     extracted_values = packetlib.extract_values(extracted_data["_extraced_160_bytes"], verbose=False)
@@ -293,11 +279,6 @@ with open(os.path.join(input_folder, input_file), 'r') as f:
                     hamming_code_array[current_event_num][_half*3+2] =  packetlib.DaqH_get_H3(extracted_values["_DaqH"])
                 indices_to_delete.update([i, i+1, i+2, i+3])
                 current_event_num += 1
-                if timediff < timestamp_diff_threshold:
-                    machine_gun_counter += 1
-                else:
-                    machine_gun_counter = 0
-                machine_gun_counter_pack.append(machine_gun_counter)
                 i += 4
             else:
                 if timestamp0 in fragment_life_dict:
@@ -316,6 +297,8 @@ with open(os.path.join(input_folder, input_file), 'r') as f:
 
 logger.info(f'Event Counter: {current_event_num}')
 
+machine_gun_counter_pack, machine_gun_burst_pack = packetlib.machine_gun_samples(event_timestamp_pack, timestamp_diff_threshold)
+
 logger.info(f'ASIC 0 half 0 counter: {ASIC_0_half_0_counter}')
 logger.info(f'Line counters: {ASIC_half_line_counters[0:5]}')
 logger.info(f'ASIC 0 half 1 counter: {ASIC_0_half_1_counter}')
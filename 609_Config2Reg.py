@@ -217,19 +217,8 @@ tottoa_calib_folder = "dump"
 
 if not pedeA:
     # * Find the latest pedestal file for board A
-    pedeA_candidates = [f for f in os.listdir(pedestal_calib_folder) if f.startswith(pedestal_calib_file_prefix) and f.endswith(".json")]
-    pedeA_candidates.sort(reverse=True)
-
-    newset_pedeA_found = False
-    if len(pedeA_candidates) > 0:
-        for pedeA_candidate in pedeA_candidates:
-            with open(os.path.join(pedestal_calib_folder, pedeA_candidate), 'r') as f:
-                pedeA_json = json.load(f)
-                if pedeA_json['udp']['h2gcroc_ip'] == h2gcroc_ip_A:
-                    pedeA = os.path.join(pedestal_calib_folder, pedeA_candidate)
-                    newset_pedeA_found = True
-                    break
-    if not newset_pedeA_found:
+    pedeA = packetlib.find_latest_calib_file(packetlib.calib_type_pedestal, h2gcroc_ip_A, pedestal_calib_folder, pedestal_calib_file_prefix)
+    if pedeA is None:
         logger.critical("No pedestal calibration file found for board A")
         exit()
     else:
@@ -242,19 +231,8 @@ else:
 
 if not pedeB:
     # * Find the latest pedestal file for board B
-    pedeB_candidates = [f for f in os.listdir(pedestal_calib_folder) if f.startswith(pedestal_calib_file_prefix) and f.endswith(".json")]
-    pedeB_candidates.sort(reverse=True)
-
-    newset_pedeB_found = False
-    if len(pedeB_candidates) > 0:
-        for pedeB_candidate in pedeB_candidates:
-            with open(os.path.join(pedestal_calib_folder, pedeB_candidate), 'r') as f:
-                pedeB_json = json.load(f)
-                if pedeB_json['udp']['h2gcroc_ip'] == h2gcroc_ip_B:
-                    pedeB = os.path.join(pedestal_calib_folder, pedeB_candidate)
-                    newset_pedeB_found = True
-                    break
-    if not newset_pedeB_found:
+    pedeB = packetlib.find_latest_calib_file(packetlib.calib_type_pedestal, h2gcroc_ip_B, pedestal_calib_folder, pedestal_calib_file_prefix)
+    if pedeB is None:
         logger.critical("No pedestal calibration file found for board B")
         exit()
     else:
@@ -267,19 +245,8 @@ else:
 
 if not totA:
     # * Find the latest ToT/ToA calibration file for board A
-    totA_candidates = [f for f in os.listdir(tottoa_calib_folder) if f.startswith(tottoa_calib_file_prefix) and f.endswith(".json")]
-    totA_candidates.sort(reverse=True)
-
-    newset_totA_found = False
-    if len(totA_candidates) > 0:
-        for totA_candidate in totA_candidates:
-            with open(os.path.join(tottoa_calib_folder, totA_candidate), 'r') as f:
-                totA_json = json.load(f)
-                if totA_json['udp']['h2gcroc_ip'] == h2gcroc_ip_A:
-                    totA = os.path.join(tottoa_calib_folder, totA_candidate)
-                    newset_totA_found = True
-                    break
-    if not newset_totA_found:
+    totA = packetlib.find_latest_calib_file(packetlib.calib_type_tottoa, h2gcroc_ip_A, tottoa_calib_folder, tottoa_calib_file_prefix)
+    if totA is None:
         logger.critical("No ToT/ToA calibration file found for board A")
         exit()
     else:
@@ -292,19 +259,8 @@ else:
 
 if not totB:
     # * Find the latest ToT/ToA calibration file for board B
-    totB_candidates = [f for f in os.listdir(tottoa_calib_folder) if f.startswith(tottoa_calib_file_prefix) and f.endswith(".json")]
-    totB_candidates.sort(reverse=True)
-
-    newset_totB_found = False
-    if len(totB_candidates) > 0:
-        for totB_candidate in totB_candidates:
-            with open(os.path.join(tottoa_calib_folder, totB_candidate), 'r') as f:
-                totB_json = json.load(f)
-                if totB_json['udp']['h2gcroc_ip'] == h2gcroc_ip_B:
-                    totB = os.path.join(tottoa_calib_folder, totB_candidate)
-                    newset_totB_found = True
-                    break
-    if not newset_totB_found:
+    totB = packetlib.find_latest_calib_file(packetlib.calib_type_tottoa, h2gcroc_ip_B, tottoa_calib_folder, tottoa_calib_file_prefix)
+    if totB is None:
         logger.critical("No ToT/ToA calibration file found for board B")
         exit()
     else:
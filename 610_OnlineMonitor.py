@@ -0,0 +1,185 @@
+import packetlib
+import socket
+import numpy as np
+import time
+import json
+import logging
+import colorlog
+import argparse
+import threading
+import http.server
+from tqdm import tqdm
+
+# * --- Set up script information -------------------------------------
+script_id_str       = '610_OnlineMonitor'
+script_version_str  = '0.1'
+
+# * --- Set up logging ------------------------------------------------
+class TqdmColorLoggingHandler(colorlog.StreamHandler):
+    def __init__(self):
+        super().__init__()
+
+    def emit(self, record):
+        try:
+            msg = self.format(record)
+            tqdm.write(msg)
+            self.flush()
+        except Exception:
+            self.handleError(record)
+
+# Configure the custom logging handler with colored output
+handler = TqdmColorLoggingHandler()
+formatter = colorlog.ColoredFormatter(
+    '%(log_color)s%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%H:%M:%S',  # Customizes the date format to show only time
+    log_colors={
+        'DEBUG': 'cyan',
+        'INFO': 'green',
+        'WARNING': 'yellow',
+        'ERROR': 'red',
+        'CRITICAL': 'red,bg_white',
+    }
+)
+handler.setFormatter(formatter)
+
+logger = logging.getLogger('example_logger')
+logger.setLevel(logging.DEBUG)
+logger.addHandler(handler)
+
+# * --- Set up argument parser -----------------------------------------
+parser = argparse.ArgumentParser(description='Online monitor fed with the datagrams sampled by 605_DAQ -m')
+parser.add_argument('-p', '--port', type=int, default=packetlib.monitor_default_port, help='Local UDP port the DAQ sends the sampled datagrams to')
+parser.add_argument('-w', '--web', type=int, default=8080, help='Port of the local monitoring web page, 0 to disable it')
+parser.add_argument('-t', '--terminal', type=float, default=10.0, help='Seconds between terminal summaries, 0 to disable them')
+parser.add_argument('--window', type=float, default=60.0, help='Length of the rolling window in seconds')
+
+args = parser.parse_args()
+
+# * --- Set up the monitor ---------------------------------------------
+slice_num = 12
+online_monitor = packetlib.OnlineMonitor(slice_seconds=args.window / slice_num, slice_num=slice_num)
+monitor_lock = threading.Lock()
+
+socket_udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+socket_udp.bind(("127.0.0.1", args.port))
+socket_udp.settimeout(0.5)
+logger.info(f"Listening for sampled datagrams on 127.0.0.1:{args.port}")
+
+# * --- Set up the web page --------------------------------------------
+monitor_page_html = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>H2GCROC Online Monitor</title>
+<style>
+body { font-family: monospace; }
+td { width: 2.2em; height: 1.4em; text-align: center; font-size: 70%; }
+.dead { background: #444; color: white; }
+</style></head>
+<body>
+<h3>H2GCROC Online Monitor</h3>
+<div id="summary"></div>
+<div id="boards"></div>
+<script>
+function cell(value, text, cls) {
+    var level = Math.max(0, Math.min(1, value));
+    var color = 'rgb(' + Math.round(255 * level) + ',' + Math.round(255 * (1 - Math.abs(level - 0.5) * 2)) + ',' + Math.round(255 * (1 - level)) + ')';
+    return '<td class="' + (cls || '') + '" style="' + (cls ? '' : 'background:' + color) + '">' + text + '</td>';
+}
+function render(s) {
+    document.getElementById('summary').innerHTML = 'Window ' + s.window_seconds.toFixed(1) + ' s, ' + s.datagram_num + ' sampled datagrams';
+    var html = '';
+    for (var b = 0; b < s.half_packet_rate.length; b++) {
+        html += '<h4>Board ' + b + '</h4><table><tr><th>Half</th><th>Rate [Hz]</th><th>Bad DaqH</th></tr>';
+        for (var h = 0; h < 4; h++) {
+            html += '<tr><td>' + h + '</td><td>' + s.half_packet_rate[b][h].toFixed(1) + '</td><td>' + (100 * s.daqh_bad_fraction[b][h]).toFixed(1) + '%</td></tr>';
+        }
+        html += '</table><p>Mean ADC (colour) and occupancy [%]; dark cells are dead, red text is saturated</p><table>';
+        for (var h = 0; h < 4; h++) {
+            html += '<tr>';
+            for (var c = 0; c < 37; c++) {
+                var chn = h * 38 + c;
+                var text = (100 * s.occupancy[b][chn]).toFixed(0);
+                if (s.saturated_fraction[b][chn] > 0.01) { text = '<b style="color:red">' + text + '</b>'; }
+                html += cell(s.adc_mean[b][chn] / 1024, text, s.dead[b][chn] ? 'dead' : '');
+            }
+            html += '</tr>';
+        }
+        html += '</table>';
+    }
+    document.getElementById('boards').innerHTML = html;
+}
+function update() { fetch('snapshot.json').then(function (r) { return r.json(); }).then(render); }
+update();
+setInterval(update, 2000);
+</script>
+</body></html>
+"""
+
+class MonitorRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith('/snapshot.json'):
+            with monitor_lock:
+                _snapshot = online_monitor.snapshot()
+            _body = json.dumps(_snapshot).encode()
+            _content_type = 'application/json'
+        elif self.path.startswith('/histograms.json'):
+            with monitor_lock:
+                _histograms = online_monitor.histograms()
+            _body = json.dumps({_name: _values.tolist() for _name, _values in _histograms.items()}).encode()
+            _content_type = 'application/json'
+        elif self.path == '/' or self.path.startswith('/index.html'):
+            _body = monitor_page_html.encode()
+            _content_type = 'text/html'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', _content_type)
+        self.send_header('Content-Length', str(len(_body)))
+        self.end_headers()
+        self.wfile.write(_body)
+
+    def log_message(self, format, *args):
+        pass
+
+if args.web > 0:
+    web_server = http.server.ThreadingHTTPServer(("127.0.0.1", args.web), MonitorRequestHandler)
+    threading.Thread(target=web_server.serve_forever, daemon=True).start()
+    logger.info(f"Monitoring page at http://127.0.0.1:{args.web}/")
+
+# * --- Terminal view --------------------------------------------------
+def log_terminal_summary(_snapshot):
+    logger.info(f"Window {_snapshot['window_seconds']:.1f} s, {_snapshot['datagram_num']} sampled datagrams")
+    for _board, _rates in enumerate(_snapshot['half_packet_rate']):
+        if sum(_rates) == 0:
+            continue
+        for _half in range(4):
+            _channels = range(_half*38, _half*38+37)
+            _dead = [_chn for _chn in _channels if _snapshot['dead'][_board][_chn]]
+            _saturated = [_chn for _chn in _channels if _snapshot['saturated_fraction'][_board][_chn] > 0.01]
+            _mean_occupancy = np.mean([_snapshot['occupancy'][_board][_chn] for _chn in _channels])
+            logger.info(f"Board {_board} half {_half}: {_rates[_half]:.1f} Hz, bad DaqH {100*_snapshot['daqh_bad_fraction'][_board][_half]:.1f}%, occupancy {100*_mean_occupancy:.1f}%")
+            if _rates[_half] == 0:
+                logger.warning(f"Board {_board} half {_half} sends no data")
+            if len(_dead) > 0:
+                logger.warning(f"Board {_board} half {_half} dead channels: {_dead}")
+            if len(_saturated) > 0:
+                logger.warning(f"Board {_board} half {_half} saturated channels: {_saturated}")
+
+# * --- Monitor loop ---------------------------------------------------
+last_summary_time = time.monotonic()
+try:
+    while True:
+        try:
+            rec_data, rec_addr = socket_udp.recvfrom(65536)
+            with monitor_lock:
+                online_monitor.add_datagram(rec_data)
+        except socket.timeout:
+            pass
+        if args.terminal > 0 and time.monotonic() - last_summary_time >= args.terminal:
+            last_summary_time = time.monotonic()
+            with monitor_lock:
+                _snapshot = online_monitor.snapshot()
+            log_terminal_summary(_snapshot)
+except KeyboardInterrupt:
+    logger.info("Online monitor is stopped")
+finally:
+    socket_udp.close()
@@ -16,114 +16,25 @@ script_version_str  = '1.0'
 config_to_modify    = 'config/default_2024Aug_config.json'
 
 # * --- Test function -------------------------------------------------
-def measure_v0(_socket_udp, _ip, _port, _fpga_address, _reg_runLR, _reg_offLR, _event_num, _fragment_life, _logger):
-    for _asic in range(2):
-        if not packetlib.send_check_i2c_wrapper(_socket_udp, _ip, _port, asic_num=_asic, fpga_addr = _fpga_address, sub_addr=packetlib.subblock_address_dict["Top"], reg_addr=0x00, data=_reg_runLR, retry=5, verbose=False):
-            _logger.warning(f"Failed to turn on LR for ASIC {_asic}")
-
-    packetlib.clean_socket(_socket_udp)
-
-    if not packetlib.send_daq_gen_start_stop(_socket_udp, _ip, _port, asic_num=0, fpga_addr = _fpga_address, daq_push=0x00, gen_start_stop=1, daq_start_stop=0xFF, verbose=False):
-        _logger.warning("Failed to start the generator")
-
-    extracted_payloads_pool = []
-    event_fragment_pool     = []
-    fragment_life_dict      = {}
-
-    current_half_packet_num = 0
-    current_event_num = 0
-
-    all_chn_value_0_array = np.zeros((_event_num, 152))
-    all_chn_value_1_array = np.zeros((_event_num, 152))
-    all_chn_value_2_array = np.zeros((_event_num, 152))
-    hamming_code_array    = np.zeros((_event_num, 12))
-
-    while True:
-        try:
-            data_packet, rec_addr    = _socket_udp.recvfrom(8192)
-            # _logger.debug("Packet received")
-            extracted_payloads_pool += packetlib.extract_raw_payloads(data_packet)
-            while len(extracted_payloads_pool) >= 5:
-                candidate_packet_lines = extracted_payloads_pool[:5]
-                is_packet_good, event_fragment = packetlib.check_event_fragment(candidate_packet_lines)
-                if is_packet_good:
-                    event_fragment_pool.append(event_fragment)
-                    current_half_packet_num += 1
-                    extracted_payloads_pool = extracted_payloads_pool[5:]
-                else:
-                    _logger.warning("Warning: Event fragment is not good")
-                    extracted_payloads_pool = extracted_payloads_pool[1:]
-            indices_to_delete = set()
-            if len(event_fragment_pool) >= 4:
-                event_fragment_pool = sorted(event_fragment_pool, key=lambda x: x[0][3:7])
-            i = 0
-            while i <= len(event_fragment_pool) - 4:
-                timestamp0 = event_fragment_pool[i][0][4] << 24 | event_fragment_pool[i][0][5] << 16 | event_fragment_pool[i][0][6] << 8 | event_fragment_pool[i][0][7]
-                timestamp1 = event_fragment_pool[i+1][0][4] << 24 | event_fragment_pool[i+1][0][5] << 16 | event_fragment_pool[i+1][0][6] << 8 | event_fragment_pool[i+1][0][7]
-                timestamp2 = event_fragment_pool[i+2][0][4] << 24 | event_fragment_pool[i+2][0][5] << 16 | event_fragment_pool[i+2][0][6] << 8 | event_fragment_pool[i+2][0][7]
-                timestamp3 = event_fragment_pool[i+3][0][4] << 24 | event_fragment_pool[i+3][0][5] << 16 | event_fragment_pool[i+3][0][6] << 8 | event_fragment_pool[i+3][0][7]
-                if timestamp0 == timestamp1 and timestamp0 == timestamp2 and timestamp0 == timestamp3:
-                    id_str = f"{timestamp0:08X}"
-                    for _half in range(4):
-                        extracted_data = packetlib.assemble_data_from_40bytes(event_fragment_pool[i+_half], verbose=False)
-                        extracted_values = packetlib.extract_values(extracted_data["_extraced_160_bytes"], verbose=False)
-                        uni_chn_base = (extracted_data["_header"] - 0xA0) * 76 + (extracted_data["_packet_type"] - 0x24) * 38
-                        for j in range(len(extracted_values["_extracted_values"])):
-                            all_chn_value_0_array[current_event_num][j+uni_chn_base] = extracted_values["_extracted_values"][j][1]
-                            all_chn_value_1_array[current_event_num][j+uni_chn_base] = extracted_values["_extracted_values"][j][2]
-                            all_chn_value_2_array[current_event_num][j+uni_chn_base] = extracted_values["_extracted_values"][j][3]
-                        hamming_code_array[current_event_num][_half*3+0] =  packetlib.DaqH_get_H1(extracted_values["_DaqH"])
-                        hamming_code_array[current_event_num][_half*3+1] =  packetlib.DaqH_get_H2(extracted_values["_DaqH"])
-                        hamming_code_array[current_event_num][_half*3+2] =  packetlib.DaqH_get_H3(extracted_values["_DaqH"])
-                    indices_to_delete.update([i, i+1, i+2, i+3])
-                    current_event_num += 1
-                    i += 4
-                else:
-                    if timestamp0 in fragment_life_dict:
-                        if fragment_life_dict[timestamp0] >= _fragment_life - 1:
-                            indices_to_delete.update([i])
-                            del fragment_life_dict[timestamp0]
-                        else:
-                            fragment_life_dict[timestamp0] += 1
-                    else:
-                        fragment_life_dict[timestamp0] = 1
-                    i += 1
-            for index in sorted(indices_to_delete, reverse=True):
-                del event_fragment_pool[index]
-            if current_event_num == _event_num:
-                break;      
-        except Exception as e:
-            _logger.warning("Exception in receiving data")
-            _logger.warning(e)
-            _logger.warning('Packet received: ' + str(current_half_packet_num))
-            _logger.warning('left fragments:' + str(len(event_fragment_pool)))
-            _logger.warning("current event num:" + str(current_event_num))
-            measurement_good_flag = False
-            break
-
-    if not np.all(hamming_code_array == 0):
-        _logger.warning("Hamming code error detected!")
-        measurement_good_flag = False
-    if not packetlib.send_daq_gen_start_stop(_socket_udp, _ip, _port, asic_num=0, fpga_addr = _fpga_address, daq_push=0x00, gen_start_stop=0, daq_start_stop=0x00, verbose=False):
-        _logger.warning("Failed to stop the generator")
-    for _asic in range(2):
-        if not packetlib.send_check_i2c_wrapper(_socket_udp, _ip, _port, asic_num=_asic, fpga_addr = _fpga_address, sub_addr=packetlib.subblock_address_dict["Top"], reg_addr=0x00, data=_reg_offLR, retry=5, verbose=False):
-            _logger.warning(f"Failed to turn off LR for ASIC {_asic}")
-    _val0_mean_list = []
-    _val0_err_list  = []
-    for _chn in range(152):
-        _candidate_values = []
-        for _event in range(_event_num):
-            if np.all(hamming_code_array[_event] == 0):
-                _candidate_values.append(all_chn_value_0_array[_event][_chn])
-        if len(_candidate_values) > 0:
-            _val0_mean_list.append(np.mean(_candidate_values))
-            _val0_err_list.append(np.std(_candidate_values))
-        else:
-            _logger.warning(f"Channel {_chn} has no valid data")
-            _val0_mean_list.append(0)
-            _val0_err_list.append(0)
-    return _val0_mean_list, _val0_err_list
+def measure_v0(_socket_udp, _ip, _port, _fpga_address, _reg_runLR, _reg_offLR, _event_num, _fragment_life, _logger, _target_sem=None, _max_event_num=None, _exclude_channels=(), _idle_timeout=None, _deadline=None):
+    _statistics = packetlib.ChannelStatistics()
+    if _target_sem is None:
+        _measurement = packetlib.measure_events(_socket_udp, _ip, _port, _fpga_address, _reg_runLR, _reg_offLR, _event_num, fragment_life=_fragment_life, statistics=_statistics, store_events=False, idle_timeout=_idle_timeout, deadline=_deadline)
+        if _measurement["event_num"] < _event_num:
+            _logger.warning(f"Only {_measurement['event_num']} of {_event_num} events received ({_measurement['shortfall']['reason']})")
+    else:
+        # bursts of _event_num events until the error on the mean is small enough
+        _measurement = packetlib.measure_until_precision(_socket_udp, _ip, _port, _fpga_address, _reg_runLR, _reg_offLR, _event_num, _target_sem, _max_event_num, exclude_channels=_exclude_channels, fragment_life=_fragment_life, statistics=_statistics, idle_timeout=_idle_timeout, deadline=_deadline)
+        if _measurement["shortfall"] is not None and _measurement["shortfall"]["reason"] != "complete":
+            _logger.warning(f"Burst stopped ({_measurement['shortfall']['reason']} timeout) with {_measurement['event_num']} events")
+        elif not _measurement["converged"]:
+            _logger.warning(f"Pedestal error target not reached with {_measurement['event_num']} events")
+    if _measurement["hamming_error_num"] > 0:
+        _logger.warning(f"Hamming code error detected in {_measurement['hamming_error_num']} events!")
+    if _statistics.event_count == 0:
+        _logger.warning("No valid data for any channel")
+        return [0] * 152, [0] * 152
+    return _statistics.mean("val0").tolist(), _statistics.std("val0").tolist()
 
 def chn_pedestal_draw(_mean_list, _err_list, _title, _y_max=512):
     fig, ax = plt.subplots()
@@ -340,6 +251,19 @@ dead_channels       = []
 gen_nr_cycle        = 10
 gen_interval_value  = 40
 
+# take bursts of sampling_burst_event_num events until the pedestal error on the
+# mean of every used channel is below the target, at most max_sampling_event_num
+# events; set to None for a fixed gen_nr_cycle
+# half an ADC count is finer than a trim step; with a pedestal noise of 1-3 ADC
+# this takes about 4-36 events, so quiet channels stop after one burst and noisy
+# ones get up to ten bursts before the cap
+target_pedestal_sem         = 0.5
+sampling_burst_event_num    = 5
+max_sampling_event_num      = 50
+measurement_burst_event_num = gen_nr_cycle if target_pedestal_sem is None else sampling_burst_event_num
+# a lost half-packet ends the measurement with a shortfall instead of a socket error
+measurement_idle_timeout, measurement_deadline = packetlib.generator_timeouts(measurement_burst_event_num, gen_interval_value, run_num=max_sampling_event_num // measurement_burst_event_num)
+
 gen_fcmd_internal_injection = 0b00101101
 gen_fcmd_L1A                = 0b01001011
 
@@ -366,6 +290,9 @@ output_pedecalib_json['running_parameters'] = {
     'channel_not_used': channel_not_used,
     'dead_channels': dead_channels,
     'gen_nr_cycle': gen_nr_cycle,
+    'target_pedestal_sem': target_pedestal_sem,
+    'sampling_burst_event_num': sampling_burst_event_num,
+    'max_sampling_event_num': max_sampling_event_num,
     'gen_interval_value': gen_interval_value,
     'gen_fcmd_internal_injection': gen_fcmd_internal_injection,
     'gen_fcmd_L1A': gen_fcmd_L1A,
@@ -382,7 +309,7 @@ final_chn_inputdac_list = []
 
 try:
 # * --- Set up the generator --------------------------------------------------
-    if not packetlib.send_check_DAQ_gen_params(socket_udp, h2gcroc_ip, h2gcroc_port, 0x00, fpga_addr=fpga_address, data_coll_en=0x03, trig_coll_en=0x00, daq_fcmd=75, gen_preimp_en=0, gen_pre_interval = 10, gen_nr_of_cycle=gen_nr_cycle, gen_pre_fcmd=75, gen_fcmd=75,gen_interval=gen_interval_value, daq_push_fcmd=75, machine_gun=0x00, verbose=False):
+    if not packetlib.send_check_DAQ_gen_params(socket_udp, h2gcroc_ip, h2gcroc_port, 0x00, fpga_addr=fpga_address, data_coll_en=0x03, trig_coll_en=0x00, daq_fcmd=75, gen_preimp_en=0, gen_pre_interval = 10, gen_nr_of_cycle=measurement_burst_event_num, gen_pre_fcmd=75, gen_fcmd=75,gen_interval=gen_interval_value, daq_push_fcmd=75, machine_gun=0x00, verbose=False):
         logger.warning(f"Failed to set up the generator")
 # * --- Set up the I2C settings -----------------------------------------------
     for _asic in range(total_asic):
@@ -419,7 +346,7 @@ try:
         packetlib.send_check_i2c_wrapper(socket_udp, h2gcroc_ip, h2gcroc_port, asic_num=_asic, fpga_addr = fpga_address, sub_addr=packetlib.subblock_address_dict["HalfWise_1"], reg_addr=0x00, data=_chn_wise, retry=5, verbose=i2c_setting_verbose)
 
     # ! --- Get the initial pedestal values ---
-    initial_chn_pede_list, initial_chn_pede_err = measure_v0(socket_udp, h2gcroc_ip, h2gcroc_port, fpga_address, top_reg_runLR, top_reg_offLR, gen_nr_cycle, fragment_life, logger)
+    initial_chn_pede_list, initial_chn_pede_err = measure_v0(socket_udp, h2gcroc_ip, h2gcroc_port, fpga_address, top_reg_runLR, top_reg_offLR, measurement_burst_event_num, fragment_life, logger, target_pedestal_sem, max_sampling_event_num, channel_not_used + dead_channels, measurement_idle_timeout, measurement_deadline)
     _fig = chn_pedestal_draw(initial_chn_pede_list, initial_chn_pede_err, f"Initial Pedestal Values")
     _fig.savefig(os.path.join(output_dump_folder, f"pede_initial.png"))
 
@@ -463,7 +390,7 @@ try:
 
         time.sleep(0.2)
 
-        inputdac_chn_pede_list, inputdac_chn_err_list = measure_v0(socket_udp, h2gcroc_ip, h2gcroc_port, fpga_address, top_reg_runLR, top_reg_offLR, gen_nr_cycle, fragment_life, logger)
+        inputdac_chn_pede_list, inputdac_chn_err_list = measure_v0(socket_udp, h2gcroc_ip, h2gcroc_port, fpga_address, top_reg_runLR, top_reg_offLR, measurement_burst_event_num, fragment_life, logger, target_pedestal_sem, max_sampling_event_num, channel_not_used + dead_channels, measurement_idle_timeout, measurement_deadline)
         
     fig_res_inputdac = chn_pedestal_draw(inputdac_chn_pede_list, inputdac_chn_err_list, f"InputDAC Pedestal Results")
     fig_res_inputdac.savefig(os.path.join(output_dump_folder, f"pede_inputdac.png"))
@@ -506,7 +433,7 @@ try:
 
         time.sleep(0.2)
 
-        _inv_chn_pede_list, _inv_chn_err_list = measure_v0(socket_udp, h2gcroc_ip, h2gcroc_port, fpga_address, top_reg_runLR, top_reg_offLR, gen_nr_cycle, fragment_life, logger)
+        _inv_chn_pede_list, _inv_chn_err_list = measure_v0(socket_udp, h2gcroc_ip, h2gcroc_port, fpga_address, top_reg_runLR, top_reg_offLR, measurement_burst_event_num, fragment_life, logger, target_pedestal_sem, max_sampling_event_num, channel_not_used + dead_channels, measurement_idle_timeout, measurement_deadline)
 
         _global_mean = [0,0,0,0]
         _global_err  = [0,0,0,0]
@@ -578,7 +505,7 @@ try:
         if not packetlib.send_check_i2c_wrapper(socket_udp, h2gcroc_ip, h2gcroc_port, asic_num=_asic, fpga_addr = fpga_address, sub_addr=packetlib.subblock_address_dict["Reference_Voltage_1"], reg_addr=0x00, data=_ref_voltage_half1, retry=5, verbose=i2c_setting_verbose):
             logger.warning(f"Failed to set Reference_Voltage_Half_1 settings for ASIC {_asic}")
 
-    _temp_chn_pede_list, _temp_chn_pede_err = measure_v0(socket_udp, h2gcroc_ip, h2gcroc_port, fpga_address, top_reg_runLR, top_reg_offLR, gen_nr_cycle, fragment_life, logger)
+    _temp_chn_pede_list, _temp_chn_pede_err = measure_v0(socket_udp, h2gcroc_ip, h2gcroc_port, fpga_address, top_reg_runLR, top_reg_offLR, measurement_burst_event_num, fragment_life, logger, target_pedestal_sem, max_sampling_event_num, channel_not_used + dead_channels, measurement_idle_timeout, measurement_deadline)
     _fig = chn_pedestal_draw(_temp_chn_pede_list, _temp_chn_pede_err, f"Pedestal After Ref Inv")
     _fig.savefig(os.path.join(output_dump_folder, f"pede_ref_inv.png"))
     
@@ -613,7 +540,7 @@ try:
 
         time.sleep(0.2)
 
-        _trim_chn_pede_list, _trim_chn_err_list = measure_v0(socket_udp, h2gcroc_ip, h2gcroc_port, fpga_address, top_reg_runLR, top_reg_offLR, gen_nr_cycle, fragment_life, logger)
+        _trim_chn_pede_list, _trim_chn_err_list = measure_v0(socket_udp, h2gcroc_ip, h2gcroc_port, fpga_address, top_reg_runLR, top_reg_offLR, measurement_burst_event_num, fragment_life, logger, target_pedestal_sem, max_sampling_event_num, channel_not_used + dead_channels, measurement_idle_timeout, measurement_deadline)
 
         scan_trim_res_chn_means.append(_trim_chn_pede_list)
         scan_trim_res_chn_errs.append(_trim_chn_err_list)
@@ -690,7 +617,7 @@ try:
             if not packetlib.send_check_i2c_wrapper(socket_udp, h2gcroc_ip, h2gcroc_port, asic_num=_asic_num, fpga_addr = fpga_address, sub_addr=_sub_addr, reg_addr=0x00, data=_chn_wise, retry=5, verbose=False):
                 logger.warning(f"Failed to set Channel Wise settings for ASIC {_asic_num}")
 
-    _trim_chn_pede_list, _trim_chn_pede_err = measure_v0(socket_udp, h2gcroc_ip, h2gcroc_port, fpga_address, top_reg_runLR, top_reg_offLR, gen_nr_cycle, fragment_life, logger)
+    _trim_chn_pede_list, _trim_chn_pede_err = measure_v0(socket_udp, h2gcroc_ip, h2gcroc_port, fpga_address, top_reg_runLR, top_reg_offLR, measurement_burst_event_num, fragment_life, logger, target_pedestal_sem, max_sampling_event_num, channel_not_used + dead_channels, measurement_idle_timeout, measurement_deadline)
     _fig = chn_pedestal_draw(_trim_chn_pede_list, _trim_chn_pede_err, f"Pedestal After Trim")
     _fig.savefig(os.path.join(output_dump_folder, f"pede_trim.png"))
 
@@ -759,7 +686,7 @@ try:
 
         time.sleep(0.2)
 
-        _trim_chn_pede_list, _trim_chn_pede_err = measure_v0(socket_udp, h2gcroc_ip, h2gcroc_port, fpga_address, top_reg_runLR, top_reg_offLR, gen_nr_cycle, fragment_life, logger)
+        _trim_chn_pede_list, _trim_chn_pede_err = measure_v0(socket_udp, h2gcroc_ip, h2gcroc_port, fpga_address, top_reg_runLR, top_reg_offLR, measurement_burst_event_num, fragment_life, logger, target_pedestal_sem, max_sampling_event_num, channel_not_used + dead_channels, measurement_idle_timeout, measurement_deadline)
 
         if _retry == _ref_inv_tunning_retry - 1:
             logger.warning(f"Ref inv tuning did not converge after {_ref_inv_tunning_retry} tries")
@@ -818,7 +745,7 @@ try:
 
         time.sleep(0.2)
 
-        _trim_chn_pede_list, _trim_chn_pede_err = measure_v0(socket_udp, h2gcroc_ip, h2gcroc_port, fpga_address, top_reg_runLR, top_reg_offLR, gen_nr_cycle, fragment_life, logger)
+        _trim_chn_pede_list, _trim_chn_pede_err = measure_v0(socket_udp, h2gcroc_ip, h2gcroc_port, fpga_address, top_reg_runLR, top_reg_offLR, measurement_burst_event_num, fragment_life, logger, target_pedestal_sem, max_sampling_event_num, channel_not_used + dead_channels, measurement_idle_timeout, measurement_deadline)
 
     _fig = chn_pedestal_draw(_trim_chn_pede_list, _trim_chn_pede_err, f"Final Pedestal")
     _fig.savefig(os.path.join(output_dump_folder, f"pede_final.png"))
@@ -837,9 +764,11 @@ output_pedecalib_json["chn_inputdac_settings"]  = final_chn_inputdac_list
 output_pedecalib_json["dead_channels"]          = dead_channels
 output_pedecalib_json["channel_not_used"]       = channel_not_used
 output_pedecalib_json["pede_values"]            = _trim_chn_pede_list
+output_pedecalib_json["pede_noise"]             = _trim_chn_pede_err
 
 with open(output_pedecalib_path, 'w') as f:
     json.dump(output_pedecalib_json, f, indent=4)
+packetlib.register_calib_file(output_pedecalib_path, packetlib.calib_type_pedestal, output_pedecalib_json['udp']['h2gcroc_ip'])
 
 with open(output_config_path, 'w') as f:
     json.dump(output_config_json, f, indent=4)
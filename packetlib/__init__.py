@@ -2,4 +2,25 @@ from .packet import *
 from .socket_wrapper import *
 from .register_settings import *
 from .data_packet import *
-from .pedestal import *
\ No newline at end of file
+from .pedestal import *
+from .scan_journal import *
+from .iodelay import *
+from .calib_catalog import *
+from .acquisition import *
+from .scan import *
+from .statistics import *
+from .histogram import *
+from .channel_gallery import *
+from .decoder import *
+from .run_file import *
+from .export import *
+from .event_index import *
+from .phase_series import *
+from .monitor import *
+from .zero_suppression import *
+from .compressed_stream import *
+from .run_segments import *
+from .loss_accounting import *
+from .run_report import *
+from .buffered_writer import *
+from .board_receiver import *
\ No newline at end of file
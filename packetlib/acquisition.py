@@ -0,0 +1,392 @@
+from .socket_wrapper import *
+from .data_packet import *
+from .statistics import *
+import socket
+import time
+import numpy as np
+
+# length of one generator interval tick, the gen_interval of the generator settings counts these
+generator_clock_seconds = 25e-9
+
+def generator_timeouts(gen_nr_cycle, gen_interval, machine_gun_val=0, run_num=1, idle_factor=20.0, min_idle=1.0, deadline_factor=2.0, min_deadline=10.0):
+    """ Return (idle timeout, deadline) in seconds for run_num generator runs.
+
+    Every run sends gen_nr_cycle bursts of machine_gun_val + 1 triggers, one
+    burst every gen_interval ticks. The idle timeout is idle_factor burst
+    intervals, at least min_idle; the deadline is deadline_factor times the
+    expected duration of all runs plus one idle timeout, at least
+    min_deadline.
+    """
+    _interval_seconds = gen_interval * generator_clock_seconds
+    idle_timeout = max(min_idle, idle_factor * _interval_seconds)
+    deadline = max(min_deadline, deadline_factor * run_num * gen_nr_cycle * _interval_seconds + idle_timeout)
+    return idle_timeout, deadline
+
+def acquisition_shortfall(requested_num, received_num, stop_reason, elapsed_seconds, dropped_num=0, pending_num=0):
+    """ Summarise how an acquisition ended: stop_reason is None for a complete run, 'idle' or 'deadline'. """
+    return {
+        "requested": requested_num,
+        "received": received_num,
+        "missing": max(requested_num - received_num, 0),
+        "reason": "complete" if stop_reason is None else stop_reason,
+        "elapsed_seconds": elapsed_seconds,
+        "dropped_incomplete": dropped_num,
+        "pending_incomplete": pending_num
+    }
+
+def fragment_half_index(event_fragment):
+    # 0-3 for ASIC 0 half 0, ASIC 0 half 1, ASIC 1 half 0, ASIC 1 half 1
+    return (event_fragment[0][0] - 0xA0) * 2 + (event_fragment[0][2] - 0x24)
+
+def fragment_timestamp(event_fragment):
+    return int.from_bytes(event_fragment[0][4:8], byteorder='big', signed=False)
+
+class EventBuilder:
+    """ Group half-packet fragments into events by board and timestamp.
+
+    add_fragment returns the four halves once an event is complete; age drops
+    the incomplete events that waited for more than fragment_life steps.
+    """
+    def __init__(self, fragment_life=5):
+        self.fragment_life = fragment_life
+        self.pending_fragments = {}
+        self.fragment_life_dict = {}
+        self.half_packet_num = 0
+        self.dropped_event_num = 0
+
+    def add_fragment(self, event_fragment):
+        """ Add a half-packet, return (event_key, {half_index: fragment}) if it completes an event, else None. """
+        self.half_packet_num += 1
+        _event_key = (event_fragment[0][1], fragment_timestamp(event_fragment))
+        _halves = self.pending_fragments.setdefault(_event_key, {})
+        _halves[fragment_half_index(event_fragment)] = event_fragment
+        if len(_halves) < 4:
+            return None
+        del self.pending_fragments[_event_key]
+        self.fragment_life_dict.pop(_event_key, None)
+        return _event_key, _halves
+
+    def age(self):
+        for _event_key in list(self.pending_fragments.keys()):
+            self.fragment_life_dict[_event_key] = self.fragment_life_dict.get(_event_key, 0) + 1
+            if self.fragment_life_dict[_event_key] >= self.fragment_life:
+                del self.pending_fragments[_event_key]
+                del self.fragment_life_dict[_event_key]
+                self.dropped_event_num += 1
+
+class DualBoardEventBuilder:
+    """ Build the events of each board and merge the events of all boards by timestamp.
+
+    An event of one board is matched with the events of the other boards
+    whose timestamps differ by at most timestamp_tolerance (modulo the
+    2**30 counter period). add_fragment returns the merged events, each a
+    dict board -> (event_key, halves); board events that found no partner
+    within event_life age steps are counted as orphans.
+    """
+    def __init__(self, boards=(0, 1), timestamp_tolerance=0, fragment_life=5, event_life=10, timestamp_period=2**30):
+        self.boards = tuple(boards)
+        self.timestamp_tolerance = timestamp_tolerance
+        self.event_life = event_life
+        self.timestamp_period = timestamp_period
+        self.board_builders = {_board: EventBuilder(fragment_life) for _board in self.boards}
+        self.pending_events = {_board: {} for _board in self.boards}
+        self.pending_event_life = {_board: {} for _board in self.boards}
+        self.merged_event_num = 0
+        self.orphan_event_num = {_board: 0 for _board in self.boards}
+
+    def _find_partner(self, board, timestamp):
+        for _offset in range(self.timestamp_tolerance + 1):
+            for _timestamp in {(timestamp - _offset) % self.timestamp_period, (timestamp + _offset) % self.timestamp_period}:
+                if _timestamp in self.pending_events[board]:
+                    return _timestamp
+        return None
+
+    def add_fragment(self, event_fragment):
+        """ Add a half-packet, return the list of events it completes on all boards. """
+        _board = event_fragment[0][1]
+        if _board not in self.board_builders:
+            return []
+        _event = self.board_builders[_board].add_fragment(event_fragment)
+        if _event is None:
+            return []
+        _timestamp = _event[0][1] % self.timestamp_period
+        _partners = {}
+        for _other_board in self.boards:
+            if _other_board == _board:
+                continue
+            _partner_timestamp = self._find_partner(_other_board, _timestamp)
+            if _partner_timestamp is None:
+                self.pending_events[_board][_timestamp] = _event
+                self.pending_event_life[_board][_timestamp] = 0
+                return []
+            _partners[_other_board] = _partner_timestamp
+        merged_event = {_board: _event}
+        for _other_board, _partner_timestamp in _partners.items():
+            merged_event[_other_board] = self.pending_events[_other_board].pop(_partner_timestamp)
+            del self.pending_event_life[_other_board][_partner_timestamp]
+        self.merged_event_num += 1
+        return [{_key: merged_event[_key] for _key in self.boards}]
+
+    def age(self):
+        for _board in self.boards:
+            self.board_builders[_board].age()
+            _life = self.pending_event_life[_board]
+            for _timestamp in list(_life.keys()):
+                _life[_timestamp] += 1
+                if _life[_timestamp] >= self.event_life:
+                    del _life[_timestamp]
+                    del self.pending_events[_board][_timestamp]
+                    self.orphan_event_num[_board] += 1
+
+    def flush(self):
+        """ Count the events still waiting for a partner as orphans. """
+        for _board in self.boards:
+            self.orphan_event_num[_board] += len(self.pending_events[_board])
+            self.pending_events[_board].clear()
+            self.pending_event_life[_board].clear()
+
+    def dropped_event_num(self):
+        """ Incomplete board events dropped by the per-board event builders, per board. """
+        return {_board: self.board_builders[_board].dropped_event_num for _board in self.boards}
+
+def decode_event(halves):
+    """ Decode the halves of one event into values (3, 152), hamming bits (12) and the DaqH of each half. """
+    event_values  = np.zeros((3, 152))
+    event_hamming = np.zeros(12)
+    event_daqh    = [None] * 4
+    for _half_index, _fragment in halves.items():
+        extracted_data = assemble_data_from_40bytes(_fragment, verbose=False)
+        extracted_values = extract_values(extracted_data["_extraced_160_bytes"], verbose=False)
+        uni_chn_base = _half_index * 38
+        _values = np.array(extracted_values["_extracted_values"])
+        event_values[:, uni_chn_base:uni_chn_base+len(_values)] = _values[:, 1:4].T
+        event_hamming[_half_index*3+0] = DaqH_get_H1(extracted_values["_DaqH"])
+        event_hamming[_half_index*3+1] = DaqH_get_H2(extracted_values["_DaqH"])
+        event_hamming[_half_index*3+2] = DaqH_get_H3(extracted_values["_DaqH"])
+        event_daqh[_half_index] = extracted_values["_DaqH"]
+    return event_values, event_hamming, event_daqh
+
+def set_top_register(_socket, addr, port, fpga_addr, reg_content, verbose=False):
+    """ Write the Top register (e.g. runLR / offLR) of both ASICs. """
+    write_ok = True
+    for _asic in range(2):
+        if not send_check_i2c_wrapper(_socket, addr, port, asic_num=_asic, fpga_addr=fpga_addr, sub_addr=subblock_address_dict["Top"], reg_addr=0x00, data=reg_content, retry=5, verbose=False):
+            write_ok = False
+            if verbose:
+                print('\033[33m' + "Warning: failed to set Top register for ASIC " + str(_asic) + '\033[0m')
+    return write_ok
+
+def start_generator(_socket, addr, port, fpga_addr, verbose=False):
+    clean_socket(_socket)
+    if not send_daq_gen_start_stop(_socket, addr, port, asic_num=0, fpga_addr=fpga_addr, daq_push=0x00, gen_start_stop=1, daq_start_stop=0xFF, verbose=False):
+        if verbose:
+            print('\033[33m' + "Warning: failed to start the generator" + '\033[0m')
+        return False
+    return True
+
+def stop_generator(_socket, addr, port, fpga_addr, verbose=False):
+    if not send_daq_gen_start_stop(_socket, addr, port, asic_num=0, fpga_addr=fpga_addr, daq_push=0x00, gen_start_stop=0, daq_start_stop=0x00, verbose=False):
+        if verbose:
+            print('\033[33m' + "Warning: failed to stop the generator" + '\033[0m')
+        return False
+    return True
+
+def start_generator_run(_socket, addr, port, fpga_addr, reg_runLR, verbose=False):
+    """ Turn on the Top runLR register of both ASICs and start the generator. """
+    run_ok = set_top_register(_socket, addr, port, fpga_addr, reg_runLR, verbose=verbose)
+    return start_generator(_socket, addr, port, fpga_addr, verbose=verbose) and run_ok
+
+def stop_generator_run(_socket, addr, port, fpga_addr, reg_offLR, verbose=False):
+    """ Stop the generator and turn off the Top runLR register of both ASICs. """
+    stop_ok = stop_generator(_socket, addr, port, fpga_addr, verbose=verbose)
+    return set_top_register(_socket, addr, port, fpga_addr, reg_offLR, verbose=verbose) and stop_ok
+
+def collect_events(_socket, event_num, fragment_life=5, statistics=None, store_events=True, idle_timeout=None, deadline=None, verbose=False):
+    """ Receive half-packets and build events until event_num events are complete.
+
+    An event is complete when the four halves of one board carry the same
+    timestamp. Halves that stay incomplete for fragment_life datagrams are
+    dropped. Returns the per-channel values (event_num, 152), the DaqH hamming
+    bits (event_num, 12), the event timestamps and the number of built events;
+    'good' is False if the socket timed out or a hamming error was seen.
+    The events without hamming errors of each datagram are merged into the
+    optional ChannelStatistics as they arrive; with store_events=False the
+    per-event arrays are not kept and the value entries are None.
+
+    Without idle_timeout and deadline the socket's own timeout ends the
+    acquisition. With them, it ends after idle_timeout seconds without a
+    datagram or deadline seconds after the start, whichever comes first,
+    and returns the complete events received so far; 'shortfall' tells how
+    many are missing and why (see acquisition_shortfall).
+    """
+    all_chn_value_0_array = np.zeros((event_num, 152)) if store_events else None
+    all_chn_value_1_array = np.zeros((event_num, 152)) if store_events else None
+    all_chn_value_2_array = np.zeros((event_num, 152)) if store_events else None
+    hamming_code_array    = np.zeros((event_num, 12)) if store_events else None
+    timestamp_array       = np.zeros(event_num, dtype=np.uint32) if store_events else None
+    hamming_error_num     = 0
+
+    extracted_payloads_pool = []
+    event_builder           = EventBuilder(fragment_life)
+    current_event_num       = 0
+    measurement_good_flag   = True
+    stop_reason             = None
+
+    _previous_timeout = _socket.gettimeout()
+    _start_time = time.monotonic()
+    if idle_timeout is not None:
+        _socket.settimeout(idle_timeout)
+    while current_event_num < event_num:
+        if deadline is not None:
+            _remaining = _start_time + deadline - time.monotonic()
+            if _remaining <= 0:
+                stop_reason = "deadline"
+                measurement_good_flag = False
+                break
+            _socket.settimeout(_remaining if idle_timeout is None else min(idle_timeout, _remaining))
+        try:
+            data_packet, rec_addr = _socket.recvfrom(8192)
+        except socket.timeout:
+            stop_reason = "deadline" if deadline is not None and time.monotonic() - _start_time >= deadline else "idle"
+            if verbose:
+                print('\033[33m' + "Warning: UDP timeout (" + stop_reason + "), " + str(current_event_num) + " of " + str(event_num) + " events received" + '\033[0m')
+            measurement_good_flag = False
+            break
+        extracted_payloads_pool += extract_raw_payloads(data_packet)
+        _batch_values = []
+        while len(extracted_payloads_pool) >= 5:
+            is_packet_good, event_fragment = check_event_fragment(extracted_payloads_pool[:5])
+            if not is_packet_good:
+                extracted_payloads_pool = extracted_payloads_pool[1:]
+                continue
+            extracted_payloads_pool = extracted_payloads_pool[5:]
+            _event = event_builder.add_fragment(event_fragment)
+            if _event is None or current_event_num >= event_num:
+                continue
+            _event_key, _halves = _event
+            _event_values, _event_hamming, _event_daqh = decode_event(_halves)
+            if np.all(_event_hamming == 0):
+                _batch_values.append(_event_values)
+            else:
+                hamming_error_num += 1
+            if store_events:
+                all_chn_value_0_array[current_event_num] = _event_values[0]
+                all_chn_value_1_array[current_event_num] = _event_values[1]
+                all_chn_value_2_array[current_event_num] = _event_values[2]
+                hamming_code_array[current_event_num]    = _event_hamming
+                timestamp_array[current_event_num]       = _event_key[1]
+            current_event_num += 1
+        if statistics is not None and len(_batch_values) > 0:
+            _batch_values = np.array(_batch_values)
+            statistics.update(_batch_values[:, 0], _batch_values[:, 1], _batch_values[:, 2])
+        # age the incomplete events once per datagram
+        event_builder.age()
+    if idle_timeout is not None or deadline is not None:
+        _socket.settimeout(_previous_timeout)
+
+    if hamming_error_num > 0:
+        measurement_good_flag = False
+        if verbose:
+            print('\033[33m' + "Warning: hamming code error detected" + '\033[0m')
+
+    return {
+        "val0": all_chn_value_0_array,
+        "val1": all_chn_value_1_array,
+        "val2": all_chn_value_2_array,
+        "hamming": hamming_code_array,
+        "timestamps": timestamp_array,
+        "event_num": current_event_num,
+        "hamming_error_num": hamming_error_num,
+        "half_packet_num": event_builder.half_packet_num,
+        "shortfall": acquisition_shortfall(event_num, current_event_num, stop_reason, time.monotonic() - _start_time, event_builder.dropped_event_num, len(event_builder.pending_fragments)),
+        "good": measurement_good_flag
+    }
+
+def measure_events(_socket, addr, port, fpga_addr, reg_runLR, reg_offLR, event_num, fragment_life=5, statistics=None, store_events=True, idle_timeout=None, deadline=None, verbose=False):
+    """ Run the generator once with the given Top registers and return the built events. """
+    start_generator_run(_socket, addr, port, fpga_addr, reg_runLR, verbose=verbose)
+    try:
+        measurement = collect_events(_socket, event_num, fragment_life=fragment_life, statistics=statistics, store_events=store_events, idle_timeout=idle_timeout, deadline=deadline, verbose=verbose)
+    finally:
+        stop_generator_run(_socket, addr, port, fpga_addr, reg_offLR, verbose=verbose)
+    return measurement
+
+def expand_channel_target(target, channel_num=152):
+    """ Expand a scalar, per-half (4) or per-channel target to one value per channel. """
+    target = np.asarray(target, dtype=float)
+    if target.ndim == 0:
+        return np.full(channel_num, float(target))
+    if len(target) == 4:
+        return np.repeat(target, channel_num // 4)
+    return target
+
+def measure_until_precision(_socket, addr, port, fpga_addr, reg_runLR, reg_offLR, burst_event_num, target_sem, max_event_num, exclude_channels=(), value_name="val0", fragment_life=5, statistics=None, idle_timeout=None, deadline=None, verbose=False):
+    """ Acquire generator bursts until every checked channel reaches the target standard error.
+
+    The generator must already be set up to produce burst_event_num events per
+    start. Bursts are taken with runLR kept on until the standard error of the
+    mean of value_name is at most target_sem (scalar, per half or per channel)
+    for all channels not in exclude_channels, or until max_event_num events
+    have been requested. idle_timeout applies to every burst and deadline
+    (seconds) to all bursts together; the loop also stops at the deadline or
+    after a burst without any event. Returns the
+    ChannelStatistics, the number of received events and bursts, whether the
+    target was reached and the shortfall of the last burst.
+    """
+    if statistics is None:
+        statistics = ChannelStatistics()
+    _target = expand_channel_target(target_sem, statistics.channel_num)
+    _checked = np.isfinite(_target)
+    _checked[[_chn for _chn in exclude_channels if _chn < statistics.channel_num]] = False
+
+    requested_event_num = 0
+    received_event_num  = 0
+    hamming_error_num   = 0
+    burst_num           = 0
+    converged           = False
+    measurement_good_flag = True
+    shortfall           = None
+
+    _start_time = time.monotonic()
+    set_top_register(_socket, addr, port, fpga_addr, reg_runLR, verbose=verbose)
+    try:
+        while requested_event_num < max_event_num:
+            _remaining = None
+            if deadline is not None:
+                _remaining = _start_time + deadline - time.monotonic()
+                if _remaining <= 0:
+                    break
+            start_generator(_socket, addr, port, fpga_addr, verbose=verbose)
+            try:
+                _measurement = collect_events(_socket, burst_event_num, fragment_life=fragment_life, statistics=statistics, store_events=False, idle_timeout=idle_timeout, deadline=_remaining, verbose=verbose)
+            finally:
+                stop_generator(_socket, addr, port, fpga_addr, verbose=verbose)
+            requested_event_num += burst_event_num
+            received_event_num  += _measurement["event_num"]
+            hamming_error_num   += _measurement["hamming_error_num"]
+            burst_num += 1
+            shortfall = _measurement["shortfall"]
+            if not _measurement["good"]:
+                measurement_good_flag = False
+            if shortfall["reason"] == "deadline":
+                break
+            if _measurement["event_num"] == 0:
+                # the board stopped sending, more bursts will not help
+                break
+            if np.all(statistics.sem(value_name)[_checked] <= _target[_checked]):
+                converged = True
+                break
+    finally:
+        set_top_register(_socket, addr, port, fpga_addr, reg_offLR, verbose=verbose)
+
+    if not converged and verbose:
+        print('\033[33m' + "Warning: target precision not reached after " + str(received_event_num) + " events" + '\033[0m')
+    return {
+        "statistics": statistics,
+        "event_num": received_event_num,
+        "hamming_error_num": hamming_error_num,
+        "burst_num": burst_num,
+        "converged": converged,
+        "shortfall": shortfall,
+        "good": measurement_good_flag
+    }
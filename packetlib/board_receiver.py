@@ -0,0 +1,183 @@
+from .data_packet import *
+from .loss_accounting import *
+from .monitor import *
+from .run_report import *
+import multiprocessing
+import multiprocessing.shared_memory
+import queue
+import socket
+import time
+
+def open_board_socket(pc_ip, pc_port, board_ip, board_port, receive_buffer=None):
+    """ Open a UDP socket on the shared DAQ port that only receives the datagrams of one board.
+
+    The socket is bound with SO_REUSEPORT and connected to the board, so the
+    kernel delivers that board's datagrams to it rather than to the
+    unconnected control socket on the same port, which also needs
+    SO_REUSEPORT set before it is bound.
+    """
+    _socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    _socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    if receive_buffer is not None:
+        _socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+    _socket.bind((pc_ip, pc_port))
+    _socket.connect((board_ip, board_port))
+    return _socket
+
+def _board_receiver_worker(board, board_address, local_address, shared_block, block_lines, free_slots, filled_slots, stop_event, monitor_port, flush_seconds, receive_buffer):
+    _socket = open_board_socket(local_address[0], local_address[1], board_address[0], board_address[1], receive_buffer)
+    _socket.settimeout(0.1)
+    _monitor_sender = None if monitor_port is None else MonitorSender(port=monitor_port, max_rate=100)
+    _accounting = PacketAccounting()
+    _stats = {"datagram_num": 0, "byte_num": 0, "decode_seconds": 0.0, "slot_wait_seconds": 0.0, "kernel_drop_num": None}
+    _kernel_drops_start = udp_socket_drops(_socket)
+    _pool = []
+    _slot = None
+    _slot_lines = 0
+    _last_handoff = time.monotonic()
+
+    def _next_slot():
+        # wait for the main process to give a slot back, unless the run is over
+        _wait_start = time.perf_counter()
+        _slot = None
+        while _slot is None and not stop_event.is_set():
+            try:
+                _slot = free_slots.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        _stats["slot_wait_seconds"] += time.perf_counter() - _wait_start
+        return _slot
+
+    _slot = _next_slot()
+    while _slot is not None and not stop_event.is_set():
+        try:
+            _data = _socket.recv(65536)
+        except socket.timeout:
+            _data = None
+        if _data is not None:
+            _decode_start = time.perf_counter()
+            _stats["datagram_num"] += 1
+            _stats["byte_num"] += len(_data)
+            if _monitor_sender is not None:
+                _monitor_sender.offer(_data)
+            _payloads = extract_raw_payloads(_data)
+            _accounting.add_datagram(_data, _payloads)
+            _pool += _payloads
+            while len(_pool) >= 5:
+                _is_packet_good, _event_fragment = check_event_fragment(_pool[:5])
+                if not _is_packet_good:
+                    _pool = _pool[1:]
+                    _accounting.parser_skipped_line_num += 1
+                    continue
+                _pool = _pool[5:]
+                _offset = (_slot * block_lines + _slot_lines) * 40
+                shared_block.buf[_offset:_offset + 200] = b''.join(_event_fragment)
+                _slot_lines += 5
+                if _slot_lines + 5 > block_lines:
+                    filled_slots.put((board, _slot, _slot_lines, _accounting.loss_summary()))
+                    _slot_lines = 0
+                    _last_handoff = time.monotonic()
+                    _slot = _next_slot()
+                    if _slot is None:
+                        break
+            _stats["decode_seconds"] += time.perf_counter() - _decode_start
+        # hand partly filled slots over regularly, so a slow trigger does not hold data back
+        if _slot is not None and _slot_lines > 0 and time.monotonic() - _last_handoff >= flush_seconds:
+            filled_slots.put((board, _slot, _slot_lines, _accounting.loss_summary()))
+            _slot_lines = 0
+            _last_handoff = time.monotonic()
+            _slot = _next_slot()
+    if _slot is not None and _slot_lines > 0:
+        filled_slots.put((board, _slot, _slot_lines, _accounting.loss_summary()))
+    _kernel_drops_end = udp_socket_drops(_socket)
+    if _kernel_drops_start is not None and _kernel_drops_end is not None:
+        _stats["kernel_drop_num"] = _kernel_drops_end - _kernel_drops_start
+    _socket.close()
+    if _monitor_sender is not None:
+        _monitor_sender.close()
+    filled_slots.put((board, None, _stats, _accounting))
+
+class BoardReceiverPool:
+    """ Receive and decode the datagrams of every board in its own process.
+
+    boards is a list of (board, board ip, board port). Every receiver process
+    opens its own socket with open_board_socket, finds the half-packets in
+    the datagrams and copies their raw 40-byte lines into slots of a shared
+    memory block of slot_num x block_lines lines per board. Filled slots are
+    handed to the main process through a queue and come back through a free
+    slot queue once get_block has copied them, so decoding scales with the
+    number of boards while the writer and event builder stay in one process.
+    """
+    def __init__(self, boards, pc_ip, pc_port, block_lines=4000, slot_num=8, monitor_port=None, flush_seconds=0.2, receive_buffer=None):
+        self.boards = list(boards)
+        self.local_address = (pc_ip, pc_port)
+        self.block_lines = block_lines
+        self.slot_num = slot_num
+        self.monitor_port = monitor_port
+        self.flush_seconds = flush_seconds
+        self.receive_buffer = receive_buffer
+        self.stats = {}
+        self.accounting = {}
+        self.loss_summaries = {}
+        self._context = multiprocessing.get_context('fork')
+        self._stop_event = self._context.Event()
+        self._filled_slots = self._context.Queue()
+        self._shared_blocks = {}
+        self._free_slots = {}
+        self._processes = []
+
+    def start(self):
+        for _board, _board_ip, _board_port in self.boards:
+            _shared_block = multiprocessing.shared_memory.SharedMemory(create=True, size=self.slot_num * self.block_lines * 40)
+            _free_slots = self._context.Queue()
+            for _slot in range(self.slot_num):
+                _free_slots.put(_slot)
+            self._shared_blocks[_board] = _shared_block
+            self._free_slots[_board] = _free_slots
+            _process = self._context.Process(target=_board_receiver_worker, args=(_board, (_board_ip, _board_port), self.local_address, _shared_block, self.block_lines, _free_slots, self._filled_slots, self._stop_event, self.monitor_port, self.flush_seconds, self.receive_buffer), daemon=True)
+            _process.start()
+            self._processes.append(_process)
+
+    def _handle_message(self, message):
+        _board, _slot, _content, _extra = message
+        if _slot is None:
+            self.stats[_board] = _content
+            self.accounting[_board] = _extra
+            return None
+        _offset = _slot * self.block_lines * 40
+        _data = bytes(self._shared_blocks[_board].buf[_offset:_offset + _content * 40])
+        self._free_slots[_board].put(_slot)
+        self.loss_summaries[_board] = _extra
+        return _board, _data
+
+    def get_block(self, timeout=None):
+        """ Return (board, raw lines as bytes) of the next filled slot, whole half-packets only, or None after timeout seconds without data. """
+        _deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                _message = self._filled_slots.get(timeout=None if _deadline is None else max(_deadline - time.monotonic(), 0))
+            except queue.Empty:
+                return None
+            _block = self._handle_message(_message)
+            if _block is not None:
+                return _block
+
+    def stop(self, timeout=5.0):
+        """ Stop the receivers, collect their statistics and packet accounting and free the shared memory; data still in flight is dropped. """
+        self._stop_event.set()
+        _deadline = time.monotonic() + timeout
+        while len(self.stats) < len(self._processes) and time.monotonic() < _deadline:
+            try:
+                self._handle_message(self._filled_slots.get(timeout=max(_deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        for _process in self._processes:
+            _process.join(timeout=1.0)
+            if _process.is_alive():
+                _process.terminate()
+        for _shared_block in self._shared_blocks.values():
+            _shared_block.close()
+            _shared_block.unlink()
+        self._processes = []
+        self._shared_blocks = {}
+        return self.stats
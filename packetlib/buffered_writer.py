@@ -0,0 +1,214 @@
+import os
+import queue
+import threading
+import time
+import numpy as np
+
+# "XX " for every byte value; the last space of a 40-byte line becomes the newline
+_hex_byte_table = np.array([list(f"{_byte:02X} ".encode()) for _byte in range(256)], dtype=np.uint8)
+
+def raw_lines_hex_text(data):
+    """ Format raw 40-byte lines as the hex text lines of a run file, in one vectorized pass. """
+    _text = _hex_byte_table[np.frombuffer(data, dtype=np.uint8)].reshape(-1, 120)
+    _text[:, 119] = ord('\n')
+    return _text.tobytes()
+
+class BufferedRunWriter:
+    """ Collect raw 40-byte lines in preallocated blocks and write them as run file text on a worker thread.
+
+    add_lines copies the lines of one record (a half-packet or an event) into
+    the current block; a full block is handed to the worker thread, which
+    formats it with raw_lines_hex_text and writes it with one write call.
+    buffer_num blocks are allocated once and recycled, so add_lines waits
+    when the worker is that far behind. When the output has end_record (a
+    segmented output), the worker writes record by record and marks every
+    record end. A block that is older than flush_seconds is written by the
+    worker thread even if it is not full, so a run with a slow trigger still
+    reaches the disk; None waits for full blocks. sync is None, 'block' (fsync
+    after every block) or 'close' (fsync once at close); fadvise drops the
+    written pages from the page cache after every block. The output file
+    itself is not closed.
+    """
+    def __init__(self, output_file, block_lines=65536, buffer_num=4, sync=None, fadvise=False, flush_seconds=1.0):
+        if sync not in (None, 'block', 'close'):
+            raise ValueError("Unknown sync policy " + str(sync))
+        self.output_file = output_file
+        self.block_lines = block_lines
+        self.sync = sync
+        self.fadvise = fadvise and hasattr(os, 'posix_fadvise')
+        self.flush_seconds = flush_seconds
+        self.block_num = 0
+        self.line_num = 0
+        self.write_seconds = 0.0
+        self.max_block_seconds = 0.0
+        self.queue_high_water = 0
+        self.error = None
+        self._record_output = hasattr(output_file, 'end_record')
+        self._free_buffers = queue.Queue()
+        for _ in range(buffer_num):
+            self._free_buffers.put(bytearray(block_lines * 40))
+        self._buffer = self._free_buffers.get()
+        self._buffer_lines = 0
+        self._buffer_start = None
+        self._records = []
+        # the worker thread takes the current block when it is too old, so it is swapped under this lock
+        self._buffer_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._write_blocks, daemon=True)
+        self._worker.start()
+
+    def _file_descriptor(self):
+        try:
+            return self.output_file.fileno()
+        except (AttributeError, OSError, ValueError):
+            return None
+
+    def _sync_file(self):
+        _fd = self._file_descriptor()
+        if _fd is None:
+            return
+        self.output_file.flush()
+        if self.sync is not None:
+            os.fsync(_fd)
+        if self.fadvise:
+            os.posix_fadvise(_fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+    def _write_block(self, _buffer, _line_num, _records):
+        if self.error is None:
+            try:
+                _start_time = time.perf_counter()
+                _text = raw_lines_hex_text(memoryview(_buffer)[:_line_num * 40]).decode()
+                if self._record_output:
+                    _position = 0
+                    for _record_lines, _timestamp in _records:
+                        self.output_file.write(_text[_position:_position + _record_lines * 120])
+                        self.output_file.end_record(_timestamp)
+                        _position += _record_lines * 120
+                else:
+                    self.output_file.write(_text)
+                if self.sync == 'block' or self.fadvise:
+                    self._sync_file()
+                elif self.flush_seconds is not None:
+                    # hand the text to the operating system, a reader of the live file sees it
+                    self.output_file.flush()
+                _block_seconds = time.perf_counter() - _start_time
+                self.write_seconds += _block_seconds
+                self.max_block_seconds = max(self.max_block_seconds, _block_seconds)
+                self.block_num += 1
+                self.line_num += _line_num
+            except Exception as e:
+                self.error = e
+        self._free_buffers.put(_buffer)
+
+    def _take_old_block(self):
+        # called by the worker thread when it is idle: take the current block if it waited too long;
+        # if the main thread holds the lock it is adding lines and the block is taken next time
+        if not self._buffer_lock.acquire(blocking=False):
+            return None
+        try:
+            if self._buffer_lines == 0 or time.monotonic() - self._buffer_start < self.flush_seconds:
+                return None
+            try:
+                _free_buffer = self._free_buffers.get_nowait()
+            except queue.Empty:
+                return None
+            _item = (self._buffer, self._buffer_lines, self._records)
+            self._buffer = _free_buffer
+            self._buffer_lines = 0
+            self._records = []
+            return _item
+        finally:
+            self._buffer_lock.release()
+
+    def _write_blocks(self):
+        while True:
+            try:
+                _item = self._queue.get(timeout=self.flush_seconds)
+            except queue.Empty:
+                _item = self._take_old_block()
+                if _item is not None:
+                    self._write_block(*_item)
+                continue
+            if _item is None:
+                break
+            self._write_block(*_item)
+
+    def add_lines(self, lines, timestamp=None):
+        """ Add the raw 40-byte lines of one record; timestamp is passed to end_record of a segmented output. """
+        _line_num = len(lines)
+        with self._buffer_lock:
+            if self._buffer_lines + _line_num > self.block_lines:
+                self._hand_over()
+            if self._buffer_lines == 0:
+                self._buffer_start = time.monotonic()
+            _start = self._buffer_lines * 40
+            self._buffer[_start:_start + _line_num * 40] = b''.join(lines)
+            self._buffer_lines += _line_num
+            if self._record_output:
+                self._records.append((_line_num, timestamp))
+
+    def add_block(self, data, record_lines=5):
+        """ Add raw lines that are whole records of record_lines lines each, e.g. the half-packets of a receiver process. """
+        _record_size = record_lines * 40
+        with self._buffer_lock:
+            if self._buffer_lines == 0 and len(data) > 0:
+                self._buffer_start = time.monotonic()
+            if self._record_output:
+                # a segmented output needs the record ends, the timestamp is in the first line of every record
+                for _offset in range(0, len(data), _record_size):
+                    if self._buffer_lines + record_lines > self.block_lines:
+                        self._hand_over()
+                        self._buffer_start = time.monotonic()
+                    _start = self._buffer_lines * 40
+                    self._buffer[_start:_start + _record_size] = data[_offset:_offset + _record_size]
+                    self._buffer_lines += record_lines
+                    self._records.append((record_lines, int.from_bytes(data[_offset + 4:_offset + 8], byteorder='big')))
+                return
+            _line_num = len(data) // 40
+            _position = 0
+            while _position < _line_num:
+                _copy_lines = min(_line_num - _position, self.block_lines - self._buffer_lines)
+                if _copy_lines == 0:
+                    self._hand_over()
+                    self._buffer_start = time.monotonic()
+                    continue
+                _start = self._buffer_lines * 40
+                self._buffer[_start:_start + _copy_lines * 40] = data[_position * 40:(_position + _copy_lines) * 40]
+                self._buffer_lines += _copy_lines
+                _position += _copy_lines
+
+    def _hand_over(self):
+        # called with the buffer lock held
+        if self.error is not None:
+            raise self.error
+        if self._buffer_lines == 0:
+            return
+        self._queue.put((self._buffer, self._buffer_lines, self._records))
+        self.queue_high_water = max(self.queue_high_water, self._queue.qsize())
+        self._buffer = self._free_buffers.get()
+        self._buffer_lines = 0
+        self._records = []
+
+    def flush(self):
+        """ Hand the current block to the worker thread and continue in a free one. """
+        with self._buffer_lock:
+            self._hand_over()
+
+    def close(self):
+        """ Write everything still buffered and stop the worker thread. """
+        if self._worker is None:
+            return
+        self.flush()
+        self._queue.put(None)
+        self._worker.join()
+        self._worker = None
+        if self.error is not None:
+            raise self.error
+        if self.sync == 'close':
+            self._sync_file()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,148 @@
+import sqlite3
+import hashlib
+import json
+import os
+import re
+import time
+
+calib_type_pedestal = "pedestal"
+calib_type_tottoa   = "tottoa"
+
+default_calib_catalog_path = os.path.join("dump", "calib_catalog.sqlite")
+
+def _calib_file_sha256(file_path):
+    _hash = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for _chunk in iter(lambda: f.read(65536), b''):
+            _hash.update(_chunk)
+    return _hash.hexdigest()
+
+def _calib_file_timestamp(file_path):
+    # calibration files carry their creation time in the name, e.g. pede_calib_config_20240801_120000.json
+    _match = re.search(r'(\d{8}_\d{6})', os.path.basename(file_path))
+    if _match:
+        return _match.group(1)
+    return time.strftime("%Y%m%d_%H%M%S", time.localtime(os.path.getmtime(file_path)))
+
+class CalibCatalog:
+    """ Index of calibration result files, keyed by calibration type and board IP.
+
+    Calibration scripts register their output files here; configuration scripts
+    ask for the newest file of a type for a board with one indexed query instead
+    of opening every JSON file in the dump folder. Each entry keeps the size and
+    SHA-256 of the file, so a modified or missing file is never returned.
+    """
+    def __init__(self, catalog_path=default_calib_catalog_path):
+        self.catalog_path = catalog_path
+        _catalog_folder = os.path.dirname(catalog_path)
+        if _catalog_folder and not os.path.exists(_catalog_folder):
+            os.makedirs(_catalog_folder)
+        self.connection = sqlite3.connect(catalog_path)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS calibrations (
+            file_path  TEXT PRIMARY KEY,
+            calib_type TEXT NOT NULL,
+            board_ip   TEXT NOT NULL,
+            timestamp  TEXT NOT NULL,
+            file_size  INTEGER NOT NULL,
+            sha256     TEXT NOT NULL)""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS calib_lookup ON calibrations (calib_type, board_ip, timestamp)")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS synced_folders (
+            folder      TEXT NOT NULL,
+            file_prefix TEXT NOT NULL,
+            calib_type  TEXT NOT NULL,
+            mtime_ns    INTEGER NOT NULL,
+            PRIMARY KEY (folder, file_prefix, calib_type))""")
+        self.connection.commit()
+
+    def register(self, file_path, calib_type, board_ip, timestamp=None):
+        if timestamp is None:
+            timestamp = _calib_file_timestamp(file_path)
+        self.connection.execute("INSERT OR REPLACE INTO calibrations VALUES (?, ?, ?, ?, ?, ?)", (os.path.normpath(file_path), calib_type, board_ip, timestamp, os.path.getsize(file_path), _calib_file_sha256(file_path)))
+        self.connection.commit()
+
+    def is_registered(self, file_path):
+        _row = self.connection.execute("SELECT 1 FROM calibrations WHERE file_path = ?", (os.path.normpath(file_path),)).fetchone()
+        return _row is not None
+
+    def check_integrity(self, file_path, file_size, sha256):
+        if not os.path.exists(file_path):
+            return False
+        if os.path.getsize(file_path) != file_size:
+            return False
+        return _calib_file_sha256(file_path) == sha256
+
+    def find_latest(self, calib_type, board_ip, verbose=True):
+        """ Return the newest intact calibration file of a type for a board, or None. """
+        _rows = self.connection.execute("SELECT file_path, file_size, sha256 FROM calibrations WHERE calib_type = ? AND board_ip = ? ORDER BY timestamp DESC, file_path DESC", (calib_type, board_ip))
+        for _file_path, _file_size, _sha256 in _rows:
+            if self.check_integrity(_file_path, _file_size, _sha256):
+                return _file_path
+            if verbose:
+                print('\033[33m' + "Warning: calibration file failed integrity check, skipped: " + _file_path + '\033[0m')
+        return None
+
+    def sync_folder(self, folder, file_prefix, calib_type):
+        """ Register the files of a folder that are not in the catalog yet.
+
+        Only files unknown to the catalog are opened, so this is the one-time
+        cost of indexing an existing dump folder.
+        """
+        if not os.path.exists(folder):
+            return 0
+        _new_files = 0
+        for _file in os.listdir(folder):
+            if not _file.startswith(file_prefix) or not _file.endswith(".json"):
+                continue
+            _file_path = os.path.join(folder, _file)
+            if self.is_registered(_file_path):
+                continue
+            try:
+                with open(_file_path, 'r') as f:
+                    _board_ip = json.load(f)['udp']['h2gcroc_ip']
+            except (ValueError, KeyError, TypeError, OSError):
+                continue
+            self.register(_file_path, calib_type, _board_ip)
+            _new_files += 1
+        return _new_files
+
+    def sync_folder_if_changed(self, folder, file_prefix, calib_type, settle_seconds=2.0):
+        """ Run sync_folder only when the folder was modified since the last sync.
+
+        Creating, renaming or deleting a file updates the folder modification
+        time, so the usual lookup costs one stat and one query. A folder that
+        changed within settle_seconds is not marked as synced, a file written
+        in the same timestamp tick is then still picked up by the next lookup.
+        """
+        if not os.path.exists(folder):
+            return 0
+        _folder = os.path.normpath(folder)
+        _mtime_ns = os.stat(_folder).st_mtime_ns
+        _row = self.connection.execute("SELECT mtime_ns FROM synced_folders WHERE folder = ? AND file_prefix = ? AND calib_type = ?", (_folder, file_prefix, calib_type)).fetchone()
+        if _row is not None and _row[0] == _mtime_ns:
+            return 0
+        _new_files = self.sync_folder(_folder, file_prefix, calib_type)
+        if time.time_ns() - _mtime_ns > settle_seconds * 1e9:
+            self.connection.execute("INSERT OR REPLACE INTO synced_folders VALUES (?, ?, ?, ?)", (_folder, file_prefix, calib_type, _mtime_ns))
+            self.connection.commit()
+        return _new_files
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def register_calib_file(file_path, calib_type, board_ip, catalog_path=default_calib_catalog_path):
+    with CalibCatalog(catalog_path) as catalog:
+        catalog.register(file_path, calib_type, board_ip)
+
+def find_latest_calib_file(calib_type, board_ip, folder, file_prefix, catalog_path=default_calib_catalog_path):
+    """ Look up the newest calibration file of a board, indexing files the writers did not register first. """
+    with CalibCatalog(catalog_path) as catalog:
+        # files written before the catalog existed or by scripts that do not register them
+        catalog.sync_folder_if_changed(folder, file_prefix, calib_type)
+        _file_path = catalog.find_latest(calib_type, board_ip)
+    return _file_path
@@ -0,0 +1,87 @@
+import multiprocessing
+import os
+import numpy as np
+
+def _histogram_bin_index(values, edges):
+    # same binning as np.histogram2d: left-closed bins, the last bin also holds the upper edge
+    _index = np.searchsorted(edges, values, side='right') - 1
+    _index[values == edges[-1]] = len(edges) - 2
+    _index[(values < edges[0]) | (values > edges[-1])] = -1
+    return _index
+
+def channel_scan_histograms(scan_values, scan_data, x_edges, y_edges, channel_num=152):
+    """ Bin the per-channel values of all scan points in one vectorized pass.
+
+    scan_values holds the x value of each scan point, scan_data the matching
+    (n_events, channel_num) value arrays. Returns the counts of every channel,
+    shape (channel_num, len(x_edges)-1, len(y_edges)-1).
+    """
+    x_edges = np.asarray(x_edges, dtype=float)
+    y_edges = np.asarray(y_edges, dtype=float)
+    _x_bins = len(x_edges) - 1
+    _y_bins = len(y_edges) - 1
+    _values = np.concatenate([np.asarray(_data, dtype=float).reshape(-1, channel_num) for _data in scan_data])
+    _x_values = np.concatenate([np.full(np.asarray(_data).reshape(-1, channel_num).shape[0], _x, dtype=float) for _x, _data in zip(scan_values, scan_data)])
+    _x_index = np.broadcast_to(_histogram_bin_index(_x_values, x_edges)[:, np.newaxis], _values.shape)
+    _y_index = _histogram_bin_index(_values, y_edges)
+    _chn_index = np.broadcast_to(np.arange(channel_num), _values.shape)
+    _valid = (_x_index >= 0) & (_y_index >= 0)
+    _keys = (_chn_index[_valid] * _x_bins + _x_index[_valid]) * _y_bins + _y_index[_valid]
+    return np.bincount(_keys, minlength=channel_num * _x_bins * _y_bins).reshape(channel_num, _x_bins, _y_bins).astype(np.int32)
+
+_gallery_figure = None
+_gallery_axes   = None
+_gallery_colors = None
+
+def _gallery_worker_init(dpi):
+    global _gallery_figure, _gallery_axes, _gallery_colors
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import matplotlib.colors
+    _gallery_figure, _gallery_axes = plt.subplots(dpi=dpi)
+    _gallery_colors = matplotlib.colors
+
+def _gallery_render_channel(task):
+    _figure_path, _counts, _x_edges, _y_edges, _xlabel, _ylabel, _log_scale = task
+    _gallery_axes.clear()
+    if _log_scale:
+        # empty bins stay white, as in hist2d with a log scale
+        _norm = _gallery_colors.LogNorm() if np.any(_counts > 0) else None
+        _gallery_axes.pcolormesh(_x_edges, _y_edges, np.ma.masked_equal(_counts, 0).T, norm=_norm)
+    else:
+        _gallery_axes.pcolormesh(_x_edges, _y_edges, _counts.T)
+    _gallery_axes.set_xlabel(_xlabel)
+    _gallery_axes.set_ylabel(_ylabel)
+    _gallery_figure.savefig(_figure_path)
+    return _figure_path
+
+def render_channel_gallery(channel_counts, x_edges, y_edges, output_folder, xlabel='', ylabel='', log_scale=False, dpi=300, file_name_format='Chn{}.png', processes=None, progress=None):
+    """ Render one PNG per channel from precomputed histogram counts.
+
+    The figures are drawn with the Agg backend in a pool of worker processes,
+    each of which creates its figure and axes once and reuses them for all of
+    its channels. Workers are forked so the calling script is not imported
+    again; where fork is not available the channels are rendered in this
+    process. progress is an optional wrapper for the result iterator, e.g.
+    tqdm. Returns the list of written files.
+    """
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    _tasks = [(os.path.join(output_folder, file_name_format.format(_chn)), channel_counts[_chn], x_edges, y_edges, xlabel, ylabel, log_scale) for _chn in range(len(channel_counts))]
+    if processes is None:
+        processes = min(os.cpu_count() or 1, len(_tasks))
+    if processes > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        with multiprocessing.get_context('fork').Pool(processes, initializer=_gallery_worker_init, initargs=(dpi,)) as pool:
+            _results = pool.imap(_gallery_render_channel, _tasks)
+            if progress is not None:
+                _results = progress(_results, total=len(_tasks))
+            return list(_results)
+    _gallery_worker_init(dpi)
+    _results = map(_gallery_render_channel, _tasks)
+    if progress is not None:
+        _results = progress(_results, total=len(_tasks))
+    _figure_paths = list(_results)
+    import matplotlib.pyplot as plt
+    plt.close(_gallery_figure)
+    return _figure_paths
@@ -0,0 +1,213 @@
+import concurrent.futures
+import queue
+import struct
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+compressed_stream_magic = b'H2GZ'
+compressed_block_magic  = b'H2GB'
+# block header: magic, codec id, raw size, compressed size, CRC32 of the raw data
+compressed_block_header = struct.Struct('<4sBIII')
+
+compression_codec_zlib = "zlib"
+compression_codec_zstd = "zstd"
+compression_codec_lz4  = "lz4"
+compression_codec_ids  = {compression_codec_zlib: 0, compression_codec_zstd: 1, compression_codec_lz4: 2}
+compression_codec_names = {_id: _name for _name, _id in compression_codec_ids.items()}
+
+def available_compression_codecs():
+    _codecs = []
+    if zstandard is not None:
+        _codecs.append(compression_codec_zstd)
+    if lz4 is not None:
+        _codecs.append(compression_codec_lz4)
+    _codecs.append(compression_codec_zlib)
+    return _codecs
+
+def default_compression_codec():
+    """ zstd, else lz4, else zlib, depending on the installed modules. """
+    return available_compression_codecs()[0]
+
+def compress_block(data, codec, level=None):
+    if codec == compression_codec_zstd:
+        if zstandard is None:
+            raise ImportError("zstandard is required for zstd compression")
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+    if codec == compression_codec_lz4:
+        if lz4 is None:
+            raise ImportError("lz4 is required for lz4 compression")
+        return lz4.frame.compress(data, compression_level=0 if level is None else level)
+    if codec == compression_codec_zlib:
+        return zlib.compress(data, 6 if level is None else level)
+    raise ValueError("Unknown compression codec " + str(codec))
+
+def decompress_block(data, codec, raw_size):
+    if codec == compression_codec_zstd:
+        if zstandard is None:
+            raise ImportError("zstandard is required to read zstd blocks")
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=raw_size)
+    if codec == compression_codec_lz4:
+        if lz4 is None:
+            raise ImportError("lz4 is required to read lz4 blocks")
+        return lz4.frame.decompress(data)
+    if codec == compression_codec_zlib:
+        return zlib.decompress(data)
+    raise ValueError("Unknown compression codec " + str(codec))
+
+class CompressedBlockWriter:
+    """ Text output file written as a stream of independently compressed blocks.
+
+    write takes text like a file opened with 'w'. The text is cut into blocks
+    of about block_size bytes at line ends; every block is compressed on its
+    own and framed with a header, so readers can skip from block to block
+    and decompress blocks in parallel. Compression and writing run on a
+    worker thread; a full queue of queue_size blocks makes write wait.
+    """
+    def __init__(self, file_path, codec=None, block_size=4 * 1024 * 1024, level=None, queue_size=8):
+        self.file_path = file_path
+        self.codec = codec if codec is not None else default_compression_codec()
+        if self.codec not in compression_codec_ids:
+            raise ValueError("Unknown compression codec " + str(self.codec))
+        self.block_size = block_size
+        self.level = level
+        self.block_num = 0
+        self.raw_size = 0
+        self.compressed_size = 0
+        self.error = None
+        self.queue_high_water = 0
+        self._buffer = []
+        self._buffer_size = 0
+        self._output_file = open(file_path, 'wb')
+        self._output_file.write(compressed_stream_magic)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._worker = threading.Thread(target=self._compress_blocks, daemon=True)
+        self._worker.start()
+
+    def _compress_blocks(self):
+        while True:
+            _raw = self._queue.get()
+            if _raw is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                _compressed = compress_block(_raw, self.codec, self.level)
+                self._output_file.write(compressed_block_header.pack(compressed_block_magic, compression_codec_ids[self.codec], len(_raw), len(_compressed), zlib.crc32(_raw)))
+                self._output_file.write(_compressed)
+                self.block_num += 1
+                self.raw_size += len(_raw)
+                self.compressed_size += len(_compressed)
+            except Exception as e:
+                self.error = e
+
+    def write(self, text):
+        _data = text.encode()
+        self._buffer.append(_data)
+        self._buffer_size += len(_data)
+        if self._buffer_size >= self.block_size and _data.endswith(b'\n'):
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        """ Hand the buffered text to the worker thread as one block. """
+        if self.error is not None:
+            raise self.error
+        if self._buffer_size > 0:
+            self._queue.put(b''.join(self._buffer))
+            self.queue_high_water = max(self.queue_high_water, self._queue.qsize())
+            self._buffer = []
+            self._buffer_size = 0
+
+    def close(self):
+        if self._output_file is None:
+            return
+        self.flush()
+        self._queue.put(None)
+        self._worker.join()
+        self._output_file.close()
+        self._output_file = None
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def is_compressed_stream(file_path):
+    with open(file_path, 'rb') as f:
+        return f.read(len(compressed_stream_magic)) == compressed_stream_magic
+
+def compressed_block_index(file_path):
+    """ Return (offset, codec, raw size, compressed size, crc32) of every block, reading only the headers. """
+    _blocks = []
+    with open(file_path, 'rb') as f:
+        if f.read(len(compressed_stream_magic)) != compressed_stream_magic:
+            raise ValueError(file_path + " is not a compressed block stream")
+        while True:
+            _offset = f.tell()
+            _header = f.read(compressed_block_header.size)
+            if len(_header) < compressed_block_header.size:
+                break
+            _magic, _codec_id, _raw_size, _compressed_size, _crc = compressed_block_header.unpack(_header)
+            if _magic != compressed_block_magic:
+                print('\033[33m' + "Warning: broken block header at offset " + str(_offset) + " in " + file_path + '\033[0m')
+                break
+            _blocks.append((_offset, compression_codec_names[_codec_id], _raw_size, _compressed_size, _crc))
+            f.seek(_compressed_size, 1)
+    return _blocks
+
+def read_compressed_block(file_path, block):
+    """ Decompress one block of compressed_block_index and check its CRC. """
+    _offset, _codec, _raw_size, _compressed_size, _crc = block
+    with open(file_path, 'rb') as f:
+        f.seek(_offset + compressed_block_header.size)
+        _raw = decompress_block(f.read(_compressed_size), _codec, _raw_size)
+    if zlib.crc32(_raw) != _crc:
+        raise ValueError("CRC mismatch in block at offset " + str(_offset) + " of " + file_path)
+    return _raw
+
+def iter_compressed_blocks(file_path, threads=4):
+    """ Yield the decompressed blocks of a stream in order, decompressing up to threads blocks ahead. """
+    _blocks = compressed_block_index(file_path)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        _pending = []
+        for _block in _blocks:
+            _pending.append(executor.submit(read_compressed_block, file_path, _block))
+            if len(_pending) > threads:
+                yield _pending.pop(0).result()
+        for _future in _pending:
+            yield _future.result()
+
+class CompressedLineReader:
+    """ Iterate over the text lines of a compressed block stream like over a file opened with 'r'. """
+    def __init__(self, file_path, threads=4):
+        self.file_path = file_path
+        self.threads = threads
+
+    def __iter__(self):
+        for _block in iter_compressed_blocks(self.file_path, threads=self.threads):
+            yield from _block.decode().splitlines(keepends=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+def open_run_file(file_path):
+    """ Open a run file for reading text lines, whether plain or a compressed block stream. """
+    if is_compressed_stream(file_path):
+        return CompressedLineReader(file_path)
+    return open(file_path, 'r')
@@ -1,4 +1,5 @@
 from itertools import groupby
+import numpy as np
 
 def extract_raw_payloads(data):
     # Constant values
@@ -133,4 +134,9 @@ def DaqH_get_H3(_daqh):
         return None
     # Ensure the element is treated as an integer
     value = int(_daqh[-1])
-    return (value & 0x10) >> 4
\ No newline at end of file
+    return (value & 0x10) >> 4
+
+def expand_tot(tot_values):
+    """ Expand ToT values to 12 bits: with bit 9 set, the lower 9 bits are shifted up by 3. """
+    tot_values = np.asarray(tot_values).astype(np.int64)
+    return np.where((tot_values >> 9) & 0x1 == 1, (tot_values & 0x1FF) << 3, tot_values)
\ No newline at end of file
@@ -0,0 +1,67 @@
+from .data_packet import *
+import numpy as np
+
+def extract_channel_words(bytes_input):
+    """ Return the 37 raw 32-bit channel words of a 160-byte half-packet payload as uint32. """
+    return np.frombuffer(bytes(bytes_input[4:152]), dtype='>u4').astype(np.uint32)
+
+def event_channel_words(halves):
+    """ Collect the raw channel words of an event (152, uint32) and the DaqH of each half. """
+    event_words = np.zeros(152, dtype=np.uint32)
+    event_daqh  = [None] * 4
+    for _half_index, _fragment in halves.items():
+        _data = b''.join(bytes(_line) for _line in _fragment)
+        # the five 40-byte lines carry 32 payload bytes each after their 8-byte header
+        _payload = b''.join(_data[_line*40+8:_line*40+40] for _line in range(5))
+        _words = extract_channel_words(_payload)
+        event_words[_half_index*38:_half_index*38+len(_words)] = _words
+        event_daqh[_half_index] = _payload[0:4]
+    return event_words, event_daqh
+
+def decode_channel_words(words):
+    """ Decode raw channel words of any shape into ADC, ADC-1, ToT and ToA following the Tc/Tp flags.
+
+    As in decodedata of 013_Analysis_NN:
+    tc tp = 0 x: m0 is ADC-1, m1 is ADC, m2 is ToA
+    tc tp = 1 0: m0 is ADC-1, m1 is ToT, m2 is ToA
+    tc tp = 1 1: m0 is ADC,   m1 is ToT, m2 is ToA
+    ToT is expanded to 12 bits. Fields that a word does not carry are 0 and
+    False in the matching '_valid' mask; ToA is valid when it is not 0.
+    """
+    words = np.asarray(words).astype(np.uint32)
+    tc = (words >> 31) & 0x1
+    tp = (words >> 30) & 0x1
+    m0 = ((words >> 20) & 0x3FF).astype(np.int64)
+    m1 = ((words >> 10) & 0x3FF).astype(np.int64)
+    m2 = (words & 0x3FF).astype(np.int64)
+
+    adc_from_m1 = tc == 0
+    adc_from_m0 = (tc == 1) & (tp == 1)
+    tot_valid   = tc == 1
+    adcm1_valid = ~adc_from_m0
+    adc_valid   = adc_from_m1 | adc_from_m0
+
+    adc   = np.where(adc_from_m1, m1, np.where(adc_from_m0, m0, 0))
+    adcm1 = np.where(adcm1_valid, m0, 0)
+    tot   = np.where(tot_valid, expand_tot(m1), 0)
+    return {
+        "tc": tc,
+        "tp": tp,
+        "adc": adc,
+        "adcm1": adcm1,
+        "tot": tot,
+        "toa": m2,
+        "adc_valid": adc_valid,
+        "adcm1_valid": adcm1_valid,
+        "tot_valid": tot_valid,
+        "toa_valid": m2 != 0
+    }
+
+def daqh_is_good(daqh_words):
+    """ Check the fixed 0x5 patterns in the first and last nibble of 32-bit DaqH words. """
+    daqh_words = np.asarray(daqh_words).astype(np.uint32)
+    return ((daqh_words >> 28) == 0x5) & ((daqh_words & 0xF) == 0x5)
+
+def daqh_hamming_bits(daqh_words):
+    """ Return the H1, H2, H3 bits of 32-bit DaqH words packed as H1 << 2 | H2 << 1 | H3. """
+    return ((np.asarray(daqh_words).astype(np.uint32) >> 4) & 0x7).astype(np.uint8)
@@ -0,0 +1,191 @@
+from .compressed_stream import *
+from .zero_suppression import *
+import os
+import numpy as np
+
+timestamp_period = 2**30
+
+event_index_dtype = np.dtype([
+    ("timestamp", np.int64),    # unwrapped timestamp
+    ("offset", np.int64),       # byte offset of the first line of the event
+    ("end_offset", np.int64),   # byte offset after the last line of the event
+    ("board", np.uint8),
+    ("halves", np.uint8)        # bit h set if half h arrived with its five lines
+])
+
+event_index_complete_halves = 0xF
+
+def unwrap_timestamps(timestamps, period=timestamp_period):
+    """ Unwrap a sequence of wrapping timestamp counters into a monotonic int64 time line.
+
+    A backward step of more than half a period is taken as a counter wrap.
+    """
+    timestamps = np.asarray(timestamps).astype(np.int64) % period
+    if len(timestamps) == 0:
+        return timestamps
+    _wraps = np.diff(timestamps) < -(period // 2)
+    return timestamps + np.concatenate(([0], np.cumsum(_wraps))) * period
+
+def machine_gun_samples(timestamps, timestamp_diff_threshold=100, previous=None, period=timestamp_period):
+    """ Return the sample index within its machine-gun burst and the burst id of every event.
+
+    A new burst starts when the timestamp step from the previous event is at
+    least timestamp_diff_threshold, the step being taken modulo the counter
+    period. To continue over batches, previous is (timestamp, sample_index,
+    burst_id) of the last event of the previous batch.
+    """
+    timestamps = np.asarray(timestamps).astype(np.int64)
+    if len(timestamps) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    _positions = np.arange(len(timestamps))
+    if previous is None:
+        _new_burst = np.concatenate(([True], np.diff(timestamps) % period >= timestamp_diff_threshold))
+        _previous_sample_index, _previous_burst_id = -1, -1
+    else:
+        _new_burst = np.diff(timestamps, prepend=previous[0]) % period >= timestamp_diff_threshold
+        _previous_sample_index, _previous_burst_id = previous[1], previous[2]
+    _burst_start = np.maximum.accumulate(np.where(_new_burst, _positions, -1))
+    sample_index = np.where(_burst_start >= 0, _positions - _burst_start, _previous_sample_index + 1 + _positions)
+    burst_id = _previous_burst_id + np.cumsum(_new_burst)
+    return sample_index, burst_id
+
+def _unwrap_near(timestamp, reference, period=timestamp_period):
+    """ Unwrap one timestamp counter to the value closest to the unwrapped reference. """
+    return timestamp + period * ((reference - timestamp + period // 2) // period)
+
+def _parse_index_line(line):
+    """ Return (board, timestamp, half_index, line_index) of a raw run file line, or None. """
+    if line.startswith(b'#'):
+        return None
+    try:
+        _line_bytes = bytes.fromhex(line.decode('ascii'))
+    except ValueError:
+        return None
+    if len(_line_bytes) < 8:
+        return None
+    _half_index = (_line_bytes[0] - 0xA0) * 2 + (_line_bytes[2] - 0x24)
+    _timestamp = int.from_bytes(_line_bytes[4:8], byteorder='big') % timestamp_period
+    return _line_bytes[1], _timestamp, _half_index, _line_bytes[3]
+
+def event_index_path(file_path):
+    return file_path + ".idx.npy"
+
+def build_event_index(file_path, board=None):
+    """ Scan a hex text run file once and return its event index, ordered by file position.
+
+    Every (board, timestamp) gets one entry with the byte range of its lines
+    and the halves it got complete. Timestamps are unwrapped per board while
+    reading, so events of different counter turns are never merged.
+    Compressed run files are seeked with compressed_block_index instead;
+    sparse (zero-suppressed) run files have no raw lines to index.
+    """
+    if is_compressed_stream(file_path):
+        raise ValueError(file_path + " is a compressed block stream, the event index needs a plain run file")
+    if is_sparse_run_file(file_path):
+        raise ValueError(file_path + " is a sparse run file, the event index needs raw half-packet lines")
+    _events = {}
+    _last_timestamps = {}
+    _offset = 0
+    with open(file_path, 'rb') as f:
+        for line in f:
+            _line_offset = _offset
+            _offset += len(line)
+            _parsed = _parse_index_line(line)
+            if _parsed is None:
+                continue
+            _board, _timestamp, _half_index, _line_index = _parsed
+            if board is not None and _board != board:
+                continue
+            if not 0 <= _half_index < 4 or not 0 <= _line_index < 5:
+                continue
+            _timestamp = _unwrap_near(_timestamp, _last_timestamps.get(_board, _timestamp))
+            _last_timestamps[_board] = _timestamp
+            _event = _events.get((_board, _timestamp))
+            if _event is None:
+                _event = [_line_offset, _offset, 0]
+                _events[(_board, _timestamp)] = _event
+            _event[1] = _offset
+            _event[2] |= 1 << (_half_index * 5 + _line_index)
+
+    index = np.zeros(len(_events), dtype=event_index_dtype)
+    for _i, (_event_key, _event) in enumerate(_events.items()):
+        _halves = 0
+        for _half_index in range(4):
+            if (_event[2] >> (_half_index * 5)) & 0x1F == 0x1F:
+                _halves |= 1 << _half_index
+        index[_i] = (_event_key[1], _event[0], _event[1], _event_key[0], _halves)
+    return index[np.argsort(index["offset"], kind='stable')]
+
+class EventIndex:
+    """ Random access to the events of a run file through its index sidecar.
+
+    The sidecar (<run file>.idx.npy) is built on first use and rebuilt when the
+    run file is newer. seek_event reads only the byte range of one event, and
+    time_range finds the events of a timestamp window with np.searchsorted.
+    """
+    def __init__(self, file_path, rebuild=False):
+        self.file_path = file_path
+        _index_path = event_index_path(file_path)
+        if not rebuild and os.path.exists(_index_path) and os.path.getmtime(_index_path) >= os.path.getmtime(file_path):
+            self.index = np.load(_index_path)
+        else:
+            self.index = build_event_index(file_path)
+            try:
+                with open(_index_path, 'wb') as f:
+                    np.save(f, self.index)
+            except OSError:
+                print('\033[33m' + "Warning: cannot write event index " + _index_path + '\033[0m')
+        self.time_order = np.argsort(self.index["timestamp"], kind='stable')
+        self.sorted_timestamps = self.index["timestamp"][self.time_order]
+
+    def __len__(self):
+        return len(self.index)
+
+    def complete(self):
+        """ Boolean mask of the events that have all four halves. """
+        return self.index["halves"] == event_index_complete_halves
+
+    def _read_events(self, event_indices):
+        _entries = self.index[event_indices]
+        _wanted = {(int(_entry["board"]), int(_entry["timestamp"])): _i for _i, _entry in enumerate(_entries)}
+        _last_timestamps = {int(_entry["board"]): int(_entry["timestamp"]) for _entry in _entries[::-1]}
+        _events = [{} for _ in range(len(_entries))]
+        if len(_entries) == 0:
+            return _events
+        with open(self.file_path, 'rb') as f:
+            f.seek(int(_entries["offset"].min()))
+            _data = f.read(int(_entries["end_offset"].max() - _entries["offset"].min()))
+        for line in _data.splitlines():
+            _parsed = _parse_index_line(line)
+            if _parsed is None:
+                continue
+            if _parsed[0] not in _last_timestamps or not 0 <= _parsed[2] < 4 or not 0 <= _parsed[3] < 5:
+                continue
+            _timestamp = _unwrap_near(_parsed[1], _last_timestamps[_parsed[0]])
+            _last_timestamps[_parsed[0]] = _timestamp
+            _i = _wanted.get((_parsed[0], _timestamp))
+            if _i is None:
+                continue
+            _events[_i].setdefault(_parsed[2], [None] * 5)[_parsed[3]] = bytearray.fromhex(line.decode('ascii'))
+        return [{_half_index: _fragment for _half_index, _fragment in _halves.items() if None not in _fragment} for _halves in _events]
+
+    def seek_event(self, event_index):
+        """ Return (event_key, halves) of the event_index-th event, halves as from iter_run_file_events. """
+        _entry = self.index[event_index]
+        _event_key = (int(_entry["board"]), int(_entry["timestamp"] % timestamp_period))
+        return _event_key, self._read_events([event_index])[0]
+
+    def read_events(self, start, stop):
+        """ Return [(event_key, halves)] of the events start to stop, reading their byte range once. """
+        _event_indices = np.arange(start, min(stop, len(self.index)))
+        _keys = [(int(_entry["board"]), int(_entry["timestamp"] % timestamp_period)) for _entry in self.index[_event_indices]]
+        return list(zip(_keys, self._read_events(_event_indices)))
+
+    def time_range(self, timestamp_start, timestamp_stop, board=None):
+        """ Return the indices (in file order) of the events with unwrapped timestamp_start <= timestamp < timestamp_stop. """
+        _low  = np.searchsorted(self.sorted_timestamps, timestamp_start, side='left')
+        _high = np.searchsorted(self.sorted_timestamps, timestamp_stop, side='left')
+        _event_indices = np.sort(self.time_order[_low:_high])
+        if board is not None:
+            _event_indices = _event_indices[self.index["board"][_event_indices] == board]
+        return _event_indices
@@ -0,0 +1,180 @@
+from .decoder import *
+from .run_file import *
+import os
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import uproot
+except ImportError:
+    uproot = None
+
+export_format_hdf5    = "hdf5"
+export_format_parquet = "parquet"
+
+def export_format_from_path(file_path):
+    _extension = os.path.splitext(file_path)[1].lower()
+    if _extension in (".h5", ".hdf5"):
+        return export_format_hdf5
+    if _extension in (".parquet", ".pq"):
+        return export_format_parquet
+    raise ValueError("Unknown export format for file " + file_path + ", use .h5/.hdf5 or .parquet")
+
+def half_packet_columns(batch):
+    """ Turn an event batch of iter_run_file_batches into one row per half-packet.
+
+    Columns: timestamp, board, asic, half, the DaqH word with its quality
+    flag and hamming bits, and per-channel (38) tctp, adc, adcm1, tot, toa
+    decoded with the Tc/Tp flags; values a word does not carry are 0.
+    """
+    _event_num = len(batch["timestamp"])
+    _words = batch["words"].reshape(_event_num * 4, 38)
+    _daqh  = batch["daqh"].reshape(_event_num * 4)
+    _decoded = decode_channel_words(_words)
+    return {
+        "timestamp": np.repeat(batch["timestamp"], 4),
+        "board": np.repeat(batch["board"], 4),
+        "asic": np.tile(np.array([0, 0, 1, 1], dtype=np.uint8), _event_num),
+        "half": np.tile(np.array([0, 1, 0, 1], dtype=np.uint8), _event_num),
+        "daqh": _daqh,
+        "daqh_good": daqh_is_good(_daqh),
+        "hamming": daqh_hamming_bits(_daqh),
+        "tctp": (_decoded["tc"] << 1 | _decoded["tp"]).astype(np.uint8),
+        "adc": _decoded["adc"].astype(np.uint16),
+        "adcm1": _decoded["adcm1"].astype(np.uint16),
+        "tot": _decoded["tot"].astype(np.uint16),
+        "toa": _decoded["toa"].astype(np.uint16)
+    }
+
+def event_columns(batch):
+    """ Turn an event batch of iter_run_file_batches into one row per event.
+
+    Columns: timestamp, board, per-half (4) DaqH word, quality flag and
+    hamming bits, and per-channel (152) tctp, adc, adcm1, tot and toa decoded
+    with the Tc/Tp flags.
+    """
+    _decoded = decode_channel_words(batch["words"])
+    return {
+        "timestamp": batch["timestamp"],
+        "board": batch["board"],
+        "daqh": batch["daqh"],
+        "daqh_good": daqh_is_good(batch["daqh"]),
+        "hamming": daqh_hamming_bits(batch["daqh"]),
+        "tctp": (_decoded["tc"] << 1 | _decoded["tp"]).astype(np.uint8),
+        "adc": _decoded["adc"].astype(np.uint16),
+        "adcm1": _decoded["adcm1"].astype(np.uint16),
+        "tot": _decoded["tot"].astype(np.uint16),
+        "toa": _decoded["toa"].astype(np.uint16)
+    }
+
+class ColumnarRunWriter:
+    """ Append column batches to a chunked, compressed HDF5 or Parquet file.
+
+    HDF5 files get one resizable dataset per column, chunked along the rows;
+    Parquet files get one row group per written batch. The format follows the
+    file extension unless export_format is given. h5py or pyarrow is only
+    needed for the format that is used.
+    """
+    def __init__(self, file_path, export_format=None, chunk_rows=16384, compression=None):
+        self.file_path = file_path
+        self.export_format = export_format if export_format is not None else export_format_from_path(file_path)
+        self.chunk_rows = chunk_rows
+        self.row_num = 0
+        if self.export_format == export_format_hdf5:
+            if h5py is None:
+                raise ImportError("h5py is required to write HDF5 files")
+            self.compression = compression if compression is not None else "gzip"
+            self.output_file = h5py.File(file_path, 'w')
+        elif self.export_format == export_format_parquet:
+            if pyarrow is None:
+                raise ImportError("pyarrow is required to write Parquet files")
+            self.compression = compression if compression is not None else "zstd"
+            self.output_file = None
+        else:
+            raise ValueError("Unknown export format " + str(self.export_format))
+
+    def _parquet_table(self, columns):
+        _arrays = []
+        for _name, _values in columns.items():
+            if _values.ndim == 1:
+                _arrays.append(pyarrow.array(_values))
+            else:
+                _arrays.append(pyarrow.FixedSizeListArray.from_arrays(pyarrow.array(_values.ravel()), _values.shape[1]))
+        return pyarrow.Table.from_arrays(_arrays, names=list(columns.keys()))
+
+    def write_batch(self, columns):
+        _batch_rows = len(next(iter(columns.values())))
+        if _batch_rows == 0:
+            return
+        if self.export_format == export_format_hdf5:
+            for _name, _values in columns.items():
+                if _name not in self.output_file:
+                    self.output_file.create_dataset(_name, shape=(0,) + _values.shape[1:], maxshape=(None,) + _values.shape[1:], dtype=_values.dtype, chunks=(self.chunk_rows,) + _values.shape[1:], compression=self.compression)
+                _dataset = self.output_file[_name]
+                _dataset.resize(self.row_num + _batch_rows, axis=0)
+                _dataset[self.row_num:] = _values
+        else:
+            _table = self._parquet_table(columns)
+            if self.output_file is None:
+                self.output_file = pyarrow.parquet.ParquetWriter(self.file_path, _table.schema, compression=self.compression)
+            self.output_file.write_table(_table, row_group_size=max(self.chunk_rows, _batch_rows))
+        self.row_num += _batch_rows
+
+    def close(self):
+        if self.output_file is not None:
+            self.output_file.close()
+            self.output_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def export_run_file(input_path, output_path, export_format=None, batch_size=4096, fragment_life=100, board=None, progress=None):
+    """ Decode a hex text run file and stream it into a columnar file, one row per half-packet.
+
+    Returns the number of events written. progress is an optional callable
+    called with the number of events of every written batch.
+    """
+    _event_num = 0
+    with ColumnarRunWriter(output_path, export_format=export_format, chunk_rows=batch_size * 4) as writer:
+        for _batch in iter_run_file_batches(input_path, batch_size=batch_size, fragment_life=fragment_life, board=board):
+            writer.write_batch(half_packet_columns(_batch))
+            _event_num += len(_batch["timestamp"])
+            if progress is not None:
+                progress(len(_batch["timestamp"]))
+    return _event_num
+
+def rootify_run_file(input_path, output_path, tree_name="h2gcroc", batch_size=65536, fragment_life=100, board=None, progress=None):
+    """ Decode a run file into a flat ROOT TTree with uproot, one entry per event.
+
+    Per-channel and per-half quantities are fixed-size array branches, e.g.
+    adc[152] and daqh_good[4]. Every batch of batch_size events is written as
+    one basket per branch, so the file is filled in large baskets while the
+    memory stays bounded. Returns the number of events written.
+    """
+    if uproot is None:
+        raise ImportError("uproot is required to write ROOT files")
+    _event_num = 0
+    with uproot.recreate(output_path) as root_file:
+        _tree = None
+        for _batch in iter_run_file_batches(input_path, batch_size=batch_size, fragment_life=fragment_life, board=board):
+            _columns = event_columns(_batch)
+            if _tree is None:
+                _tree = root_file.mktree(tree_name, {_name: np.dtype((_values.dtype, _values.shape[1:])) for _name, _values in _columns.items()})
+            _tree.extend(_columns)
+            _event_num += len(_batch["timestamp"])
+            if progress is not None:
+                progress(len(_batch["timestamp"]))
+    return _event_num
@@ -0,0 +1,50 @@
+import numpy as np
+
+class Histogram2D:
+    """ Fixed-bin 2D count histogram that is filled batch by batch.
+
+    Every fill maps the (x, y) pairs to one combined bin key and adds
+    np.bincount of the keys to the counts, so the memory is the size of the
+    count array no matter how many entries are filled. Entries outside the
+    ranges are dropped, as in np.histogram2d.
+    """
+    def __init__(self, x_bins, x_range, y_bins, y_range):
+        self.x_bins  = x_bins
+        self.x_range = x_range
+        self.y_bins  = y_bins
+        self.y_range = y_range
+        self.counts  = np.zeros((x_bins, y_bins), dtype=np.int64)
+
+    def _bin_index(self, values, bins, value_range):
+        _low, _high = value_range
+        return np.floor((np.asarray(values, dtype=float) - _low) * (bins / (_high - _low))).astype(np.int64)
+
+    def fill(self, x, y, mask=None):
+        """ Fill the (x, y) pairs, only where mask is True if a mask is given. """
+        _x_index = self._bin_index(x, self.x_bins, self.x_range).ravel()
+        _y_index = self._bin_index(y, self.y_bins, self.y_range).ravel()
+        _in_range = (_x_index >= 0) & (_x_index < self.x_bins) & (_y_index >= 0) & (_y_index < self.y_bins)
+        if mask is not None:
+            _in_range &= np.asarray(mask, dtype=bool).ravel()
+        _keys = _x_index[_in_range] * self.y_bins + _y_index[_in_range]
+        self.counts += np.bincount(_keys, minlength=self.x_bins * self.y_bins).reshape(self.x_bins, self.y_bins)
+
+    def x_edges(self):
+        return np.linspace(self.x_range[0], self.x_range[1], self.x_bins + 1)
+
+    def y_edges(self):
+        return np.linspace(self.y_range[0], self.y_range[1], self.y_bins + 1)
+
+    def entries(self):
+        return int(self.counts.sum())
+
+class ChannelHistogram2D(Histogram2D):
+    """ Channel vs. value histogram with one x bin per channel. """
+    def __init__(self, channel_num=152, bins=256, value_range=(0, 1024)):
+        super().__init__(channel_num, (0, channel_num), bins, value_range)
+        self.channel_num = channel_num
+
+    def fill_channels(self, values, mask=None):
+        """ Fill a batch of events of shape (n_events, channel_num). """
+        values = np.asarray(values)
+        self.fill(np.broadcast_to(np.arange(self.channel_num), values.shape), values, mask=mask)
@@ -0,0 +1,269 @@
+from .socket_wrapper import *
+import socket
+import time
+import numpy as np
+
+iodelay_line_names  = ["trg0", "trg1", "trg2", "trg3", "data0", "data1"]
+iodelay_line_labels = ["T0", "T1", "T2", "T3", "D0", "D1"]
+
+def find_true_sublists(bool_list):
+    results = []
+    start_index = None
+    in_sequence = False
+
+    for index, value in enumerate(bool_list):
+        if value:
+            if not in_sequence:
+                # Starting a new sequence
+                start_index = index
+                in_sequence = True
+        else:
+            if in_sequence:
+                # Ending a sequence
+                results.append((start_index, index - start_index))
+                in_sequence = False
+
+    # Check if the last sequence extends to the end of the list
+    if in_sequence:
+        results.append((start_index, len(bool_list) - start_index))
+
+    return results
+
+def get_line_lock_status(debug_info, locked_output):
+    """ Return the lock status of the six lines (T0-T3, D0, D1) from the debug data. """
+    if debug_info is None:
+        return [False] * len(iodelay_line_names)
+    return [debug_info[_line + "_value"] == locked_output for _line in iodelay_line_names]
+
+def probe_iodelay(_socket, addr, port, fpga_addr, delay_vals, locked_output, asic_select=0x03, settle_time=0.05, fclk_val=0x000, fcmd_val=0x400, verbose=False):
+    """ Program the IO delays of both ASICs in one step and read back the lock status of each line.
+
+    delay_vals is a list of two entries, one per ASIC. Each entry is either a single
+    delay for all six lines or a list of six per-line delays (T0-T3, D0, D1).
+    Returns a list with the per-line lock status of each ASIC.
+    """
+    _line_delays = []
+    for _asic_delay in delay_vals:
+        if isinstance(_asic_delay, (list, tuple)):
+            _line_delays.append(list(_asic_delay))
+        else:
+            _line_delays.append([_asic_delay] * len(iodelay_line_names))
+    a0, a1 = _line_delays[0], _line_delays[1]
+    if not set_bitslip(_socket, addr, port, asic_num=0, fpga_addr=fpga_addr, io_dly_sel=asic_select, a0_io_dly_val_fclk=fclk_val, a0_io_dly_val_fcmd=fcmd_val, a1_io_dly_val_fclk=fclk_val, a1_io_dly_val_fcmd=fcmd_val, a0_io_dly_val_tr0=a0[0], a0_io_dly_val_tr1=a0[1], a0_io_dly_val_tr2=a0[2], a0_io_dly_val_tr3=a0[3], a0_io_dly_val_dq0=a0[4], a0_io_dly_val_dq1=a0[5], a1_io_dly_val_tr0=a1[0], a1_io_dly_val_tr1=a1[1], a1_io_dly_val_tr2=a1[2], a1_io_dly_val_tr3=a1[3], a1_io_dly_val_dq0=a1[4], a1_io_dly_val_dq1=a1[5], verbose=verbose):
+        if verbose:
+            print('\033[33m' + "Warning in setting bitslip" + '\033[0m')
+    if not send_reset_adj(_socket, addr, port, asic_num=0, fpga_addr=fpga_addr, sw_hard_reset_sel=0x00, sw_hard_reset=0x00, sw_soft_reset_sel=0x00, sw_soft_reset=0x00, sw_i2c_reset_sel=0x00, sw_i2c_reset=0x00, reset_pack_counter=0x00, adjustable_start=asic_select, verbose=False):
+        if verbose:
+            print('\033[33m' + "Warning in sending reset_adj" + '\033[0m')
+    # one settling time for both ASICs
+    time.sleep(settle_time)
+    lock_status = []
+    for _asic in range(2):
+        if not (asic_select >> _asic) & 0x01:
+            lock_status.append([False] * len(iodelay_line_names))
+            continue
+        try:
+            debug_info = get_debug_data(_socket, addr, port, asic_num=_asic, fpga_addr=fpga_addr, verbose=False)
+        except socket.timeout:
+            debug_info = None
+        if debug_info is None and verbose:
+            print('\033[33m' + "Warning in getting debug data" + '\033[0m')
+        lock_status.append(get_line_lock_status(debug_info, locked_output))
+    return lock_status
+
+def _iodelay_skip_value(value, lower, upper, skip_values):
+    # move a probe point off a known bad delay value, staying strictly inside (lower, upper)
+    if value not in skip_values:
+        return value
+    for _candidate in (value + 1, value - 1):
+        if lower < _candidate < upper and _candidate not in skip_values:
+            return _candidate
+    return None
+
+def _coarse_window_brackets(coarse_locked, coarse_delays, delay_min, delay_max):
+    # (unlocked, locked) pair for the lower edge and (locked, unlocked) pair for the upper edge of the
+    # longest locked coarse window, or None; the ends of the delay range act as unlocked points that are never probed
+    _sublists = find_true_sublists(list(coarse_locked))
+    if len(_sublists) == 0:
+        return None
+    _start_index, _sublist_len = sorted(_sublists, key=lambda x: x[1], reverse=True)[0]
+    _first_locked = coarse_delays[_start_index]
+    _last_locked = coarse_delays[_start_index + _sublist_len - 1]
+    _lower_bracket = [coarse_delays[_start_index - 1] if _start_index > 0 else delay_min - 1, _first_locked]
+    _upper_bracket = [_last_locked, coarse_delays[_start_index + _sublist_len] if _start_index + _sublist_len < len(coarse_delays) else delay_max + 1]
+    return _lower_bracket, _upper_bracket
+
+def fast_iodelay_search(probe_func, asic_list=(0, 1), delay_min=0, delay_max=511, coarse_step=16, skip_values=(320,), min_window=8, verbose=False):
+    """ Find the center of the locked IO delay window of each ASIC.
+
+    probe_func takes a list with one delay per ASIC and returns a list with one
+    lock flag per ASIC; every probe programs and reads both ASICs at once.
+    The search runs a strided coarse sweep, takes the longest locked window
+    found by find_true_sublists and bisects its lower and upper edges down to
+    single delay steps.
+    Returns a dict per ASIC with 'best_delay', 'window' and 'window_len', or
+    None for an ASIC without any locked coarse point, plus the number of probes.
+    """
+    probe_count = 0
+    coarse_delays = [_d for _d in range(delay_min, delay_max + 1, coarse_step) if _d not in skip_values]
+    coarse_locked = {_asic: [] for _asic in asic_list}
+    for _delay in coarse_delays:
+        _locked = probe_func([_delay, _delay])
+        probe_count += 1
+        for _asic in asic_list:
+            coarse_locked[_asic].append(_locked[_asic])
+
+    # * bracket the edges of the longest locked window of each ASIC
+    lower_bracket = {}
+    upper_bracket = {}
+    results = {}
+    for _asic in asic_list:
+        _brackets = _coarse_window_brackets(coarse_locked[_asic], coarse_delays, delay_min, delay_max)
+        if _brackets is None:
+            results[_asic] = None
+            if verbose:
+                print('\033[33m' + "Warning: no locked IO delay found in coarse sweep for ASIC " + str(_asic) + '\033[0m')
+            continue
+        lower_bracket[_asic], upper_bracket[_asic] = _brackets
+
+    # * bisect the lower edges of all ASICs in parallel, then the upper edges
+    for _brackets, _is_lower in ((lower_bracket, True), (upper_bracket, False)):
+        while True:
+            _probe_delays = [delay_min, delay_min]
+            _pending = {}
+            for _asic, (_left, _right) in _brackets.items():
+                if _right - _left <= 1:
+                    continue
+                _mid = _iodelay_skip_value((_left + _right) // 2, _left, _right, skip_values)
+                if _mid is None:
+                    continue
+                _probe_delays[_asic] = _mid
+                _pending[_asic] = _mid
+            if len(_pending) == 0:
+                break
+            _locked = probe_func(_probe_delays)
+            probe_count += 1
+            for _asic, _mid in _pending.items():
+                # the locked side moves towards the unlocked one
+                if _locked[_asic] == _is_lower:
+                    _brackets[_asic][1] = _mid
+                else:
+                    _brackets[_asic][0] = _mid
+
+    for _asic in lower_bracket.keys():
+        _window_low  = lower_bracket[_asic][1]
+        _window_high = upper_bracket[_asic][0]
+        _window_len  = _window_high - _window_low + 1
+        if _window_len < min_window and verbose:
+            print('\033[33m' + "Warning: narrow IO delay window for ASIC " + str(_asic) + ": " + str(_window_low) + " - " + str(_window_high) + '\033[0m')
+        _best_delay = _window_low + (_window_len - 1) // 2
+        if _best_delay in skip_values:
+            _best_delay = _iodelay_skip_value(_best_delay, _window_low - 1, _window_high + 1, skip_values)
+        results[_asic] = {
+            "best_delay": _best_delay,
+            "window": [_window_low, _window_high],
+            "window_len": _window_len
+        }
+    return results, probe_count
+
+def fast_line_delay_search(probe_func, asic_list=(0, 1), delay_min=0, delay_max=511, coarse_step=16, skip_values=(320,)):
+    """ Find the locked IO delay window of every line of each ASIC.
+
+    probe_func takes a list with the delays of each ASIC, either one delay or six
+    per-line delays, and returns the per-line lock status of each ASIC, as
+    probe_iodelay does. The coarse sweep programs one delay on all lines; the
+    edges of the longest coarse window of every line are then bisected in
+    parallel, each probe programming every line with its own midpoint.
+    Returns the centers and window widths of shape (2 asics, 6 lines) as
+    find_line_delay_centers does, the coarse lock bitmap, the coarse delays
+    and the number of probes.
+    """
+    _line_num = len(iodelay_line_names)
+    coarse_delays = [_d for _d in range(delay_min, delay_max + 1, coarse_step) if _d not in skip_values]
+    coarse_bitmap = iodelay_line_sweep(probe_func, coarse_delays)
+    probe_count = len(coarse_delays)
+
+    # * bracket the edges of the longest locked window of every line
+    lower_bracket = {}
+    upper_bracket = {}
+    for _asic in asic_list:
+        for _line in range(_line_num):
+            _brackets = _coarse_window_brackets(coarse_bitmap[:, _asic, _line], coarse_delays, delay_min, delay_max)
+            if _brackets is not None:
+                lower_bracket[(_asic, _line)], upper_bracket[(_asic, _line)] = _brackets
+
+    # * bisect the lower edges of all lines in parallel, then the upper edges
+    for _brackets, _is_lower in ((lower_bracket, True), (upper_bracket, False)):
+        while True:
+            _probe_delays = [[delay_min] * _line_num for _ in range(2)]
+            _pending = {}
+            for (_asic, _line), (_left, _right) in _brackets.items():
+                if _right - _left <= 1:
+                    continue
+                _mid = _iodelay_skip_value((_left + _right) // 2, _left, _right, skip_values)
+                if _mid is None:
+                    continue
+                _probe_delays[_asic][_line] = _mid
+                _pending[(_asic, _line)] = _mid
+            if len(_pending) == 0:
+                break
+            _locked = probe_func(_probe_delays)
+            probe_count += 1
+            for (_asic, _line), _mid in _pending.items():
+                if _locked[_asic][_line] == _is_lower:
+                    _brackets[(_asic, _line)][1] = _mid
+                else:
+                    _brackets[(_asic, _line)][0] = _mid
+
+    line_centers = np.full((2, _line_num), -1, dtype=int)
+    line_widths  = np.full((2, _line_num), -1, dtype=int)
+    for _key in lower_bracket.keys():
+        _window_low  = lower_bracket[_key][1]
+        _window_high = upper_bracket[_key][0]
+        _window_len  = _window_high - _window_low + 1
+        _center = _window_low + (_window_len - 1) // 2
+        if _center in skip_values:
+            _center = _iodelay_skip_value(_center, _window_low - 1, _window_high + 1, skip_values)
+        line_centers[_key] = _center
+        line_widths[_key]  = _window_len
+    return line_centers, line_widths, coarse_bitmap, coarse_delays, probe_count
+
+def iodelay_line_sweep(probe_func, delay_values):
+    """ Sweep one delay over all lines of both ASICs and record which lines are locked.
+
+    probe_func takes a list with one delay per ASIC and returns the per-line lock
+    status of each ASIC, as probe_iodelay does. Returns a boolean lock bitmap of
+    shape (n_delays, 2 asics, 6 lines).
+    """
+    lock_bitmap = np.zeros((len(delay_values), 2, len(iodelay_line_names)), dtype=bool)
+    for _index, _delay in enumerate(delay_values):
+        lock_bitmap[_index] = np.array(probe_func([_delay, _delay]), dtype=bool)
+    return lock_bitmap
+
+def find_delay_window_center(locked_flags, delay_values):
+    """ Return (center, first, last) delay of the longest locked window, or None if nothing is locked. """
+    _sublists = find_true_sublists(list(locked_flags))
+    if len(_sublists) == 0:
+        return None
+    _start_index, _sublist_len = sorted(_sublists, key=lambda x: x[1], reverse=True)[0]
+    _first = delay_values[_start_index]
+    _last = delay_values[_start_index + _sublist_len - 1]
+    return _first + (_last - _first) // 2, _first, _last
+
+def find_line_delay_centers(lock_bitmap, delay_values):
+    """ Compute the optimal delay of every line independently from a lock bitmap.
+
+    Returns the centers and the window widths (in delay units), both of shape
+    (2 asics, 6 lines); lines that never locked get a center and width of -1.
+    """
+    delay_values = list(delay_values)
+    line_centers = np.full(lock_bitmap.shape[1:], -1, dtype=int)
+    line_widths  = np.full(lock_bitmap.shape[1:], -1, dtype=int)
+    for _asic in range(lock_bitmap.shape[1]):
+        for _line in range(lock_bitmap.shape[2]):
+            _window = find_delay_window_center(lock_bitmap[:, _asic, _line], delay_values)
+            if _window is None:
+                continue
+            line_centers[_asic, _line] = _window[0]
+            line_widths[_asic, _line]  = _window[2] - _window[1] + 1
+    return line_centers, line_widths
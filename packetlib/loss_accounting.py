@@ -0,0 +1,153 @@
+import collections
+
+class PacketAccounting:
+    """ Count received, complete and missing half-packets per (fpga, asic, half) from the raw 40-byte lines.
+
+    Every line carries its package id (line 0-4 of the half-packet) and the
+    30-bit timestamp. A half-packet is complete when the five package ids of
+    one timestamp arrived; a timestamp seen on any half of a board is
+    expected on every half of that board that sends data, so expected minus
+    received half-packets is the loss before parsing. Timestamp steps that go
+    backwards (other than the counter wrap) and lines that arrive twice are
+    counted as well.
+    Per datagram, the 40-byte slots that extract_raw_payloads did not
+    recognise as lines are counted too; parser_skipped_line_num is for the
+    caller to count the lines its fragment parser threw away. All updates
+    are O(1) per line.
+    """
+    def __init__(self, timestamp_period=2**30, timestamp_window=256):
+        self.timestamp_period = timestamp_period
+        self.timestamp_window = timestamp_window
+        self.datagram_num = 0
+        self.unrecognised_slot_num = 0
+        self.line_num = 0
+        self.invalid_line_num = 0
+        self.parser_skipped_line_num = 0
+        self.halves = {}
+        self.board_timestamp_num = {}
+        self.board_recent_timestamps = {}
+
+    def _new_half(self):
+        return {
+            "line_num": 0,
+            "half_packet_num": 0,
+            "complete_num": 0,
+            "incomplete_num": 0,
+            "missing_line_num": 0,
+            "timestamp_backward_num": 0,
+            "duplicate_line_num": 0,
+            "current_timestamp": None,
+            "current_line_mask": 0
+        }
+
+    def _close_half_packet(self, half):
+        if half["current_timestamp"] is None:
+            return
+        _received = bin(half["current_line_mask"]).count('1')
+        if _received == 5:
+            half["complete_num"] += 1
+        else:
+            half["incomplete_num"] += 1
+            half["missing_line_num"] += 5 - _received
+
+    def add_line(self, line):
+        self.line_num += 1
+        if len(line) < 8 or not 0 <= line[3] < 5:
+            self.invalid_line_num += 1
+            return
+        _asic = line[0] - 0xA0
+        _fpga = line[1]
+        _half_index = line[2] - 0x24
+        _package_id = line[3]
+        _timestamp = int.from_bytes(line[4:8], byteorder='big') % self.timestamp_period
+        _key = (_fpga, _asic, _half_index)
+        _half = self.halves.get(_key)
+        if _half is None:
+            _half = self._new_half()
+            self.halves[_key] = _half
+        _half["line_num"] += 1
+        if _timestamp != _half["current_timestamp"]:
+            if _half["current_timestamp"] is not None:
+                _step = (_timestamp - _half["current_timestamp"]) % self.timestamp_period
+                if _step > self.timestamp_period // 2:
+                    _half["timestamp_backward_num"] += 1
+            self._close_half_packet(_half)
+            _half["current_timestamp"] = _timestamp
+            _half["current_line_mask"] = 0
+            _half["half_packet_num"] += 1
+            self._add_board_timestamp(_fpga, _timestamp)
+        elif _half["current_line_mask"] & (1 << _package_id):
+            _half["duplicate_line_num"] += 1
+        _half["current_line_mask"] |= 1 << _package_id
+
+    def _add_board_timestamp(self, fpga, timestamp):
+        _recent = self.board_recent_timestamps.setdefault(fpga, collections.OrderedDict())
+        if timestamp in _recent:
+            return
+        _recent[timestamp] = None
+        if len(_recent) > self.timestamp_window:
+            _recent.popitem(last=False)
+        self.board_timestamp_num[fpga] = self.board_timestamp_num.get(fpga, 0) + 1
+
+    def add_lines(self, lines):
+        for _line in lines:
+            self.add_line(_line)
+
+    def add_datagram(self, data, lines):
+        """ Count one datagram and the lines extract_raw_payloads found in it. """
+        self.datagram_num += 1
+        self.unrecognised_slot_num += max((len(data) - 12) // 40 - len(lines), 0)
+        self.add_lines(lines)
+
+    def merge(self, other):
+        """ Add the counters of another PacketAccounting, e.g. of the receiver process of another board. """
+        self.datagram_num += other.datagram_num
+        self.unrecognised_slot_num += other.unrecognised_slot_num
+        self.line_num += other.line_num
+        self.invalid_line_num += other.invalid_line_num
+        self.parser_skipped_line_num += other.parser_skipped_line_num
+        for _key, _other_half in other.halves.items():
+            _half = self.halves.get(_key)
+            if _half is None:
+                self.halves[_key] = dict(_other_half)
+                continue
+            for _name, _value in _other_half.items():
+                if not _name.startswith("current_"):
+                    _half[_name] += _value
+        for _fpga, _timestamp_num in other.board_timestamp_num.items():
+            self.board_timestamp_num[_fpga] = self.board_timestamp_num.get(_fpga, 0) + _timestamp_num
+
+    def report(self):
+        """ Return the counters per half ('fpga_asic_half') and their totals; the half-packet being received is not judged yet. """
+        _halves = {}
+        _totals = collections.Counter()
+        for (_fpga, _asic, _half_index), _half in sorted(self.halves.items()):
+            _expected = self.board_timestamp_num.get(_fpga, 0)
+            _counters = {_name: _value for _name, _value in _half.items() if not _name.startswith("current_")}
+            _counters["expected_num"] = _expected
+            _counters["missing_half_packet_num"] = max(_expected - _half["half_packet_num"], 0)
+            _halves[f"{_fpga}_{_asic}_{_half_index}"] = _counters
+            _totals.update(_counters)
+        _totals = dict(_totals)
+        _totals["datagram_num"] = self.datagram_num
+        _totals["unrecognised_slot_num"] = self.unrecognised_slot_num
+        _totals["line_num"] = self.line_num
+        _totals["invalid_line_num"] = self.invalid_line_num
+        _totals["parser_skipped_line_num"] = self.parser_skipped_line_num
+        return {"halves": _halves, "totals": _totals}
+
+    def loss_summary(self):
+        """ Short live summary: missing/expected half-packets, missing lines, unrecognised slots and parser-skipped lines. """
+        _missing_half_packets = 0
+        _missing_lines = 0
+        _expected = 0
+        for (_fpga, _asic, _half_index), _half in self.halves.items():
+            _expected += self.board_timestamp_num.get(_fpga, 0)
+            _missing_half_packets += max(self.board_timestamp_num.get(_fpga, 0) - _half["half_packet_num"], 0)
+            _missing_lines += _half["missing_line_num"]
+        return {
+            "lost": f"{_missing_half_packets}/{_expected}",
+            "lines": _missing_lines,
+            "slots": self.unrecognised_slot_num,
+            "parser": self.parser_skipped_line_num
+        }
@@ -0,0 +1,144 @@
+from .data_packet import *
+from .acquisition import *
+from .decoder import *
+from .histogram import *
+import collections
+import socket
+import time
+import numpy as np
+
+monitor_default_port = 11100
+
+class MonitorSender:
+    """ Forward a sample of the received datagrams to a local online monitor.
+
+    offer is called for every datagram of the acquisition loop; at most
+    max_rate datagrams per second are sent on a non-blocking UDP socket and a
+    busy or absent monitor only drops datagrams, so monitoring never holds up
+    the acquisition.
+    """
+    def __init__(self, port=monitor_default_port, host="127.0.0.1", max_rate=200):
+        self.address = (host, port)
+        self.min_interval = 1.0 / max_rate if max_rate > 0 else 0
+        self.last_send_time = 0
+        self.sent_num = 0
+        self.dropped_num = 0
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+    def offer(self, data):
+        _now = time.monotonic()
+        if _now - self.last_send_time < self.min_interval:
+            return
+        self.last_send_time = _now
+        try:
+            self.socket.sendto(data, self.address)
+            self.sent_num += 1
+        except OSError:
+            self.dropped_num += 1
+
+    def close(self):
+        self.socket.close()
+
+class OnlineMonitor:
+    """ Rolling per-channel ADC/ToT/ToA histograms, hit maps and rates of sampled datagrams.
+
+    The monitor works on half-packets, so a datagram sample does not need to
+    hold complete events. The window is kept as slice_num slices of
+    slice_seconds; the oldest slice is dropped as a new one starts, and
+    snapshot sums the slices of the window.
+    """
+    def __init__(self, board_num=2, slice_seconds=5.0, slice_num=12, bins=64):
+        self.board_num = board_num
+        self.channel_num = board_num * 152
+        self.slice_seconds = slice_seconds
+        self.bins = bins
+        self.slices = collections.deque(maxlen=slice_num)
+        self.datagram_num = 0
+        self._new_slice(time.monotonic())
+
+    def _new_slice(self, now):
+        self.slices.append({
+            "start_time": now,
+            "adc": ChannelHistogram2D(channel_num=self.channel_num, bins=self.bins, value_range=(0, 1024)),
+            "tot": ChannelHistogram2D(channel_num=self.channel_num, bins=self.bins, value_range=(0, 4096)),
+            "toa": ChannelHistogram2D(channel_num=self.channel_num, bins=self.bins, value_range=(0, 1024)),
+            "hits": np.zeros(self.channel_num, dtype=np.int64),
+            "saturated": np.zeros(self.channel_num, dtype=np.int64),
+            "half_packets": np.zeros(self.board_num * 4, dtype=np.int64),
+            "daqh_bad": np.zeros(self.board_num * 4, dtype=np.int64)
+        })
+
+    def add_datagram(self, data, now=None):
+        """ Decode the half-packets of one datagram into the current slice. """
+        if now is None:
+            now = time.monotonic()
+        if now - self.slices[-1]["start_time"] >= self.slice_seconds:
+            self._new_slice(now)
+        self.datagram_num += 1
+        _payloads = extract_raw_payloads(data)
+        _halves, _words, _daqh = [], [], []
+        for _start in range(0, len(_payloads) - 4, 5):
+            _fragment = _payloads[_start:_start+5]
+            _half_index = fragment_half_index(_fragment)
+            _board = _fragment[0][1]
+            if _board >= self.board_num or not 0 <= _half_index < 4:
+                continue
+            _half_words, _half_daqh = event_channel_words({_half_index: _fragment})
+            _halves.append(_board * 4 + _half_index)
+            _words.append(_half_words[_half_index*38:(_half_index+1)*38])
+            _daqh.append(int.from_bytes(bytes(_half_daqh[_half_index]), byteorder='big'))
+        if len(_halves) == 0:
+            return
+        _halves = np.array(_halves)
+        _slice = self.slices[-1]
+        _slice["half_packets"] += np.bincount(_halves, minlength=self.board_num * 4)
+        _good = daqh_is_good(np.array(_daqh, dtype=np.uint32))
+        _slice["daqh_bad"] += np.bincount(_halves[~_good], minlength=self.board_num * 4)
+        _decoded = decode_channel_words(np.array(_words)[_good])
+        _columns = _halves[_good][:, np.newaxis] * 38 + np.arange(38)
+        for _name in ("adc", "tot", "toa"):
+            _slice[_name].fill(_columns, _decoded[_name], mask=_decoded[_name + "_valid"])
+        _slice["hits"] += np.bincount(_columns[_decoded["toa_valid"]], minlength=self.channel_num)
+        _slice["saturated"] += np.bincount(_columns[_decoded["adc_valid"] & (_decoded["adc"] >= 1023)], minlength=self.channel_num)
+
+    def snapshot(self, now=None):
+        """ Sum the slices of the window into a JSON-serializable summary.
+
+        Per half: half-packet rate [Hz] and bad DaqH fraction. Per channel:
+        occupancy (ToA hits per half-packet), mean ADC, saturated ADC fraction,
+        and 'dead' for channels of live halves whose ADC never left the lowest bin.
+        """
+        if now is None:
+            now = time.monotonic()
+        _window = max(now - self.slices[0]["start_time"], 1e-6)
+        _sum = {_name: sum(_slice[_name] for _slice in self.slices) for _name in ("hits", "saturated", "half_packets", "daqh_bad")}
+        _adc_counts = sum(_slice["adc"].counts for _slice in self.slices)
+        _adc_centers = (self.slices[0]["adc"].y_edges()[:-1] + self.slices[0]["adc"].y_edges()[1:]) / 2
+        _adc_entries = _adc_counts.sum(axis=1)
+        _channel_packets = np.repeat(_sum["half_packets"] - _sum["daqh_bad"], 38)[:self.channel_num]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            _adc_mean = np.where(_adc_entries > 0, (_adc_counts * _adc_centers).sum(axis=1) / _adc_entries, 0)
+            _occupancy = np.where(_channel_packets > 0, _sum["hits"] / _channel_packets, 0)
+            _saturated = np.where(_adc_entries > 0, _sum["saturated"] / _adc_entries, 0)
+            _daqh_bad = np.where(_sum["half_packets"] > 0, _sum["daqh_bad"] / _sum["half_packets"], 0)
+        # the last word of each half is not a channel
+        _dead = (_channel_packets > 0) & (_adc_counts[:, 1:].sum(axis=1) == 0) & (np.arange(self.channel_num) % 38 != 37)
+        return {
+            "window_seconds": _window,
+            "datagram_num": self.datagram_num,
+            "half_packet_rate": (_sum["half_packets"] / _window).reshape(self.board_num, 4).tolist(),
+            "daqh_bad_fraction": _daqh_bad.reshape(self.board_num, 4).tolist(),
+            "occupancy": _occupancy.reshape(self.board_num, 152).tolist(),
+            "adc_mean": _adc_mean.reshape(self.board_num, 152).tolist(),
+            "saturated_fraction": _saturated.reshape(self.board_num, 152).tolist(),
+            "dead": _dead.reshape(self.board_num, 152).tolist()
+        }
+
+    def histograms(self):
+        """ Return the window's per-channel 'adc', 'tot' and 'toa' counts, shape (board_num, 152, bins), with their bin edges. """
+        _histograms = {}
+        for _name in ("adc", "tot", "toa"):
+            _histograms[_name] = sum(_slice[_name].counts for _slice in self.slices).reshape(self.board_num, 152, self.bins)
+            _histograms[_name + "_edges"] = self.slices[0][_name].y_edges()
+        return _histograms
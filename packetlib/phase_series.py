@@ -0,0 +1,86 @@
+from .decoder import *
+from .run_file import *
+import multiprocessing
+import os
+import numpy as np
+
+def decode_run_file_values(file_path, board=None, max_event_num=None, fragment_life=100, batch_size=4096):
+    """ Decode the raw val0, val1, val2 fields of all events of a run file into (n_events, 152) uint16 arrays.
+
+    The values of a half with a bad DaqH are set to 0. Also returns the
+    'timestamp' of every event and the number of events 'event_num'.
+    """
+    _val0, _val1, _val2, _timestamps = [], [], [], []
+    _event_num = 0
+    for _batch in iter_run_file_batches(file_path, batch_size=batch_size, fragment_life=fragment_life, board=board):
+        _words = _batch["words"]
+        _timestamp = _batch["timestamp"]
+        if max_event_num is not None:
+            _words = _words[:max_event_num - _event_num]
+            _timestamp = _timestamp[:max_event_num - _event_num]
+        _good = np.repeat(daqh_is_good(_batch["daqh"][:len(_words)]), 38, axis=1)
+        _words = np.where(_good, _words, 0)
+        _val0.append(((_words >> 20) & 0x3FF).astype(np.uint16))
+        _val1.append(((_words >> 10) & 0x3FF).astype(np.uint16))
+        _val2.append((_words & 0x3FF).astype(np.uint16))
+        _timestamps.append(_timestamp)
+        _event_num += len(_words)
+        if max_event_num is not None and _event_num >= max_event_num:
+            break
+    if _event_num == 0:
+        _empty = np.zeros((0, 152), dtype=np.uint16)
+        return {"val0": _empty, "val1": _empty, "val2": _empty, "timestamp": np.zeros(0, dtype=np.uint32), "event_num": 0}
+    return {
+        "val0": np.concatenate(_val0),
+        "val1": np.concatenate(_val1),
+        "val2": np.concatenate(_val2),
+        "timestamp": np.concatenate(_timestamps),
+        "event_num": _event_num
+    }
+
+def _phase_series_worker(task):
+    _file_path, _board, _max_event_num, _fragment_life, _reduce = task
+    _values = decode_run_file_values(_file_path, board=_board, max_event_num=_max_event_num, fragment_life=_fragment_life)
+    if _reduce is not None:
+        return _reduce(_values)
+    return _values
+
+def load_phase_series(file_paths, board=None, max_event_num=None, fragment_life=100, reduce=None, processes=None, progress=None):
+    """ Decode the run files of a scan concurrently, one file per worker process.
+
+    Without reduce, returns 'val0', 'val1', 'val2' stacked as (n_files,
+    n_events, 152) uint16, 'timestamp' as (n_files, n_events) and the
+    'event_num' of each file; files with fewer events are padded with 0. With
+    reduce, a function called in the worker with the decoded values of one
+    file (e.g. to fill per-phase histograms), returns the list of its results.
+    Workers are forked, as in render_channel_gallery; without fork the files
+    are decoded in this process. progress is an optional wrapper for the
+    result iterator, e.g. tqdm.
+    """
+    _tasks = [(_file_path, board, max_event_num, fragment_life, reduce) for _file_path in file_paths]
+    if processes is None:
+        processes = min(os.cpu_count() or 1, len(_tasks))
+    if processes > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        with multiprocessing.get_context('fork').Pool(processes) as pool:
+            _results = pool.imap(_phase_series_worker, _tasks)
+            if progress is not None:
+                _results = progress(_results, total=len(_tasks))
+            _results = list(_results)
+    else:
+        _results = map(_phase_series_worker, _tasks)
+        if progress is not None:
+            _results = progress(_results, total=len(_tasks))
+        _results = list(_results)
+    if reduce is not None:
+        return _results
+
+    _event_nums = np.array([_result["event_num"] for _result in _results], dtype=np.int64)
+    _max_event_num = int(_event_nums.max()) if len(_results) > 0 else 0
+    phase_series = {"event_num": _event_nums}
+    for _name in ("val0", "val1", "val2"):
+        phase_series[_name] = np.zeros((len(_results), _max_event_num, 152), dtype=np.uint16)
+    phase_series["timestamp"] = np.zeros((len(_results), _max_event_num), dtype=np.uint32)
+    for _index, _result in enumerate(_results):
+        for _name in ("val0", "val1", "val2", "timestamp"):
+            phase_series[_name][_index, :_result["event_num"]] = _result[_name]
+    return phase_series
@@ -0,0 +1,68 @@
+from .acquisition import *
+from .decoder import *
+from .zero_suppression import *
+from .compressed_stream import *
+import numpy as np
+
+def iter_run_file_lines(file_path, board=None):
+    """ Yield the 40-byte lines of a hex text run file, skipping comments and other boards. """
+    with open_run_file(file_path) as f:
+        for line in f:
+            if line.startswith('#') or line.startswith(sparse_event_line_tag + ' '):
+                continue
+            _line_bytes = bytearray.fromhex(line)
+            if len(_line_bytes) < 8:
+                continue
+            if board is not None and _line_bytes[1] != board:
+                continue
+            yield _line_bytes
+
+def iter_run_file_events(file_path, fragment_life=100, board=None):
+    """ Yield (event_key, halves) for every complete event of a run file, event_key being (board, timestamp). """
+    extracted_payloads_pool = []
+    event_builder = EventBuilder(fragment_life)
+    for _line_bytes in iter_run_file_lines(file_path, board=board):
+        extracted_payloads_pool.append(_line_bytes)
+        while len(extracted_payloads_pool) >= 5:
+            is_packet_good, event_fragment = check_event_fragment(extracted_payloads_pool[:5])
+            if not is_packet_good:
+                extracted_payloads_pool = extracted_payloads_pool[1:]
+                continue
+            extracted_payloads_pool = extracted_payloads_pool[5:]
+            _event = event_builder.add_fragment(event_fragment)
+            if _event is not None:
+                yield _event
+        event_builder.age()
+
+def _event_batch(boards, timestamps, words, daqh):
+    return {
+        "board": np.array(boards, dtype=np.uint8),
+        "timestamp": np.array(timestamps, dtype=np.uint32),
+        "words": np.array(words, dtype=np.uint32).reshape(-1, 152),
+        "daqh": np.array(daqh, dtype=np.uint32).reshape(-1, 4)
+    }
+
+def iter_run_file_batches(file_path, batch_size=4096, fragment_life=100, board=None):
+    """ Yield the events of a run file in batches of at most batch_size events.
+
+    Each batch holds 'board' and 'timestamp' (n,), the raw channel words
+    'words' (n, 152) and the DaqH word of each half 'daqh' (n, 4), so the
+    memory is bounded by the batch size whatever the length of the run.
+    Zero-suppressed (sparse) run files are read as well; their batches also
+    hold the 'hit_mask' and the suppressed channels have word 0.
+    """
+    if is_sparse_run_file(file_path):
+        yield from iter_sparse_run_file_batches(file_path, batch_size=batch_size, board=board)
+        return
+    _boards, _timestamps, _words, _daqh = [], [], [], []
+    for _event_key, _halves in iter_run_file_events(file_path, fragment_life=fragment_life, board=board):
+        _event_words, _event_daqh = event_channel_words(_halves)
+        _boards.append(_event_key[0])
+        _timestamps.append(_event_key[1])
+        _words.append(_event_words)
+        _daqh.append([int.from_bytes(bytes(_d), byteorder='big') if _d is not None else 0 for _d in _event_daqh])
+        if len(_boards) >= batch_size:
+            yield _event_batch(_boards, _timestamps, _words, _daqh)
+            _boards, _timestamps, _words, _daqh = [], [], [], []
+    if len(_boards) > 0:
+        yield _event_batch(_boards, _timestamps, _words, _daqh)
@@ -0,0 +1,126 @@
+import json
+import os
+import time
+
+def run_report_path(output_path):
+    """ Return the path of the JSON run report next to a run file: 'data/run.txt.h2gz' -> 'data/run_report.json'. """
+    _base = output_path
+    for _extension in ('.h2gz', '.txt'):
+        if _base.endswith(_extension):
+            _base = _base[:-len(_extension)]
+    return _base + "_report.json"
+
+def udp_socket_drops(_socket):
+    """ Return the kernel drop counter of a UDP socket from /proc/net/udp, or None where it is not available. """
+    try:
+        _inode = os.fstat(_socket.fileno()).st_ino
+        for _table in ('/proc/net/udp', '/proc/net/udp6'):
+            if not os.path.exists(_table):
+                continue
+            with open(_table, 'r') as f:
+                next(f)
+                for line in f:
+                    _fields = line.split()
+                    # columns: sl local remote st tx:rx tr:when retrnsmt uid timeout inode ref pointer drops
+                    if len(_fields) >= 13 and int(_fields[9]) == _inode:
+                        return int(_fields[12])
+    except (OSError, ValueError):
+        pass
+    return None
+
+class RunReport:
+    """ Collect the phase durations, timers, counters and high-water marks of an acquisition run.
+
+    Phases are consecutive: start_phase ends the running phase. Timers keep
+    the total, count and maximum of the durations added to them, counters are
+    plain sums and high-water marks keep the largest value recorded. Rates
+    are computed over the 'acquisition' phase, and every timer is also given
+    per half-packet and per event when those counters are set.
+    """
+    def __init__(self, info=None):
+        self.info = {} if info is None else dict(info)
+        self.phases = {}
+        self.timers = {}
+        self.counters = {}
+        self.high_water = {}
+        self.sections = {}
+        self.start_time = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+        self._phase = None
+        self._phase_start = None
+
+    def start_phase(self, name):
+        self.end_phase()
+        self._phase = name
+        self._phase_start = time.perf_counter()
+
+    def end_phase(self):
+        if self._phase is None:
+            return
+        self.phases[self._phase] = self.phases.get(self._phase, 0.0) + time.perf_counter() - self._phase_start
+        self._phase = None
+
+    def add_time(self, name, seconds):
+        _timer = self.timers.get(name)
+        if _timer is None:
+            self.timers[name] = [seconds, 1, seconds]
+            return
+        _timer[0] += seconds
+        _timer[1] += 1
+        if seconds > _timer[2]:
+            _timer[2] = seconds
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_high_water(self, name, value):
+        if value is not None and value > self.high_water.get(name, -1):
+            self.high_water[name] = value
+
+    def add_section(self, name, content):
+        """ Add a JSON-serialisable block of results, e.g. the acquisition shortfall. """
+        self.sections[name] = content
+
+    def to_dict(self):
+        self.end_phase()
+        _acquisition_seconds = self.phases.get("acquisition", 0.0)
+        _rates = {}
+        if _acquisition_seconds > 0:
+            for _name in ("datagram_num", "byte_num", "half_packet_num", "event_num"):
+                if _name in self.counters:
+                    _rates[_name[:-len("_num")] + "s_per_second"] = self.counters[_name] / _acquisition_seconds
+        _timers = {}
+        for _name, (_total, _count, _max) in self.timers.items():
+            _timers[_name] = {"total_seconds": _total, "count": _count, "mean_seconds": _total / _count, "max_seconds": _max}
+            if self.counters.get("half_packet_num", 0) > 0:
+                _timers[_name]["seconds_per_half_packet"] = _total / self.counters["half_packet_num"]
+            if self.counters.get("event_num", 0) > 0:
+                _timers[_name]["seconds_per_event"] = _total / self.counters["event_num"]
+        return {
+            "info": self.info,
+            "start_time": self.start_time,
+            "end_time": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime()),
+            "phase_seconds": self.phases,
+            "rates": _rates,
+            "timers": _timers,
+            "counters": self.counters,
+            "high_water": self.high_water,
+            **self.sections
+        }
+
+    def summary_lines(self):
+        """ Return a few human readable lines of the report for the log. """
+        _report = self.to_dict()
+        _lines = ["Phases: " + ', '.join([f"{_name} {_seconds:.2f} s" for _name, _seconds in _report["phase_seconds"].items()])]
+        if len(_report["rates"]) > 0:
+            _lines.append("Rates: " + ', '.join([f"{_name} {_value:.1f}" for _name, _value in _report["rates"].items()]))
+        for _name, _timer in _report["timers"].items():
+            _lines.append(f"Timer {_name}: mean {_timer['mean_seconds']*1e6:.1f} us, max {_timer['max_seconds']*1e3:.2f} ms over {_timer['count']}")
+        if len(_report["counters"]) > 0:
+            _lines.append("Counters: " + ', '.join([f"{_name} {_value}" for _name, _value in _report["counters"].items()]))
+        if len(_report["high_water"]) > 0:
+            _lines.append("High-water marks: " + ', '.join([f"{_name} {_value}" for _name, _value in _report["high_water"].items()]))
+        return _lines
+
+    def save(self, file_path):
+        with open(file_path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=4)
@@ -0,0 +1,141 @@
+from .compressed_stream import *
+from .run_file import *
+import json
+import os
+import time
+
+def run_manifest_path(base_path):
+    return base_path + "_manifest.json"
+
+def run_segment_path(base_path, segment_index, extension='.txt'):
+    return f"{base_path}_seg{segment_index:04d}{extension}"
+
+class SegmentedRunWriter:
+    """ Text output that rotates into numbered segment files and keeps a run manifest.
+
+    Use it like a file opened with 'w' and call end_record after every
+    complete record (a half-packet or an event) with its timestamp; a new
+    segment is only started at a record boundary, once the segment has
+    max_bytes bytes or max_records records. The comment lines written
+    before the first record are the header and are repeated at the top of
+    every segment; a segment is only opened when something is written to it.
+    The manifest (<base>_manifest.json) is rewritten whenever a segment is
+    opened or closed, so closed segments can be used while the run goes on.
+    With codec, segments are compressed block streams.
+    """
+    def __init__(self, base_path, max_bytes=None, max_records=None, codec=None):
+        self.base_path = base_path
+        self.max_bytes = max_bytes
+        self.max_records = max_records
+        self.codec = codec
+        self.extension = '.txt' if codec is None else '.txt.h2gz'
+        self.header = []
+        self.record_num = 0
+        self.segments = []
+        self.queue_high_water = 0
+        self._output_file = None
+        self._segment = None
+        self._rotate_pending = False
+        self._open_segment()
+
+    def _open_segment(self):
+        _segment_index = len(self.segments)
+        _segment_path = run_segment_path(self.base_path, _segment_index, self.extension)
+        if self.codec is None:
+            self._output_file = open(_segment_path, 'w')
+        else:
+            self._output_file = CompressedBlockWriter(_segment_path, codec=self.codec)
+        self._segment = {
+            "index": _segment_index,
+            "file": os.path.basename(_segment_path),
+            "first_record": self.record_num,
+            "record_num": 0,
+            "first_timestamp": None,
+            "last_timestamp": None,
+            "size": 0,
+            "start_time": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime()),
+            "end_time": None,
+            "closed": False
+        }
+        self.segments.append(self._segment)
+        for _text in self.header:
+            self._output_file.write(_text)
+        if _segment_index > 0:
+            self._output_file.write(f"# Segment: {_segment_index}\n")
+        self._write_manifest(False)
+
+    def _close_segment(self):
+        self._output_file.close()
+        self.queue_high_water = max(self.queue_high_water, getattr(self._output_file, 'queue_high_water', 0))
+        self._segment["end_time"] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+        self._segment["closed"] = True
+
+    def _write_manifest(self, complete):
+        _manifest = {
+            "base_path": os.path.basename(self.base_path),
+            "complete": complete,
+            "record_num": self.record_num,
+            "segments": self.segments
+        }
+        _manifest_path = run_manifest_path(self.base_path)
+        # write and rename, so readers never see a half-written manifest
+        with open(_manifest_path + ".tmp", 'w') as f:
+            json.dump(_manifest, f, indent=4)
+        os.replace(_manifest_path + ".tmp", _manifest_path)
+
+    def write(self, text):
+        if self._rotate_pending:
+            self._rotate_pending = False
+            self._open_segment()
+        if self.record_num == 0 and text.startswith('#'):
+            self.header.append(text)
+        self._segment["size"] += len(text)
+        return self._output_file.write(text)
+
+    def end_record(self, timestamp=None, record_num=1):
+        """ Mark the end of a complete record; rotate if the segment is full. """
+        self.record_num += record_num
+        self._segment["record_num"] += record_num
+        if timestamp is not None:
+            if self._segment["first_timestamp"] is None:
+                self._segment["first_timestamp"] = int(timestamp)
+            self._segment["last_timestamp"] = int(timestamp)
+        _full = (self.max_bytes is not None and self._segment["size"] >= self.max_bytes) or (self.max_records is not None and self._segment["record_num"] >= self.max_records)
+        if _full and not self._rotate_pending:
+            self._close_segment()
+            self._rotate_pending = True
+            self._write_manifest(False)
+
+    def flush(self):
+        """ Flush the open segment, e.g. for a reader of the live segment. """
+        if self._output_file is not None and not self._rotate_pending:
+            self._output_file.flush()
+
+    def close(self):
+        if self._output_file is None:
+            return
+        if not self._rotate_pending:
+            self._close_segment()
+        self._output_file = None
+        self._write_manifest(True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def load_run_manifest(manifest_path):
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+def run_segment_paths(manifest_path, closed_only=True):
+    """ Return the paths of the segments of a run, only the closed ones unless closed_only is False. """
+    _manifest = load_run_manifest(manifest_path)
+    _folder = os.path.dirname(manifest_path)
+    return [os.path.join(_folder, _segment["file"]) for _segment in _manifest["segments"] if _segment["closed"] or not closed_only]
+
+def iter_segmented_run_batches(manifest_path, batch_size=4096, fragment_life=100, board=None, closed_only=True):
+    """ Yield the event batches of all segments of a run in order, as iter_run_file_batches does for one file. """
+    for _segment_path in run_segment_paths(manifest_path, closed_only=closed_only):
+        yield from iter_run_file_batches(_segment_path, batch_size=batch_size, fragment_life=fragment_life, board=board)
@@ -0,0 +1,164 @@
+from .socket_wrapper import *
+from .acquisition import *
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import time
+
+scan_stage_names = ["configure", "acquire", "reduce", "reduce_wait"]
+
+class ScanDefinition:
+    """ Declarative description of a parameter scan.
+
+    parameter_grid maps each parameter name to its values; the points are the
+    product of all values, the first parameter being the outermost loop.
+    register_mappings are functions taking a point and returning a list of
+    (asic_num, sub_addr, data) I2C writes; configure is an optional function for
+    other per-point settings (e.g. generator parameters). acquire takes a point
+    and returns the raw measurement, reduce takes the point and that
+    measurement and returns the result stored for the point. is_good takes
+    the point and the raw measurement and tells whether the point is complete;
+    without it every point whose registers were written is.
+    """
+    def __init__(self, parameter_grid, acquire, reduce=None, register_mappings=None, configure=None, is_good=None):
+        self.parameter_grid = dict(parameter_grid)
+        self.acquire = acquire
+        self.reduce = reduce
+        self.register_mappings = list(register_mappings) if register_mappings is not None else []
+        self.configure = configure
+        self.is_good = is_good
+
+    def points(self):
+        _names = list(self.parameter_grid.keys())
+        for _values in itertools.product(*[list(self.parameter_grid[_name]) for _name in _names]):
+            yield dict(zip(_names, _values))
+
+    def point_num(self):
+        _num = 1
+        for _values in self.parameter_grid.values():
+            _num *= len(list(_values))
+        return _num
+
+def generator_acquisition(_socket, addr, port, fpga_addr, top_reg_runLR, top_reg_offLR, event_num, top_mapping=None, fragment_life=5, idle_timeout=None, deadline=None, verbose=False):
+    """ Return an acquire function running the generator once per scan point.
+
+    top_mapping(point, runLR, offLR) can return modified copies of the Top
+    register contents, e.g. for a phase scan. idle_timeout and deadline
+    apply to every point, see collect_events.
+    """
+    def _acquire(point):
+        _runLR = list(top_reg_runLR)
+        _offLR = list(top_reg_offLR)
+        if top_mapping is not None:
+            _runLR, _offLR = top_mapping(point, _runLR, _offLR)
+        return measure_events(_socket, addr, port, fpga_addr, _runLR, _offLR, event_num, fragment_life=fragment_life, idle_timeout=idle_timeout, deadline=deadline, verbose=verbose)
+    return _acquire
+
+class ScanExecutor:
+    """ Run a ScanDefinition with the reduction of a point overlapping the next point.
+
+    Configuration and acquisition need the socket and run in the calling
+    thread; the reduction of point k runs in a worker thread while point k+1
+    is configured and acquired. Register writes whose content did not change
+    since the previous point are skipped. The time spent in each stage is
+    kept in stage_times, the points that failed a register write or is_good
+    in failed_points.
+    """
+    def __init__(self, _socket, addr, port, fpga_addr, retry=3, verbose=False):
+        self.socket = _socket
+        self.addr = addr
+        self.port = port
+        self.fpga_addr = fpga_addr
+        self.retry = retry
+        self.verbose = verbose
+        self.register_cache = {}
+        self.stage_times = {_stage: [] for _stage in scan_stage_names}
+        self.failed_points = []
+        self.wall_time = 0.0
+
+    def write_registers(self, point, register_mappings):
+        write_ok = True
+        for _mapping in register_mappings:
+            for _asic_num, _sub_addr, _data in _mapping(point):
+                _data = list(_data)
+                if self.register_cache.get((_asic_num, _sub_addr)) == _data:
+                    continue
+                if send_check_i2c_wrapper(self.socket, self.addr, self.port, asic_num=_asic_num, fpga_addr=self.fpga_addr, sub_addr=_sub_addr, reg_addr=0x00, data=_data, retry=self.retry, verbose=False):
+                    self.register_cache[(_asic_num, _sub_addr)] = _data
+                else:
+                    write_ok = False
+                    # write again at the next point, the content on the chip is unknown
+                    self.register_cache.pop((_asic_num, _sub_addr), None)
+                    if self.verbose:
+                        print('\033[33m' + "Warning: failed to write sub address " + hex(_sub_addr) + " of ASIC " + str(_asic_num) + '\033[0m')
+        return write_ok
+
+    def _timed_reduce(self, reduce_func, point, measurement):
+        _start = time.perf_counter()
+        _result = reduce_func(point, measurement)
+        self.stage_times["reduce"].append(time.perf_counter() - _start)
+        return _result
+
+    def run(self, scan, journal=None, progress=None):
+        """ Run all points of the scan and return a list of (point, result).
+
+        Points already in the journal are not measured again, their stored data
+        is returned instead; new results are recorded in the journal only when
+        the point is good, so a resumed scan measures failed points again.
+        progress is an optional wrapper for the point iterator, e.g. tqdm.
+        """
+        reduce_func = scan.reduce if scan.reduce is not None else (lambda point, measurement: measurement)
+        results = []
+        pending = None
+        _points = scan.points()
+        if progress is not None:
+            _points = progress(_points, total=scan.point_num())
+        _wall_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=1) as reduce_pool:
+            for _point in _points:
+                if journal is not None and journal.is_done(_point):
+                    results.append([_point, journal.get_data(_point)])
+                    continue
+
+                _start = time.perf_counter()
+                _write_ok = self.write_registers(_point, scan.register_mappings)
+                if scan.configure is not None:
+                    scan.configure(_point)
+                self.stage_times["configure"].append(time.perf_counter() - _start)
+
+                _start = time.perf_counter()
+                _measurement = scan.acquire(_point)
+                self.stage_times["acquire"].append(time.perf_counter() - _start)
+                _good = _write_ok and (scan.is_good is None or scan.is_good(_point, _measurement))
+                if not _good:
+                    self.failed_points.append(_point)
+
+                if pending is not None:
+                    self._collect(pending, journal)
+                _entry = [_point, None]
+                results.append(_entry)
+                pending = (_entry, _good, reduce_pool.submit(self._timed_reduce, reduce_func, _point, _measurement))
+            if pending is not None:
+                self._collect(pending, journal)
+        self.wall_time += time.perf_counter() - _wall_start
+        return [tuple(_entry) for _entry in results]
+
+    def _collect(self, pending, journal):
+        _entry, _good, _future = pending
+        _start = time.perf_counter()
+        _entry[1] = _future.result()
+        self.stage_times["reduce_wait"].append(time.perf_counter() - _start)
+        if journal is not None and _good:
+            journal.record(_entry[0], _entry[1])
+
+    def timing_summary(self):
+        """ Return the total, mean and max time and the count of each stage, plus the wall time. """
+        summary = {}
+        for _stage, _times in self.stage_times.items():
+            summary[_stage] = {
+                "total": sum(_times),
+                "mean": sum(_times) / len(_times) if len(_times) > 0 else 0.0,
+                "max": max(_times) if len(_times) > 0 else 0.0,
+                "count": len(_times)
+            }
+        summary["wall"] = self.wall_time
+        return summary
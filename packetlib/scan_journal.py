@@ -0,0 +1,191 @@
+import json
+import os
+import shutil
+import time
+import numpy as np
+
+def _journal_serializable(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (bytes, bytearray)):
+        return value.hex()
+    if isinstance(value, dict):
+        return {str(k): _journal_serializable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_journal_serializable(v) for v in value]
+    return value
+
+def scan_point_key(params):
+    return json.dumps(_journal_serializable(params), sort_keys=True)
+
+def find_latest_scan_journal(folder, script_id):
+    """ Return the newest journal file of a script in the folder, or None. """
+    if not os.path.exists(folder):
+        return None
+    prefix = script_id + "_journal_"
+    candidates = [f for f in os.listdir(folder) if f.startswith(prefix) and f.endswith('.jsonl')]
+    if len(candidates) == 0:
+        return None
+    candidates.sort(reverse=True)
+    return os.path.join(folder, candidates[0])
+
+class ScanJournal:
+    """ Append-only journal of finished scan points.
+
+    The first line holds the header (board configuration and output paths),
+    every following line one completed point with its parameters, data and
+    timestamp. A point that writes a data file is announced with start before
+    it is measured, so the files of points that never finished are known on
+    resume. Each record is flushed and synced before the scan moves on, so
+    an interrupted scan can be resumed from the last finished point.
+    """
+    def __init__(self, journal_path, header=None, resume=False):
+        self.journal_path = journal_path
+        self.header = {}
+        self.points = {}
+        self.started = {}
+        if resume and os.path.exists(journal_path):
+            self.load_journal()
+            self.journal_file = open(journal_path, 'a')
+            # terminate a line cut by the interruption before appending
+            if self.journal_file.tell() > 0:
+                with open(journal_path, 'rb') as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        self.journal_file.write('\n')
+        else:
+            self.header = _journal_serializable(header) if header is not None else {}
+            self.journal_file = open(journal_path, 'w')
+            self._write_record({"type": "header", "time": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime()), "header": self.header})
+
+    def load_journal(self):
+        with open(self.journal_path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line can be cut if the scan was killed while writing
+                    print('\033[33m' + "Warning: skipping corrupted journal line in " + self.journal_path + '\033[0m')
+                    continue
+                if record.get("type") == "header":
+                    self.header = record.get("header", {})
+                elif record.get("type") == "point":
+                    self.points[scan_point_key(record["params"])] = record
+                elif record.get("type") == "start":
+                    self.started.setdefault(scan_point_key(record["params"]), []).append(record["data_file"])
+
+    def _write_record(self, record):
+        self.journal_file.write(json.dumps(record) + '\n')
+        self.journal_file.flush()
+        os.fsync(self.journal_file.fileno())
+
+    def header_mismatches(self, header):
+        """ Return the keys of header whose value differs from the journal header; keys the journal does not store are not compared. """
+        _current = _journal_serializable(header)
+        return [_key for _key in _current if _key in self.header and self.header[_key] != _current[_key]]
+
+    def is_done(self, params):
+        return scan_point_key(params) in self.points
+
+    def get_data(self, params):
+        record = self.points.get(scan_point_key(params))
+        if record is None:
+            return None
+        return record.get("data")
+
+    def finished_points(self):
+        return [record["params"] for record in self.points.values()]
+
+    def start(self, params, data_file):
+        """ Announce that a point is measured into data_file, before the file is written. """
+        self._write_record({
+            "type": "start",
+            "time": time.time(),
+            "params": _journal_serializable(params),
+            "data_file": data_file
+        })
+        self.started.setdefault(scan_point_key(params), []).append(data_file)
+
+    def unfinished_data_files(self):
+        """ Return the data files of started points that are not the file of a finished point. """
+        _unfinished = []
+        for _key, _data_files in self.started.items():
+            _record = self.points.get(_key)
+            _finished_file = None
+            if _record is not None and isinstance(_record.get("data"), dict):
+                _finished_file = _record["data"].get("data_file")
+            _unfinished += [_file for _file in _data_files if _file != _finished_file]
+        return _unfinished
+
+    def record(self, params, data=None):
+        record = {
+            "type": "point",
+            "time": time.time(),
+            "params": _journal_serializable(params),
+            "data": _journal_serializable(data)
+        }
+        self._write_record(record)
+        self.points[scan_point_key(params)] = record
+
+    def close(self):
+        if not self.journal_file.closed:
+            self.journal_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def resume_scan(resume, folder, script_id, incomplete_folder_name="incomplete"):
+    """ Open the journal of an interrupted scan and set aside the data files of its unfinished points.
+
+    resume is 'latest' for the newest journal of the script in folder, or a
+    journal path. The files of points that were started but not finished are
+    moved from the header's output_data_path into its incomplete_folder_name
+    subfolder, so analyses reading the data folder only see finished points.
+    Raises FileNotFoundError if there is no journal.
+    """
+    journal_path = find_latest_scan_journal(folder, script_id) if resume == 'latest' else resume
+    if journal_path is None or not os.path.exists(journal_path):
+        raise FileNotFoundError("No scan journal found to resume from")
+    journal = ScanJournal(journal_path, resume=True)
+    _data_path = journal.header.get('output_data_path')
+    if _data_path is None:
+        return journal
+    _moved_num = 0
+    for _file in journal.unfinished_data_files():
+        _file_path = os.path.join(_data_path, _file)
+        if not os.path.exists(_file_path):
+            continue
+        _incomplete_path = os.path.join(_data_path, incomplete_folder_name)
+        if not os.path.exists(_incomplete_path):
+            os.makedirs(_incomplete_path)
+        shutil.move(_file_path, os.path.join(_incomplete_path, _file))
+        _moved_num += 1
+    if _moved_num > 0:
+        print('\033[33m' + "Warning: moved " + str(_moved_num) + " data files of unfinished points to " + os.path.join(_data_path, incomplete_folder_name) + '\033[0m')
+    return journal
+
+def open_or_resume_scan(journal, journal_path, header, check_keys=('udp', 'i2c'), force=False):
+    """ Start a new journal with header, or check that a resumed journal runs with the same settings.
+
+    journal is the one returned by resume_scan, or None for a new scan at
+    journal_path. For a resumed scan the check_keys entries of header are
+    compared with the journal header; a difference raises ValueError and
+    closes the journal, unless force is set.
+    """
+    if journal is None:
+        return ScanJournal(journal_path, header=header)
+    _mismatches = journal.header_mismatches({_key: header[_key] for _key in check_keys if _key in header})
+    if len(_mismatches) > 0:
+        if not force:
+            journal.close()
+            raise ValueError("Settings " + str(_mismatches) + " differ from the resumed scan in " + journal.journal_path)
+        print('\033[33m' + "Warning: settings " + str(_mismatches) + " differ from the resumed scan, continuing anyway" + '\033[0m')
+    return journal
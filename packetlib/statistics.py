@@ -0,0 +1,87 @@
+import numpy as np
+
+channel_value_names = ["val0", "val1", "val2"]
+
+class ChannelStatistics:
+    """ Streaming per-channel statistics of val0, val1 and val2.
+
+    Event batches of shape (n_events, channel_num) are merged into running
+    means and squared deviation sums (Welford / Chan et al.), so the memory
+    does not grow with the number of events and the statistics of the events
+    received so far are always available. With hist_bins set, fixed-bin count
+    histograms over hist_range are kept per channel as well.
+    """
+    def __init__(self, channel_num=152, hist_bins=None, hist_range=(0, 1024)):
+        self.channel_num = channel_num
+        self.event_count = 0
+        self.mean_array = np.zeros((len(channel_value_names), channel_num))
+        self.m2_array   = np.zeros((len(channel_value_names), channel_num))
+        self.min_array  = np.full((len(channel_value_names), channel_num), np.inf)
+        self.max_array  = np.full((len(channel_value_names), channel_num), -np.inf)
+        self.hist_bins  = hist_bins
+        self.hist_range = hist_range
+        self.histograms = None
+        if hist_bins is not None:
+            self.histograms = np.zeros((len(channel_value_names), channel_num, hist_bins), dtype=np.int64)
+
+    def update(self, val0, val1, val2):
+        """ Merge a batch of events, each argument of shape (n_events, channel_num). """
+        _batch = np.stack([np.asarray(val0, dtype=float), np.asarray(val1, dtype=float), np.asarray(val2, dtype=float)])
+        _batch_num = _batch.shape[1]
+        if _batch_num == 0:
+            return
+        _batch_mean = _batch.mean(axis=1)
+        _batch_m2   = ((_batch - _batch_mean[:, np.newaxis, :]) ** 2).sum(axis=1)
+        _total_num  = self.event_count + _batch_num
+        _delta      = _batch_mean - self.mean_array
+        self.mean_array += _delta * (_batch_num / _total_num)
+        self.m2_array   += _batch_m2 + _delta ** 2 * (self.event_count * _batch_num / _total_num)
+        self.event_count = _total_num
+        self.min_array = np.minimum(self.min_array, _batch.min(axis=1))
+        self.max_array = np.maximum(self.max_array, _batch.max(axis=1))
+        if self.histograms is not None:
+            self._fill_histograms(_batch)
+
+    def _fill_histograms(self, _batch):
+        _low, _high = self.hist_range
+        _bin_index = np.floor((_batch - _low) * (self.hist_bins / (_high - _low))).astype(np.int64)
+        _in_range  = (_bin_index >= 0) & (_bin_index < self.hist_bins)
+        _chn_index = np.broadcast_to(np.arange(self.channel_num), _batch.shape[1:])
+        for _value_index in range(len(channel_value_names)):
+            _mask = _in_range[_value_index]
+            _keys = _chn_index[_mask] * self.hist_bins + _bin_index[_value_index][_mask]
+            self.histograms[_value_index] += np.bincount(_keys, minlength=self.channel_num * self.hist_bins).reshape(self.channel_num, self.hist_bins)
+
+    def _value_index(self, value_name):
+        return channel_value_names.index(value_name)
+
+    def mean(self, value_name="val0"):
+        return self.mean_array[self._value_index(value_name)].copy()
+
+    def std(self, value_name="val0"):
+        """ Population standard deviation, as np.std. """
+        if self.event_count == 0:
+            return np.zeros(self.channel_num)
+        return np.sqrt(self.m2_array[self._value_index(value_name)] / self.event_count)
+
+    def sem(self, value_name="val0"):
+        """ Standard error of the mean, using the sample standard deviation. """
+        if self.event_count < 2:
+            return np.full(self.channel_num, np.inf)
+        return np.sqrt(self.m2_array[self._value_index(value_name)] / (self.event_count - 1) / self.event_count)
+
+    def min(self, value_name="val0"):
+        return self.min_array[self._value_index(value_name)].copy()
+
+    def max(self, value_name="val0"):
+        return self.max_array[self._value_index(value_name)].copy()
+
+    def histogram(self, value_name="val0"):
+        if self.histograms is None:
+            return None
+        return self.histograms[self._value_index(value_name)]
+
+    def hist_bin_edges(self):
+        if self.hist_bins is None:
+            return None
+        return np.linspace(self.hist_range[0], self.hist_range[1], self.hist_bins + 1)
@@ -0,0 +1,147 @@
+from .decoder import *
+from .compressed_stream import *
+import json
+import numpy as np
+
+sparse_event_line_tag = "Z"
+
+def load_pedestal_calib(file_path, default_noise=2.0):
+    """ Return the per-channel pedestal, noise and dead channel mask (152 each) of a pedestal calibration JSON.
+
+    Files written before the noise was stored ('pede_noise') get default_noise
+    for every channel.
+    """
+    with open(file_path, 'r') as f:
+        pedestal_calib = json.load(f)
+    pedestal = np.asarray(pedestal_calib["pede_values"], dtype=float)
+    if "pede_noise" in pedestal_calib:
+        noise = np.asarray(pedestal_calib["pede_noise"], dtype=float)
+    else:
+        print('\033[33m' + "Warning: no pedestal noise in " + file_path + ", using " + str(default_noise) + " for all channels" + '\033[0m')
+        noise = np.full(len(pedestal), default_noise)
+    dead = np.zeros(len(pedestal), dtype=bool)
+    dead[[_chn for _chn in pedestal_calib.get("dead_channels", []) if 0 <= _chn < len(pedestal)]] = True
+    return pedestal, noise, dead
+
+class ZeroSuppressor:
+    """ Select the channels of an event that are above pedestal.
+
+    A channel is kept when its ADC is more than threshold_sigma noise above
+    the pedestal, or when it carries ToT or ToA. The noise is clamped to
+    min_noise so that channels with a very quiet pedestal do not pass on
+    single-count fluctuations. Dead channels are never kept.
+    """
+    def __init__(self, pedestal, noise, threshold_sigma=5.0, min_noise=1.0, dead=None):
+        self.threshold = np.asarray(pedestal, dtype=float) + threshold_sigma * np.maximum(np.asarray(noise, dtype=float), min_noise)
+        self.alive = np.ones(len(self.threshold), dtype=bool) if dead is None else ~np.asarray(dead, dtype=bool)
+
+    def hit_mask(self, words):
+        """ Return the hit mask (n_events, 152) of raw channel words (n_events, 152). """
+        _decoded = decode_channel_words(words)
+        _adc_hit = _decoded["adc_valid"] & (_decoded["adc"] > self.threshold)
+        return (_adc_hit | _decoded["tot_valid"] | _decoded["toa_valid"]) & self.alive
+
+def sparse_event_lines(boards, timestamps, words, daqh, hit_mask):
+    """ Format events as sparse lines: tag, board, timestamp, the 4 DaqH words, the 152-bit hit mask and the words of the hit channels, all hex. """
+    _mask_values = np.packbits(np.asarray(hit_mask, dtype=bool), axis=1)
+    _lines = []
+    for _event in range(len(timestamps)):
+        _fields = [sparse_event_line_tag, f"{boards[_event]:02X}", f"{timestamps[_event]:08X}"]
+        _fields += [f"{_d:08X}" for _d in daqh[_event]]
+        _fields.append(_mask_values[_event].tobytes().hex().upper())
+        _fields += [f"{_w:08X}" for _w in words[_event][hit_mask[_event]]]
+        _lines.append(' '.join(_fields))
+    return _lines
+
+def parse_sparse_event_line(line):
+    """ Return (board, timestamp, words (152), daqh (4), hit_mask (152)) of a sparse line; suppressed channels have word 0. """
+    _fields = line.split()
+    _board = int(_fields[1], 16)
+    _timestamp = int(_fields[2], 16)
+    _daqh = [int(_d, 16) for _d in _fields[3:7]]
+    hit_mask = np.unpackbits(np.frombuffer(bytes.fromhex(_fields[7]), dtype=np.uint8))[:152].astype(bool)
+    words = np.zeros(152, dtype=np.uint32)
+    words[hit_mask] = [int(_w, 16) for _w in _fields[8:]]
+    return _board, _timestamp, words, _daqh, hit_mask
+
+class SparseEventWriter:
+    """ Zero-suppress events in batches and write them as sparse lines.
+
+    add takes the raw words (152) and DaqH words (4) of one board event;
+    every batch_size events the hit masks are computed in one vectorized
+    pass with the suppressor of each board. Boards without a suppressor keep
+    all channels.
+    """
+    def __init__(self, output_file, suppressors, batch_size=256):
+        self.output_file = output_file
+        self.suppressors = suppressors
+        self.batch_size = batch_size
+        self.event_num = 0
+        self.hit_num = 0
+        self._boards, self._timestamps, self._words, self._daqh = [], [], [], []
+
+    def add(self, board, timestamp, words, daqh):
+        self._boards.append(board)
+        self._timestamps.append(timestamp)
+        self._words.append(words)
+        self._daqh.append(daqh)
+        if len(self._boards) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self._boards) == 0:
+            return
+        _boards = np.array(self._boards)
+        _words = np.array(self._words, dtype=np.uint32)
+        _hit_mask = np.ones(_words.shape, dtype=bool)
+        for _board, _suppressor in self.suppressors.items():
+            _board_rows = _boards == _board
+            if np.any(_board_rows):
+                _hit_mask[_board_rows] = _suppressor.hit_mask(_words[_board_rows])
+        _record_output = hasattr(self.output_file, 'end_record')
+        for _line, _timestamp in zip(sparse_event_lines(self._boards, self._timestamps, _words, self._daqh, _hit_mask), self._timestamps):
+            self.output_file.write(_line + '\n')
+            if _record_output:
+                # every sparse line is a complete event, a segmented output may rotate after it
+                self.output_file.end_record(_timestamp)
+        self.event_num += len(self._boards)
+        self.hit_num += int(_hit_mask.sum())
+        self._boards, self._timestamps, self._words, self._daqh = [], [], [], []
+
+def is_sparse_run_file(file_path):
+    """ Check whether the first data line of a run file is a sparse event line. """
+    with open_run_file(file_path) as f:
+        for line in f:
+            if line.startswith('#') or line.strip() == '':
+                continue
+            return line.startswith(sparse_event_line_tag + ' ')
+    return False
+
+def iter_sparse_run_file_batches(file_path, batch_size=4096, board=None):
+    """ Yield the events of a sparse run file in the batch format of iter_run_file_batches, plus the 'hit_mask' (n, 152). """
+    _boards, _timestamps, _words, _daqh, _hit_masks = [], [], [], [], []
+    def _batch():
+        return {
+            "board": np.array(_boards, dtype=np.uint8),
+            "timestamp": np.array(_timestamps, dtype=np.uint32),
+            "words": np.array(_words, dtype=np.uint32).reshape(-1, 152),
+            "daqh": np.array(_daqh, dtype=np.uint32).reshape(-1, 4),
+            "hit_mask": np.array(_hit_masks, dtype=bool).reshape(-1, 152)
+        }
+    with open_run_file(file_path) as f:
+        for line in f:
+            if not line.startswith(sparse_event_line_tag + ' '):
+                continue
+            _board, _timestamp, _event_words, _event_daqh, _hit_mask = parse_sparse_event_line(line)
+            if board is not None and _board != board:
+                continue
+            _boards.append(_board)
+            _timestamps.append(_timestamp)
+            _words.append(_event_words)
+            _daqh.append(_event_daqh)
+            _hit_masks.append(_hit_mask)
+            if len(_boards) >= batch_size:
+                yield _batch()
+                _boards, _timestamps, _words, _daqh, _hit_masks = [], [], [], [], []
+    if len(_boards) > 0:
+        yield _batch()